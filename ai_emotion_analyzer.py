@@ -1,16 +1,21 @@
 # ai_emotion_analyzer.py
 
 import os
+import copy
 import json
-import pandas as pd
+import argparse
 import datetime
 import re
+import hashlib
+import time
+from contextlib import nullcontext
+from functools import partial
 from math import ceil
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED, ALL_COMPLETED
 import traceback # Import the traceback module for detailed error logging
 
-# Import the Google GenAI library
-from google import genai
-from google.genai import types
+# google.genai and pandas take seconds to import, so they are imported where they are used: a dry run
+# never needs the API client, and the raw output is only turned into a DataFrame at the end of a run.
 
 # Import settings from the configuration file
 from config import (
@@ -20,31 +25,291 @@ from config import (
     QUESTION,
     SHEET_NAME,
     BATCH_SIZE,
+    BATCH_TOKEN_BUDGET,
+    OUTPUT_TOKENS_PER_EXCERPT,
+    SORT_BATCHES_BY_LENGTH,
+    INPUT_CHUNK_SIZE,
+    MAX_CONCURRENT_BATCHES,
+    MAX_CONCURRENT_JOBS,
+    WRITE_RUN_METRICS,
+    LOG_VERBOSITY,
+    LOG_MAX_BYTES,
+    REQUESTS_PER_MINUTE,
+    TOKENS_PER_MINUTE,
+    MAX_RETRIES,
+    RETRY_BASE_DELAY,
+    RETRY_MAX_DELAY,
+    RESPONSE_CACHE_PATH,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    USE_CONTEXT_CACHE,
+    CONTEXT_CACHE_TTL,
+    USE_RESPONSE_SCHEMA,
+    SCORES_ONLY,
+    RAW_OUTPUT_FORMAT,
+    EXPORT_EXCEL,
+    PARQUET_ROW_GROUP_SIZE,
+    NEAR_DUPLICATE_THRESHOLD,
+    SELF_CONSISTENCY_SAMPLES,
+    SELF_CONSISTENCY_MODE,
+    SELF_CONSISTENCY_MIN_SAMPLES,
+    SELF_CONSISTENCY_EARLY_STOP_SPREAD,
+    SELF_CONSISTENCY_THRESHOLD,
+    LOCAL_SCORER,
+    LOCAL_SCORER_CONFIDENCE,
+    BACKEND,
+    BATCH_PREDICTION_GCS_PREFIX,
+    BATCH_PREDICTION_POLL_INTERVAL,
+    BATCH_PREDICTION_TIMEOUT,
     EMOTION_CODEBOOK,
     INPUT_DIR,
     OUTPUT_DIR,
     SPREADSHEET_FILENAME
 )
+from batch_scheduler import BatchScheduler
+from checkpoint_journal import CheckpointJournal
+from response_cache import ResponseCache
+from stream_parser import StreamingJSONArrayParser
+from response_schema import build_response_schema, compile_item_validator
+from input_reader import ExcerptReader, has_text
+from result_store import ParquetResultWriter
+from batch_prediction import BatchPredictionJob, VertexBatchRunner
+from run_metrics import RunMetrics, add_metrics, set_metrics, current_metrics, use_metrics
+from prompt_logger import PromptLogger
+from near_duplicates import NearDuplicateIndex
+from local_scorer import confident_analyses, load_local_scorer
+from self_consistency import aggregate_samples, samples_agree
+from score_store import ScoreStore
+from incremental import (FINGERPRINT_SHEET, FINGERPRINT_METADATA_KEY, fingerprint_rows, load_previous_run,
+                         merge_analyses, run_fingerprints)
+
+# Sampling settings sent with every request. They are part of the response cache key.
+GENERATION_SETTINGS = {
+    "temperature": 0.2,
+    "top_p": 0.95,
+    "max_output_tokens": 8192,
+}
+
+# Rough characters-per-token ratio used for batching and rate limiting estimates.
+CHARS_PER_TOKEN = 4
+CODEBOOK_TOKEN_ESTIMATE = len(json.dumps(EMOTION_CODEBOOK, indent=2)) // CHARS_PER_TOKEN
+# Excel worksheets hold at most 1,048,576 rows, including the header row.
+EXCEL_MAX_ROWS = 1_048_576 - 1
+# Share of max_output_tokens a planned batch may fill, leaving headroom for longer-than-expected answers.
+OUTPUT_TOKEN_SAFETY_MARGIN = 0.8
+
+
+def estimate_tokens(text):
+    """Estimates the number of tokens in a piece of text."""
+    return max(1, ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def estimate_output_tokens(excerpt_tokens):
+    """Estimates the response size for one excerpt; justifications tend to grow with the excerpt."""
+    return OUTPUT_TOKENS_PER_EXCERPT + excerpt_tokens // 2
+
+
+def estimate_batch_tokens(excerpts_batch):
+    """Estimates the input tokens of a batch prompt: the codebook plus the excerpt payload."""
+    return CODEBOOK_TOKEN_ESTIMATE + estimate_tokens(json.dumps(excerpts_batch, default=str))
+
+
+def plan_batches(excerpts, token_budget=None, max_batch_size=None, max_output_tokens=None, sort_by_length=None):
+    """
+    Packs excerpts into batches that fill a token budget instead of a fixed excerpt count.
+
+    A batch is closed when adding the next excerpt would exceed the input token budget for the
+    excerpt payload, push the expected response past the output token limit, or exceed
+    `max_batch_size` excerpts. An excerpt that is too large on its own gets a batch of its own.
+
+    Args:
+        excerpts (list): Payload dictionaries (NewID and Text) to be sent to the model.
+        token_budget (int): Maximum estimated input tokens of the excerpt payload per batch
+                            (defaults to BATCH_TOKEN_BUDGET).
+        max_batch_size (int): Maximum number of excerpts per batch (defaults to BATCH_SIZE).
+        max_output_tokens (int): The model's output limit (defaults to GENERATION_SETTINGS).
+        sort_by_length (bool): If True, excerpts are packed shortest first so that similar-size
+                               excerpts share a batch (defaults to SORT_BATCHES_BY_LENGTH).
+
+    Returns:
+        list: A list of batches, each a list of payload dictionaries.
+    """
+    token_budget = BATCH_TOKEN_BUDGET if token_budget is None else token_budget
+    max_batch_size = BATCH_SIZE if max_batch_size is None else max_batch_size
+    sort_by_length = SORT_BATCHES_BY_LENGTH if sort_by_length is None else sort_by_length
+    if max_output_tokens is None:
+        max_output_tokens = GENERATION_SETTINGS["max_output_tokens"]
+    output_budget = int(max_output_tokens * OUTPUT_TOKEN_SAFETY_MARGIN)
+
+    sized = [(estimate_tokens(json.dumps(excerpt, default=str)), excerpt) for excerpt in excerpts]
+    if sort_by_length:
+        sized.sort(key=lambda item: item[0])
+
+    batches = []
+    current, current_input, current_output = [], 0, 0
+    for input_tokens, excerpt in sized:
+        output_tokens = estimate_output_tokens(input_tokens)
+        if current and (current_input + input_tokens > token_budget
+                        or current_output + output_tokens > output_budget
+                        or (max_batch_size and len(current) >= max_batch_size)):
+            batches.append(current)
+            current, current_input, current_output = [], 0, 0
+        current.append(excerpt)
+        current_input += input_tokens
+        current_output += output_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def build_system_instruction_text(include_justification=True):
+    """The model's persona and task description."""
+    deliverable = ("a confidence score and a detailed justification" if include_justification
+                   else "a confidence score")
+    return (
+        "You are an expert research assistant specializing in the analysis of emotions in text. "
+        "Your task is to meticulously classify the specific emotions conveyed in excerpts from parent responses. "
+        f"For each excerpt, you must provide {deliverable} for each emotion listed in the provided codebook. "
+        "Adhere strictly to the codebook definitions and the required JSON output format."
+    )
+
+
+def build_output_format_instructions(emotions, include_justification=True):
+    """Describes the expected JSON list, with one entry per emotion in `emotions`."""
+    entry = '{"score": 0.xx, "justification": "..."}' if include_justification else '{"score": 0.xx}'
+    emotion_lines = ",\n".join(f'      "{emotion}": {entry}' for emotion in emotions)
+    return (
+        "For EACH excerpt, provide your analysis as a JSON object. Return your complete analysis as a single, "
+        "valid JSON list, where each object corresponds to one input excerpt and uses the following format:\n\n"
+        "[\n"
+        "  {\n"
+        "    \"NewID\": \"(The ID of the first excerpt)\",\n"
+        "    \"analysis\": {\n"
+        f"{emotion_lines}\n"
+        "    }\n"
+        "  }\n"
+        "]\n\n"
+        "Ensure the output is ONLY the JSON list, without any surrounding text or markdown."
+    )
+
+
+def _static_prompt_inputs(question, scores_only, use_response_schema, samples, sample_mode):
+    """Everything besides the excerpt text that determines the model's answer."""
+    include_justification = not scores_only
+    static_inputs = {
+        "question": question,
+        "codebook": EMOTION_CODEBOOK,
+        "model": GEMINI_MODEL,
+        "generation": GENERATION_SETTINGS,
+        "system_instruction": build_system_instruction_text(include_justification),
+        "output_format": build_output_format_instructions(EMOTION_CODEBOOK, include_justification),
+        "response_schema": use_response_schema,
+    }
+    if samples > 1:
+        # Aggregated analyses differ from single samples. Single-sample keys stay as they were.
+        static_inputs["self_consistency"] = [samples, sample_mode,
+                                             SELF_CONSISTENCY_MIN_SAMPLES, SELF_CONSISTENCY_EARLY_STOP_SPREAD,
+                                             SELF_CONSISTENCY_THRESHOLD]
+    return static_inputs
+
+
+def prompt_fingerprint(question=QUESTION, scores_only=SCORES_ONLY, use_response_schema=USE_RESPONSE_SCHEMA,
+                       samples=SELF_CONSISTENCY_SAMPLES, sample_mode=SELF_CONSISTENCY_MODE):
+    """
+    Hashes everything besides the excerpt text that determines the model's answer. The defaults are the
+    settings of config.py; an EmotionClassifierClient computes its own from the settings it was built with.
+    """
+    static_inputs = _static_prompt_inputs(question, scores_only, use_response_schema, samples, sample_mode)
+    return hashlib.sha256(json.dumps(static_inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def settings_fingerprint(question=QUESTION, scores_only=SCORES_ONLY, use_response_schema=USE_RESPONSE_SCHEMA,
+                         samples=SELF_CONSISTENCY_SAMPLES, sample_mode=SELF_CONSISTENCY_MODE):
+    """
+    Hashes the inputs of `prompt_fingerprint` other than the codebook, whose entries incremental runs
+    track one by one (see incremental.py).
+    """
+    static_inputs = _static_prompt_inputs(question, scores_only, use_response_schema, samples, sample_mode)
+    del static_inputs["codebook"], static_inputs["output_format"]
+    return hashlib.sha256(json.dumps(static_inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def client_fingerprints(classifier_client, question=QUESTION):
+    """
+    The prompt and settings fingerprints of a classifier client. Clients without them (such as test
+    doubles) get the fingerprints of the config.py settings for `question`.
+
+    Returns:
+        tuple: (prompt fingerprint, settings fingerprint)
+    """
+    fingerprints = (getattr(classifier_client, "prompt_fingerprint", None),
+                    getattr(classifier_client, "settings_fingerprint", None))
+    if all(isinstance(fingerprint, str) for fingerprint in fingerprints):
+        return fingerprints
+    return prompt_fingerprint(question), settings_fingerprint(question)
+
+
+def excerpt_cache_key(text, fingerprint=None):
+    """
+    The response cache key for one excerpt: a hash of its text and the prompt fingerprint of the client
+    that answers it (default: the fingerprint of the config.py settings).
+    """
+    if fingerprint is None:
+        fingerprint = prompt_fingerprint()
+    return hashlib.sha256(f"{fingerprint}\0{text}".encode('utf-8')).hexdigest()
+
+
+SAFETY_CATEGORIES = [
+    "HARM_CATEGORY_HATE_SPEECH",
+    "HARM_CATEGORY_DANGEROUS_CONTENT",
+    "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+    "HARM_CATEGORY_HARASSMENT",
+]
+
 
 class EmotionClassifierClient:
     """
     A client to classify emotions in text batches using the Google GenAI library for Vertex AI,
     following the provided exemplar for API calls.
+
+    Everything in the prompt that does not depend on the batch (system instruction, codebook, output
+    format and generation config) is built once per client. With `use_context_cache`, the system
+    instruction and codebook are uploaded once as a Vertex AI cached context and each request only
+    sends the excerpts.
+
+    With `samples` above 1, every batch is sampled several times and each excerpt's scores are
+    aggregated (see self_consistency.py).
     """
-    def __init__(self, log_file_path):
+    def __init__(self, log_file_path, use_context_cache=USE_CONTEXT_CACHE, scores_only=SCORES_ONLY,
+                 use_response_schema=USE_RESPONSE_SCHEMA, log_verbosity=LOG_VERBOSITY, genai_client=None,
+                 samples=SELF_CONSISTENCY_SAMPLES, sample_mode=SELF_CONSISTENCY_MODE):
         """
-        Initializes the unified client for Vertex AI and sets up the log file path.
+        Initializes the unified client for Vertex AI and starts the prompt log.
+
+        Args:
+            log_file_path (str): Where prompts and responses are logged (see PromptLogger).
+            use_context_cache (bool): Upload the system instruction and codebook as a cached context.
+            scores_only (bool): Ask for scores without justifications.
+            use_response_schema (bool): Constrain the response with a JSON schema built from the codebook.
+            log_verbosity (str): How much is logged: "off", "errors", "batches" or "debug".
+            genai_client: The API client to use instead of a Vertex AI `genai.Client`, such as the
+                          FakeGenAIClient of the offline benchmark.
+            samples (int): Samples taken of every batch (self-consistency); 1 takes a single sample.
+            sample_mode (str): "parallel" (concurrent calls with an early stop) or "candidates" (one
+                               request with `candidate_count` set).
         """
+        if sample_mode not in ("parallel", "candidates"):
+            raise ValueError(f"Unknown self-consistency mode '{sample_mode}'; expected 'parallel' or 'candidates'")
         try:
-            # Initialize the client as shown in the exemplar.
-            self.client = genai.Client(
-                vertexai=True,
-                project=PROJECT_ID,
-                location=LOCATION,
-            )
-            self.log_file_path = log_file_path
+            if genai_client is None:
+                from google import genai
+                # Initialize the client as shown in the exemplar.
+                genai_client = genai.Client(
+                    vertexai=True,
+                    project=PROJECT_ID,
+                    location=LOCATION,
+                )
+            self.client = genai_client
             print(f"✅ Client initialized for project '{PROJECT_ID}' in location '{LOCATION}'.")
-            print(f"📝 Logging prompts and responses to: {self.log_file_path}")
 
         except Exception as e:
             print("\n❌ Client Initialization Failed.")
@@ -53,187 +318,1230 @@ class EmotionClassifierClient:
             print("\nPlease check your .env file, authentication, and Google Cloud project settings.\n")
             raise e
 
+        self.question = QUESTION
+        self.samples = max(1, samples)
+        self.sample_mode = sample_mode
+        # API requests made for one batch, which the BatchScheduler reserves from the rate limits.
+        self.requests_per_batch = self.samples if sample_mode == "parallel" else 1
+        self.include_justification = not scores_only
+        self.use_response_schema = use_response_schema
+        self.codebook = EMOTION_CODEBOOK
+        self.validate_item = compile_item_validator(self.codebook, self.include_justification)
+        self._compute_fingerprints()
+        self._build_static_prompt()
+        self.cached_content_name = None
+        if use_context_cache:
+            self._create_context_cache()
 
-    def classify_batch(self, excerpts_batch, batch_num, total_batches):
+        # Batches may run concurrently; the logger writes their records one at a time on its own thread.
+        self.logger = PromptLogger(log_file_path, verbosity=log_verbosity, max_bytes=LOG_MAX_BYTES)
+        self.log_file_path = self.logger.path
+        # The static prompt the batches are logged against; None for this client's own, full prompt.
+        self.prompt_id = None
+        if self.logger.enabled:
+            self._log_static_prompt()
+            print(f"📝 Logging prompts and responses ({log_verbosity}) to: {self.log_file_path}")
+
+    def _compute_fingerprints(self):
+        """Fingerprints the question and the settings this client was built with (see `prompt_fingerprint`)."""
+        settings = dict(question=self.question, scores_only=not self.include_justification,
+                        use_response_schema=self.use_response_schema, samples=self.samples,
+                        sample_mode=self.sample_mode)
+        self.prompt_fingerprint = prompt_fingerprint(**settings)
+        self.settings_fingerprint = settings_fingerprint(**settings)
+
+    def _log_static_prompt(self):
+        """Logs the static parts of this client's prompt, once per log file."""
+        self.logger.log_static(
+            prompt_id=self.prompt_id,
+            model=GEMINI_MODEL,
+            system_instruction=build_system_instruction_text(self.include_justification),
+            cached_content=self.cached_content_name,
+            prompt_intro=self.prompt_intro,
+            prompt_suffix=self.prompt_suffix,
+        )
+
+    def _build_static_prompt(self):
+        """Precomputes the parts of every request that do not change between batches."""
+        from google.genai import types
+        self.codebook_text = f"CODEBOOK:\n{json.dumps(self.codebook, indent=2)}"
+        self.output_format_instructions = build_output_format_instructions(self.codebook, self.include_justification)
+        self.system_instruction = types.Content(
+            parts=[types.Part(text=build_system_instruction_text(self.include_justification))]
+        )
+        self.safety_settings = [
+            types.SafetySetting(category=category, threshold="BLOCK_MEDIUM_AND_ABOVE")
+            for category in SAFETY_CATEGORIES
+        ]
+        self.output_settings = {}
+        if self.use_response_schema:
+            self.output_settings = {
+                "response_mime_type": "application/json",
+                "response_schema": build_response_schema(self.codebook, self.include_justification),
+            }
+        self.generation_config = types.GenerateContentConfig(
+            **GENERATION_SETTINGS,
+            **self.output_settings,
+            safety_settings=self.safety_settings,
+            system_instruction=self.system_instruction
+        )
+        self.prompt_intro = (
+            "The following JSON object contains a batch of excerpts from parent responses. "
+            "Analyze each excerpt individually.\n\n"
+        )
+        self.prompt_suffix = f"{self.codebook_text}\n\n{self.output_format_instructions}"
+
+    def _create_context_cache(self):
+        """
+        Uploads the system instruction and codebook as a cached context that every request references.
+        Falls back to sending the full prompt if the cache cannot be created (e.g. the model does not
+        support caching or the codebook is below the minimum cacheable size).
+        """
+        from google.genai import types
+        try:
+            cached_content = self.client.caches.create(
+                model=GEMINI_MODEL,
+                config=types.CreateCachedContentConfig(
+                    display_name="emotion-codebook",
+                    system_instruction=self.system_instruction,
+                    contents=[types.Content(role="user", parts=[types.Part(text=self.codebook_text)])],
+                    ttl=CONTEXT_CACHE_TTL,
+                )
+            )
+        except Exception as e:
+            print(f"⚠️ Could not create a cached context for the codebook ({type(e).__name__}: {e}). "
+                  "Sending the full prompt with every batch instead.")
+            return
+
+        self.cached_content_name = cached_content.name
+        # The system instruction lives in the cache, so requests must not repeat it.
+        self.generation_config = types.GenerateContentConfig(
+            **GENERATION_SETTINGS,
+            **self.output_settings,
+            safety_settings=self.safety_settings,
+            cached_content=self.cached_content_name
+        )
+        self.prompt_intro = (
+            "The following JSON object contains a batch of excerpts from parent responses. "
+            "Analyze each excerpt individually using the CODEBOOK provided above.\n\n"
+        )
+        self.prompt_suffix = self.output_format_instructions
+        print(f"🗄️ Codebook uploaded as cached context '{self.cached_content_name}' (TTL {CONTEXT_CACHE_TTL}).")
+
+    def close(self):
+        """
+        Flushes the prompt log and deletes the cached context, if one was created, so it stops accruing
+        storage charges.
+        """
+        self.logger.close()
+        if self.cached_content_name is None:
+            return
+        try:
+            self.client.caches.delete(name=self.cached_content_name)
+        except Exception as e:
+            print(f"⚠️ Could not delete cached context '{self.cached_content_name}': {e}")
+        self.cached_content_name = None
+
+    def for_question(self, question):
+        """
+        Returns a view of this client that asks about `question` instead. The view shares the API
+        client, static prompt, cached context and prompt log; only the original should be closed.
+        """
+        view = copy.copy(self)
+        view.question = question
+        view._compute_fingerprints()
+        return view
+
+    def for_emotions(self, emotions):
+        """
+        Returns a view of this client that scores only `emotions`, with a prompt, schema and validator
+        built from just their codebook entries. Used to re-score emotions whose definitions changed
+        (see incremental.py). The reduced codebook is sent inline rather than through the cached
+        context. The view shares the API client and prompt log, where its reduced prompt is logged as a
+        static record of its own (see PromptLogger); only the original should be closed.
+        """
+        view = copy.copy(self)
+        view.codebook = {emotion: self.codebook[emotion] for emotion in emotions}
+        view.validate_item = compile_item_validator(view.codebook, view.include_justification)
+        view.cached_content_name = None
+        view._build_static_prompt()
+        view.prompt_id = f"emotions:{','.join(view.codebook)}"
+        if view.logger.enabled:
+            view._log_static_prompt()
+        return view
+
+    def build_payload(self, excerpts_batch):
+        """The part of the prompt that changes between batches: the question and the excerpts."""
+        return {
+            "question_asked": self.question,
+            "excerpts_to_classify": excerpts_batch
+        }
+
+    def build_prompt(self, excerpts_batch):
+        """Builds the prompt for one batch from the precomputed static parts and the batch payload."""
+        return self._prompt_from_payload(self.build_payload(excerpts_batch))
+
+    def _prompt_from_payload(self, payload):
+        return f"{self.prompt_intro}{json.dumps(payload, indent=2)}\n\n{self.prompt_suffix}"
+
+    def classify_batch(self, excerpts_batch, batch_num, total_batches, samples=None):
         """
         Classifies a batch of text excerpts for emotions using a streaming API call.
 
         Args:
             excerpts_batch (list): A list of dictionaries for the batch.
             batch_num (int): The current batch number.
-            total_batches (int): The total number of batches.
+            total_batches (int): The total number of batches, or "?" while the input is still being read.
+            samples (int): Samples to take of the batch (default: the client's `samples`). With more
+                           than one, each excerpt's scores are aggregated into a mean, variance and
+                           agreement rate (see `aggregate_samples`).
 
         Returns:
-            list: A list of dictionaries with the emotion analysis for each excerpt,
-                  or an empty list if an error occurs.
+            list: A list of dictionaries with the emotion analysis for each excerpt. If the response
+                  was truncated or partly malformed, only the excerpts that decoded are returned.
+
+        Raises:
+            Exception: Any API or parsing error is logged and re-raised so that the caller
+                       (normally a BatchScheduler) can decide whether to retry the batch.
         """
         print(f"\nProcessing a batch of {len(excerpts_batch)} excerpts...")
+        samples = self.samples if samples is None else samples
+        if samples <= 1:
+            return self._classify_sample(excerpts_batch, batch_num, total_batches)
+        if self.sample_mode == "candidates":
+            return self._classify_candidates(excerpts_batch, batch_num, total_batches, samples)
+        return self._classify_parallel(excerpts_batch, batch_num, total_batches, samples)
 
-        payload = {
-            "question_asked": QUESTION,
-            "excerpts_to_classify": excerpts_batch
-        }
-        json_payload = json.dumps(payload, indent=2)
-
-        prompt = (
-            "The following JSON object contains a batch of excerpts from parent responses. "
-            "Analyze each excerpt individually.\n\n"
-            f"{json_payload}\n\n"
-            f"CODEBOOK:\n{json.dumps(EMOTION_CODEBOOK, indent=2)}\n\n"
-            "For EACH excerpt, provide your analysis as a JSON object. Return your complete analysis as a single, "
-            "valid JSON list, where each object corresponds to one input excerpt and uses the following format:\n\n"
-            "[\n"
-            "  {\n"
-            "    \"NewID\": \"(The ID of the first excerpt)\",\n"
-            "    \"analysis\": {\n"
-            "      \"anger\": {\"score\": 0.xx, \"justification\": \"...\"},\n"
-            "      \"fear\": {\"score\": 0.xx, \"justification\": \"...\"},\n"
-            "      \"disgust\": {\"score\": 0.xx, \"justification\": \"...\"},\n"
-            "      \"sadness\": {\"score\": 0.xx, \"justification\": \"...\"},\n"
-            "      \"enjoyment\": {\"score\": 0.xx, \"justification\": \"...\"},\n"
-            "      \"surprise\": {\"score\": 0.xx, \"justification\": \"...\"}\n"
-            "    }\n"
-            "  }\n"
-            "]\n\n"
-            "Ensure the output is ONLY the JSON list, without any surrounding text or markdown."
-        )
+    def _classify_parallel(self, excerpts_batch, batch_num, total_batches, samples):
+        """
+        Takes the samples as concurrent calls: SELF_CONSISTENCY_MIN_SAMPLES first, and the rest only if
+        those disagree. Failed samples are left out; the error is raised only if every sample failed.
+        """
+        record = current_metrics()
 
-        contents = [prompt]
-
-        system_instruction = types.Content(
-            parts=[
-                types.Part(text=(
-                    "You are an expert research assistant specializing in the analysis of emotions in text. "
-                    "Your task is to meticulously classify the specific emotions conveyed in excerpts from parent responses. "
-                    "For each excerpt, you must provide a confidence score and a detailed justification for each emotion listed in the provided codebook. "
-                    "Adhere strictly to the codebook definitions and the required JSON output format."
-                ))
-            ]
-        )
+        def take_sample():
+            # Report to the metrics record of the batch, which is open on the calling thread.
+            with use_metrics(record):
+                return self._classify_sample(excerpts_batch, batch_num, total_batches)
 
-        generation_config = types.GenerateContentConfig(
-            temperature=0.2,
-            top_p=0.95,
-            max_output_tokens=8192,
-            safety_settings=[
-                types.SafetySetting(category="HARM_CATEGORY_HATE_SPEECH", threshold="BLOCK_MEDIUM_AND_ABOVE"),
-                types.SafetySetting(category="HARM_CATEGORY_DANGEROUS_CONTENT", threshold="BLOCK_MEDIUM_AND_ABOVE"),
-                types.SafetySetting(category="HARM_CATEGORY_SEXUALLY_EXPLICIT", threshold="BLOCK_MEDIUM_AND_ABOVE"),
-                types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="BLOCK_MEDIUM_AND_ABOVE"),
-            ],
-            system_instruction=system_instruction
-        )
+        collected, errors = [], []
+        first = min(samples, max(1, SELF_CONSISTENCY_MIN_SAMPLES))
+        with ThreadPoolExecutor(max_workers=samples) as sample_executor:
+            for wave in (first, samples - first):
+                for future in [sample_executor.submit(take_sample) for _ in range(wave)]:
+                    try:
+                        collected.append(future.result())
+                    except Exception as e:
+                        errors.append(e)
+                if wave == first and len(collected) == first and \
+                        samples_agree(collected, excerpts_batch, SELF_CONSISTENCY_EARLY_STOP_SPREAD):
+                    add_metrics(samples_skipped=samples - first)
+                    break
+        if not collected:
+            raise errors[0]
+        add_metrics(samples=len(collected))
+        return aggregate_samples(collected, SELF_CONSISTENCY_THRESHOLD)
 
-        log_header = f"""
-{'='*80}
-BATCH {batch_num}/{total_batches} - {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-{'='*80}
+    def _classify_candidates(self, excerpts_batch, batch_num, total_batches, samples):
+        """Asks for every sample as a candidate of one (non-streaming) request and aggregates the candidates."""
+        payload = self.build_payload(excerpts_batch)
+        config = self.generation_config.model_copy(update={"candidate_count": samples})
+        call_started = time.perf_counter()
+        add_metrics(api_calls=1)
+        try:
+            response = self.client.models.generate_content(
+                model=GEMINI_MODEL,
+                contents=[self._prompt_from_payload(payload)],
+                config=config
+            )
+            add_metrics(api_latency_s=time.perf_counter() - call_started,
+                        **_usage_counts(getattr(response, "usage_metadata", None)))
+            texts = [_candidate_text(candidate) for candidate in getattr(response, "candidates", None) or []]
+            self.logger.log_batch(batch_num, total_batches, payload, texts, prompt_id=self.prompt_id)
+            parse_started = time.perf_counter()
+            results, rejected = self.parse_candidate_texts(texts, excerpts_batch)
+            add_metrics(parse_s=time.perf_counter() - parse_started, samples=len(texts))
+        except Exception as e:
+            self.logger.log_batch(batch_num, total_batches, payload, "", error=f"{type(e).__name__}: {e}",
+                                  prompt_id=self.prompt_id)
+            print(f"❌ Batch {batch_num}/{total_batches}: {type(e).__name__}: {e}")
+            raise
+        if rejected:
+            print(f"⚠️ Batch {batch_num}/{total_batches}: {rejected} malformed element(s) across {len(texts)} candidate(s).")
+        return results
 
----------- PROMPT SENT TO MODEL ----------
-"""
-        print(log_header)
-        print(prompt)
-        with open(self.log_file_path, 'a', encoding='utf-8') as f:
-            f.write(log_header)
-            f.write(prompt + '\n')
+    def _classify_sample(self, excerpts_batch, batch_num, total_batches):
+        """Takes one sample of a batch with a streaming call (see `classify_batch`)."""
+        payload = self.build_payload(excerpts_batch)
+        contents = [self._prompt_from_payload(payload)]
 
+        parser = StreamingJSONArrayParser()
+        results = []
+        response_parts = []
+        stream_error = None
+        usage = None
+        parse_time = 0.0
+        call_started = time.perf_counter()
+        add_metrics(api_calls=1)
         try:
             response_chunks = self.client.models.generate_content_stream(
                 model=GEMINI_MODEL,
                 contents=contents,
-                config=generation_config
+                config=self.generation_config
             )
-            
-            full_response_text = "".join(chunk.text for chunk in response_chunks)
-            
-            response_header = "\n---------- FULL RESPONSE FROM MODEL ----------\n"
-            print(response_header)
-            print(full_response_text)
-            with open(self.log_file_path, 'a', encoding='utf-8') as f:
-                f.write(response_header)
-                f.write(full_response_text + '\n')
 
-            clean_response = re.sub(r'```json\s*(.*)\s*```', r'\1', full_response_text, flags=re.DOTALL)
-            return json.loads(clean_response)
+            # Decode each excerpt's analysis as soon as the stream completes it, so that a dropped
+            # stream or a malformed element only loses the excerpts it actually affects.
+            try:
+                for chunk in response_chunks:
+                    if not response_parts:
+                        set_metrics(time_to_first_chunk_s=round(time.perf_counter() - call_started, 4))
+                    text = chunk.text or ""
+                    response_parts.append(text)
+                    parse_started = time.perf_counter()
+                    results.extend(parser.feed(text))
+                    parse_time += time.perf_counter() - parse_started
+                    # The usage metadata is complete on the last chunk.
+                    usage = getattr(chunk, "usage_metadata", None) or usage
+            except Exception as e:
+                if not results:
+                    raise
+                stream_error = e
+            finally:
+                add_metrics(api_latency_s=time.perf_counter() - call_started, **_usage_counts(usage))
+
+            full_response_text = "".join(response_parts)
+            self.logger.log_batch(batch_num, total_batches, payload, full_response_text, prompt_id=self.prompt_id)
+
+            parse_started = time.perf_counter()
+            results, rejected = self._finish_results(parser, results, full_response_text, excerpts_batch)
+            add_metrics(parse_s=parse_time + time.perf_counter() - parse_started)
+            if stream_error is not None or parser.errors or rejected or (parser.started and not parser.finished):
+                reason = (f"{type(stream_error).__name__}: {stream_error}" if stream_error is not None
+                          else f"{parser.errors + rejected} malformed element(s)" if parser.errors or rejected
+                          else "response was truncated")
+                print(f"⚠️ Batch {batch_num}/{total_batches} was incomplete ({reason}). "
+                      f"Kept {len(results)} of {len(excerpts_batch)} excerpt(s).")
+            return results
             
         except Exception as e:
-            print("\n" + "="*80)
-            print("❌ AN UNEXPECTED ERROR OCCURRED".center(80))
-            print("="*80)
-            print("\n[ERROR DETAILS]")
-            print(f"Type: {type(e).__name__}")
-            print(f"Message: {e}")
-            print("\n[FULL TRACEBACK]")
-            traceback.print_exc()
-            print("\n" + "="*80)
-            return []
-
-
-def process_spreadsheet(file_path, classifier_client):
-    """Loads a spreadsheet, processes texts in batches, and saves the raw model output."""
+            self.logger.log_batch(batch_num, total_batches, payload, "".join(response_parts),
+                                  error=f"{type(e).__name__}: {e}", prompt_id=self.prompt_id)
+            print("\n" + "="*80 + "\n" + "❌ AN UNEXPECTED ERROR OCCURRED".center(80) + "\n" + "="*80
+                  + f"\n\n[ERROR DETAILS]\nBatch: {batch_num}/{total_batches}\nType: {type(e).__name__}\nMessage: {e}"
+                  + "\n\n[FULL TRACEBACK]\n" + traceback.format_exc() + "\n" + "="*80)
+            raise
+
+    def parse_response_text(self, response_text, excerpts_batch):
+        """
+        Decodes and validates a complete (non-streamed) response for a batch, such as one line of a
+        batch prediction output file.
+
+        Returns:
+            tuple: The valid results and the number of malformed items.
+
+        Raises:
+            json.JSONDecodeError: If the response is neither a JSON list nor a single JSON value.
+        """
+        parser = StreamingJSONArrayParser()
+        results = parser.feed(response_text)
+        results, rejected = self._finish_results(parser, results, response_text, excerpts_batch)
+        return results, rejected + parser.errors
+
+    def parse_candidate_texts(self, texts, excerpts_batch):
+        """
+        Decodes the response text of each candidate (sample) of a request and aggregates the samples.
+
+        Returns:
+            tuple: The aggregated results and the number of malformed items across the candidates.
+
+        Raises:
+            json.JSONDecodeError: If no candidate could be decoded.
+        """
+        samples, rejected, error = [], 0, None
+        for text in texts:
+            try:
+                results, malformed = self.parse_response_text(text, excerpts_batch)
+            except json.JSONDecodeError as e:
+                error = e
+                continue
+            samples.append(results)
+            rejected += malformed
+        if not samples and error is not None:
+            raise error
+        return aggregate_samples(samples, SELF_CONSISTENCY_THRESHOLD), rejected
+
+    def _finish_results(self, parser, results, full_response_text, excerpts_batch):
+        """Falls back to decoding the whole response if it was not a JSON list, then validates the items."""
+        if not parser.started:
+            # The response is not a JSON list; fall back to decoding it as a whole.
+            clean_response = re.sub(r'```json\s*(.*)\s*```', r'\1', full_response_text, flags=re.DOTALL)
+            results = json.loads(clean_response)
+            if not isinstance(results, list):
+                results = [results]
+        return self._validate_results(results, excerpts_batch)
+
+    def build_batch_request(self, excerpts_batch):
+        """
+        Builds the request for one batch in the JSON format of a Vertex AI batch prediction input file,
+        with the same prompt, generation settings and response schema as an online call.
+        """
+        generation_config = {
+            "temperature": GENERATION_SETTINGS["temperature"],
+            "topP": GENERATION_SETTINGS["top_p"],
+            "maxOutputTokens": GENERATION_SETTINGS["max_output_tokens"],
+        }
+        if self.samples > 1:
+            generation_config["candidateCount"] = self.samples
+        if self.use_response_schema:
+            generation_config["responseMimeType"] = self.output_settings["response_mime_type"]
+            generation_config["responseSchema"] = self.output_settings["response_schema"]
+        request = {
+            "contents": [{"role": "user", "parts": [{"text": self.build_prompt(excerpts_batch)}]}],
+            "generationConfig": generation_config,
+            "safetySettings": [{"category": category, "threshold": "BLOCK_MEDIUM_AND_ABOVE"}
+                               for category in SAFETY_CATEGORIES],
+        }
+        if self.cached_content_name is not None:
+            request["cachedContent"] = self.cached_content_name
+        else:
+            request["systemInstruction"] = {
+                "parts": [{"text": build_system_instruction_text(self.include_justification)}]
+            }
+        return request
+
+    def _validate_results(self, results, excerpts_batch):
+        """
+        Validates each decoded item on its own and restores the NewID of the matching input excerpt
+        (the response schema returns every NewID as a string). If the response repeats an excerpt, only
+        its first valid item is kept.
+
+        Returns:
+            tuple: The valid results and the number of rejected items.
+        """
+        ids_by_text = {str(excerpt["NewID"]): excerpt["NewID"] for excerpt in excerpts_batch}
+        valid = []
+        seen = set()
+        for item in results:
+            item = self.validate_item(item)
+            if item is None or str(item["NewID"]) not in ids_by_text or str(item["NewID"]) in seen:
+                continue
+            seen.add(str(item["NewID"]))
+            item["NewID"] = ids_by_text[str(item["NewID"])]
+            valid.append(item)
+        return valid, len(results) - len(valid)
+
+
+def _candidate_text(candidate):
+    """The text of one response candidate."""
+    content = getattr(candidate, "content", None)
+    return "".join(getattr(part, "text", None) or "" for part in getattr(content, "parts", None) or [])
+
+
+def _usage_counts(usage):
+    """Token counts from a response's usage metadata, leaving out any the response did not report."""
+    counts = {}
+    for field, name in (("prompt_token_count", "prompt_tokens"), ("candidates_token_count", "output_tokens"),
+                        ("cached_content_token_count", "cached_tokens")):
+        value = getattr(usage, field, None)
+        if isinstance(value, int):
+            counts[name] = value
+    return counts
+
+
+def build_scheduler(classifier_client):
+    """Wraps a classifier client in a BatchScheduler configured from config.py."""
+    return BatchScheduler(
+        classifier_client,
+        requests_per_minute=REQUESTS_PER_MINUTE,
+        tokens_per_minute=TOKENS_PER_MINUTE,
+        max_retries=MAX_RETRIES,
+        base_delay=RETRY_BASE_DELAY,
+        max_delay=RETRY_MAX_DELAY,
+        estimate_tokens=estimate_batch_tokens,
+    )
+
+
+class _BatchPipeline:
+    """
+    Moves input records to the model and merges the answers into `results_map`.
+
+    Records are added chunk by chunk as the input is read. Journaled excerpts are skipped, cached
+    excerpts are answered from the cache, and each distinct excerpt is sent once; its analysis is
+    copied to every duplicate. With a `near_duplicate_threshold`, excerpts that are nearly identical
+    to one seen earlier (see NearDuplicateIndex) are grouped with it in the same way, and
+    `representative_of` records which NewID each copied analysis came from. With a `local_scorer`,
+    excerpts it scores with at least `local_confidence` are answered locally instead of by the model;
+    `tier_of` records whether each excerpt was scored "local"ly or by "gemini". The remaining excerpts
+    are packed into batches and submitted to the executor, keeping at most `max_in_flight` batches
+    queued or running. All bookkeeping happens on the calling thread; only the API calls run on the
+    executor.
+
+    With a BatchPredictionJob, batches are written to the job instead and run together in `finish`;
+    excerpts without a valid result in the job's output are then sent online.
+    """
+    def __init__(self, scheduler, executor, max_in_flight, journal=None, cache=None, on_results=None,
+                 batch_job=None, question=QUESTION, label=None, metrics=None, near_duplicate_threshold=None,
+                 local_scorer=None, local_confidence=1.0, previous=None, rescore_scheduler=None,
+                 fingerprint=None):
+        self.scheduler = scheduler
+        # An incremental run: the previous output, compared with the current codebook, and the scheduler of
+        # the client that re-scores the changed emotions.
+        self.previous = previous
+        self.rescore_scheduler = rescore_scheduler
+        self.previous_analyses = {}
+        self.rescore_members_by_key = {}
+        self.rescore_key_by_representative = {}
+        self.rescored_by_key = {}
+        self._rescoring = set()
+        self.local_scorer = local_scorer
+        self.local_confidence = local_confidence
+        self.question = question
+        # Part of every cache key: the fingerprint of the client's prompt and settings.
+        self.prompt_fingerprint = fingerprint or prompt_fingerprint(question)
+        self.label = label
+        self.metrics = metrics
+        # Prefix for progress messages when several jobs share the console.
+        self.prefix = f"[{label}] " if label else ""
+        self.batch_job = batch_job
+        self.on_results = on_results
+        self.executor = executor
+        self.max_in_flight = max_in_flight
+        self.journal = journal
+        self.cache = cache
+        # NewID -> analysis, held as float32 scores and interned justifications (see score_store.py).
+        self.results_map = ScoreStore(EMOTION_CODEBOOK)
+        if journal is not None:
+            for new_id, analysis_json in journal.completed.items():
+                self.results_map.add(new_id, json.loads(analysis_json))
+        journal_tiers = journal.tiers if journal is not None else {}
+        self.tier_of = {new_id: journal_tiers.get(new_id, "gemini") for new_id in self.results_map}
+        self.members_by_key = {}
+        self.key_by_representative = {}
+        self.near_duplicates = NearDuplicateIndex(near_duplicate_threshold) if near_duplicate_threshold else None
+        self.representative_of = {}
+        self.batches_sent = 0
+        self.counts = {"excerpts": 0, "resumed": 0, "cached": 0, "duplicates": 0, "near_duplicates": 0, "local": 0,
+                       "sent": 0, "unchanged": 0, "rescored": 0}
+        self._pending = set()
+
+    def add(self, records):
+        """Queues a chunk of input records; records without text are ignored."""
+        new_records = {}
+        rescore_records = []
+        for record in records:
+            if not has_text(record):
+                continue
+            self.counts["excerpts"] += 1
+            new_id = record["NewID"]
+            if new_id in self.results_map:
+                self.counts["resumed"] += 1
+                continue
+            if self.previous is not None and self._reuse_previous(record, rescore_records):
+                continue
+            key = excerpt_cache_key(record["Text"], self.prompt_fingerprint)
+            members = self.members_by_key.get(key)
+            counter = "duplicates"
+            if members is None and self.near_duplicates is not None:
+                group_key, _ = self.near_duplicates.add(key, record["Text"])
+                if group_key != key:
+                    # Later copies of this exact text join the same group without another lookup.
+                    members = self.members_by_key[key] = self.members_by_key[group_key]
+                    counter = "near_duplicates"
+            if members is None:
+                self.members_by_key[key] = [new_id]
+                new_records[key] = record
+                continue
+            # A duplicate of an excerpt seen earlier: reuse its analysis now if it is already known,
+            # otherwise it is filled in when the representative's batch completes.
+            members.append(new_id)
+            self.representative_of[new_id] = members[0]
+            self.counts[counter] += 1
+            representative_analysis = self.results_map.analysis(members[0])
+            if representative_analysis is not None:
+                self._store([{"NewID": new_id, "analysis": representative_analysis,
+                              "tier": self.tier_of[members[0]]}])
+
+        if self.cache is not None and new_records:
+            cached = self.cache.get_many(new_records)
+            # Duplicates already queued in this chunk receive the cached analysis along with their representative.
+            self._store([
+                {"NewID": new_id, "analysis": json.loads(analysis_json)}
+                for key, analysis_json in cached.items() for new_id in self.members_by_key[key]
+            ])
+            for key in cached:
+                del new_records[key]
+            self.counts["cached"] += len(cached)
+
+        for key, record in new_records.items():
+            self.key_by_representative[record["NewID"]] = key
+        if self.local_scorer is not None and new_records:
+            self._score_locally(new_records)
+
+        payloads = []
+        for record in new_records.values():
+            payload_item = record.copy()
+            payload_item.pop("ResponseID", None)
+            payloads.append(payload_item)
+        self.counts["sent"] += len(payloads)
+        for batch in plan_batches(payloads):
+            self._submit(batch)
+        for batch in plan_batches(rescore_records):
+            self._submit(batch, rescore=True)
+
+    def _reuse_previous(self, record, rescore_records):
+        """
+        Keeps the previous run's analysis of a row whose text is unchanged, along with its Duplicate_Of value.
+        If codebook entries changed, only those emotions are re-scored: the row is added to `rescore_records`
+        unless a row with the same text already was. Rows the local scorer answered are classified again in
+        full, as that costs nothing.
+
+        Returns:
+            bool: False if the row has to be classified in full.
+        """
+        analysis, tier = self.previous.match(record["NewID"], record["Text"])
+        if analysis is None:
+            return False
+        new_id = record["NewID"]
+        if self.previous.changed_emotions and (tier == "local" or self.rescore_scheduler is None):
+            return False
+        duplicate_of = self.previous.duplicate_of(new_id)
+        if duplicate_of is not None:
+            self.representative_of[new_id] = duplicate_of
+        if not self.previous.changed_emotions:
+            self.counts["unchanged"] += 1
+            self._store([{"NewID": new_id, "analysis": analysis, "tier": tier}])
+            return True
+        self.counts["rescored"] += 1
+        self.previous_analyses[new_id] = analysis
+        key = excerpt_cache_key(record["Text"], self.prompt_fingerprint)
+        members = self.rescore_members_by_key.get(key)
+        if members is None:
+            self.rescore_members_by_key[key] = [new_id]
+            self.rescore_key_by_representative[new_id] = key
+            rescore_records.append({"NewID": new_id, "Text": record["Text"]})
+        else:
+            members.append(new_id)
+            if key in self.rescored_by_key:
+                self._merge_rescored([{"NewID": members[0], "analysis": self.rescored_by_key[key]}], [new_id])
+        return True
+
+    def _merge_rescored(self, results, new_ids=None):
+        """
+        Merges the re-scored emotions of each result into the previous analyses of every row with the same
+        text (or just `new_ids`) and stores them.
+        """
+        merged = []
+        for result in results:
+            key = self.rescore_key_by_representative.get(result.get("NewID"))
+            if key is None or not result.get("analysis"):
+                continue
+            self.rescored_by_key[key] = result["analysis"]
+            for new_id in new_ids or self.rescore_members_by_key[key]:
+                # A row is merged once; a repeated result for it is ignored.
+                previous_analysis = self.previous_analyses.pop(new_id, None)
+                if previous_analysis is None:
+                    continue
+                merged.append({"NewID": new_id, "tier": "gemini", "analysis": merge_analyses(
+                    previous_analysis, result["analysis"], self.previous.emotions)})
+        self._store(merged)
+
+    def _score_locally(self, new_records):
+        """Answers the records the local scorer is confident about and removes them from `new_records`."""
+        keys = list(new_records)
+        analyses = confident_analyses(self.local_scorer, [new_records[key]["Text"] for key in keys],
+                                      self.local_confidence)
+        results = [{"NewID": new_records.pop(keys[index])["NewID"], "analysis": analysis}
+                   for index, analysis in analyses.items()]
+        self.counts["local"] += len(results)
+        self._merge(results, tier="local")
+
+    def finish(self):
+        """Waits for every batch, retries the dead-letter queue and returns `results_map`."""
+        if self.batch_job is not None:
+            with self._metrics_batch(phase="batch_prediction", excerpts=self.counts["sent"]):
+                results, missing = self.batch_job.run()
+            self.batch_job = None
+            self._merge(results)
+            if missing:
+                print(f"🔁 {self.prefix}Sending {len(missing)} excerpt(s) without a batch prediction result online.")
+                for batch in plan_batches(missing):
+                    self._submit(batch)
+        if self._pending:
+            self._collect(ALL_COMPLETED)
+        if self.scheduler.dead_letters:
+            with self._metrics_batch(phase="dead_letter_retry"):
+                recovered = self.scheduler.retry_dead_letters()
+                set_metrics(rows_recovered=len(recovered))
+            self._merge(recovered)
+        dead_letters = list(self.scheduler.dead_letters)
+        if self.rescore_scheduler is not None and self.rescore_scheduler.dead_letters:
+            with self._metrics_batch(phase="dead_letter_retry", rescore=True):
+                recovered = self.rescore_scheduler.retry_dead_letters()
+                set_metrics(rows_recovered=len(recovered))
+            self._merge_rescored(recovered)
+            # A row whose re-scoring failed has no analysis, so the next incremental run classifies it in full.
+            dead_letters += self.rescore_scheduler.dead_letters
+        if dead_letters:
+            failed_ids = [e.get("NewID") for batch, _, _, _ in dead_letters for e in batch]
+            print(f"⚠️ {self.prefix}{len(failed_ids)} excerpt(s) could not be classified and have no Model_Response: "
+                  f"{failed_ids}")
+        return self.results_map
+
+    def _submit(self, batch, rescore=False):
+        # Re-scoring batches use a reduced prompt, so they are always sent online.
+        if self.batch_job is not None and not rescore:
+            self.batch_job.add(batch)
+            self.batches_sent += 1
+            return
+        while len(self._pending) >= self.max_in_flight:
+            self._collect(FIRST_COMPLETED)
+        self.batches_sent += 1
+        future = self.executor.submit(self._run_batch, batch, self.batches_sent, time.perf_counter(), rescore)
+        if rescore:
+            self._rescoring.add(future)
+        self._pending.add(future)
+
+    def _run_batch(self, batch, batch_num, submitted_at, rescore=False):
+        fields = {"rescore": True} if rescore else {}
+        with self._metrics_batch(batch_num=batch_num, excerpts=len(batch),
+                                 queue_wait_s=round(time.perf_counter() - submitted_at, 4), **fields):
+            print(f"--- {self.prefix}Processing Batch {batch_num}{' (re-scoring)' if rescore else ''} ---")
+            # The total is unknown while the input is still being read.
+            scheduler = self.rescore_scheduler if rescore else self.scheduler
+            results = scheduler.classify_batch(batch, batch_num, "?")
+            set_metrics(results=len(results))
+            return results
+
+    def _metrics_batch(self, **fields):
+        """The metrics record for one batch, or a no-op context without a RunMetrics."""
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.batch(job=self.label, **fields)
+
+    def _collect(self, return_when):
+        done, self._pending = wait(self._pending, return_when=return_when)
+        for future in done:
+            if future in self._rescoring:
+                self._rescoring.discard(future)
+                self._merge_rescored(future.result())
+            else:
+                self._merge(future.result())
+
+    def _merge(self, results, tier="gemini"):
+        """
+        Copies each representative's analysis to its duplicates, caches new analyses and stores them.
+        Only the model's analyses are cached, not those of the local scorer.
+        """
+        expanded = []
+        new_entries = {}
+        for result in results:
+            key = self.key_by_representative.get(result.get("NewID"))
+            if key is None or not result.get("analysis"):
+                expanded.append({**result, "tier": tier})
+                continue
+            if tier == "gemini":
+                new_entries[key] = json.dumps(result["analysis"])
+            expanded.extend({"NewID": new_id, "analysis": result["analysis"], "tier": tier}
+                            for new_id in self.members_by_key[key])
+        if self.cache is not None:
+            self.cache.put_many(new_entries)
+        self._store(expanded)
+
+    def _store(self, results):
+        _merge_results(self.results_map, results, self.journal)
+        for result in results:
+            if result.get("NewID") and result.get("analysis"):
+                self.tier_of[result["NewID"]] = result.get("tier", "gemini")
+        if self.on_results is not None:
+            self.on_results(results)
+
+
+def process_spreadsheet(file_path, classifier_client, max_concurrent_batches=MAX_CONCURRENT_BATCHES,
+                        scheduler=None, journal=None, cache=None, batch_job=None, sheet_name=SHEET_NAME,
+                        question=QUESTION, executor=None, output_name=None, label=None, metrics=None,
+                        output_dir=None, local_scorer=None, previous_output=None):
+    """
+    Streams a spreadsheet, processes texts in batches, and saves the raw model output.
+
+    The input (.xlsx, .csv or .parquet) is read in chunks of INPUT_CHUNK_SIZE rows, keeping only the
+    ResponseID, NewID and Text columns, and each chunk is batched and sent while the next one is read.
+    Up to `max_concurrent_batches` batches are sent to the API at the same time. Results are merged
+    as each batch completes; the output keeps the row order of the input sheet. Every call goes
+    through `scheduler` (by default a BatchScheduler built from config.py), which rate-limits,
+    retries transient errors and retries failed batches once more at the end of the run.
+
+    If a CheckpointJournal is given, each batch's results are journaled as soon as the batch completes,
+    and excerpts the journal already holds (from a resumed run) are not sent again.
+
+    Excerpts with identical text are sent once and the analysis is copied to every duplicate. With
+    NEAR_DUPLICATE_THRESHOLD set, so are excerpts that are nearly identical once normalized; the
+    Duplicate_Of column names the excerpt whose analysis each copy received. If a
+    ResponseCache is given, excerpts it already holds are answered from the cache and new analyses
+    are added to it.
+
+    If a BatchPredictionJob is given, every batch is collected into one batch prediction job that is
+    run after the whole input has been read, instead of being sent online.
+
+    Several spreadsheets can be processed at the same time (see `run_manifest`) by passing each one a
+    client for its `question` and a shared `executor`, so that their batches fill the same pool of
+    API calls. `output_name` (default: the sheet name) is part of the output file name, and `label`
+    prefixes the job's progress messages. The output is written to `output_dir` (default: OUTPUT_DIR).
+
+    With a `local_scorer` (see local_scorer.py), excerpts it scores with a confidence of at least
+    LOCAL_SCORER_CONFIDENCE are answered locally and only the rest are sent to the model. The
+    Scoring_Tier column records which tier scored each row.
+
+    With a RunMetrics, every batch's queue wait, latency, token usage, parse time and retries are
+    recorded, and a summary is printed at the end.
+
+    `previous_output` makes the run incremental (see incremental.py). Rows of that raw output whose NewID
+    and text are unchanged keep their analysis, and only the emotions whose codebook entries changed
+    since it was written are re-scored, with a prompt holding just those entries. New and edited rows
+    are classified as usual. Every raw output stores the fingerprints of its codebook entries and prompt
+    settings (in a Run_Fingerprints sheet, or in the Parquet metadata) for the next incremental run.
+
+    Returns:
+        str: The path of the raw output file, or None if the input could not be read.
+    """
+    run_started = time.perf_counter()
+    if scheduler is None:
+        scheduler = build_scheduler(classifier_client)
+    prefix = f"[{label}] " if label else ""
+    fingerprint, settings = client_fingerprints(classifier_client, question)
+
+    previous = rescore_scheduler = None
+    if previous_output:
+        try:
+            previous = load_previous_run(previous_output)
+        except (FileNotFoundError, ValueError, OSError) as e:
+            print(f"❌ {prefix}Error reading the previous output: {e}")
+            return
+        if not previous.compare(EMOTION_CODEBOOK, settings):
+            previous = None
+        elif previous.changed_emotions:
+            print(f"🔄 {prefix}Codebook entries changed since the previous run: {', '.join(previous.changed_emotions)}. "
+                  "Only these emotions are re-scored on unchanged rows.")
+            rescore_scheduler = scheduler.for_client(classifier_client.for_emotions(previous.changed_emotions))
+
     try:
-        df = pd.read_excel(file_path, sheet_name=SHEET_NAME)
+        reader = ExcerptReader(file_path, sheet_name=sheet_name)
     except (FileNotFoundError, ValueError) as e:
         print(f"❌ Error reading spreadsheet: {e}")
         return
 
     base_columns = ["ResponseID", "NewID", "Text"]
     all_required_columns = base_columns
-    for col in all_required_columns:
-        if col not in df.columns:
-            raise ValueError(f"Missing required column '{col}' in sheet '{SHEET_NAME}'")
+    # The output only needs the base columns, held column-wise to keep memory small.
+    output_columns = {col: [] for col in all_required_columns}
+    max_workers = max(1, max_concurrent_batches)
 
-    df_to_process = df[pd.notna(df['Text']) & (df['Text'] != "")]
-    excerpt_list = df_to_process[all_required_columns].to_dict('records')
-    
-    results_map = {}
-    total_batches = ceil(len(excerpt_list) / BATCH_SIZE)
-    print(f"Beginning processing for {len(excerpt_list)} excerpts in {total_batches} batches.")
+    now = datetime.datetime.now()
+    timestamp = now.strftime("%Y-%m-%d_%H-%M-%S")
+    output_name = output_name or sheet_name
+    output_base_path = os.path.join(output_dir or OUTPUT_DIR, f"llm_raw_output_{output_name.replace(' ', '_')}_{timestamp}")
+    fingerprints = run_fingerprints(EMOTION_CODEBOOK, settings)
 
-    for i in range(0, len(excerpt_list), BATCH_SIZE):
-        batch_records = excerpt_list[i:i + BATCH_SIZE]
-        
-        model_batch_payload = []
-        for record in batch_records:
-            payload_item = record.copy()
-            payload_item.pop("ResponseID", None)
-            model_batch_payload.append(payload_item)
-            
-        batch_num = (i // BATCH_SIZE) + 1
-        print(f"--- Processing Batch {batch_num}/{total_batches} ---")
-        
-        results = classifier_client.classify_batch(model_batch_payload, batch_num, total_batches)
+    parquet_writer = None
+    row_by_id = {}
+    written_rows = set()
+
+    def write_parquet_rows(results):
         for result in results:
-            if result.get("NewID") and result.get("analysis"):
-                results_map[result["NewID"]] = json.dumps(result["analysis"])
+            row = row_by_id.get(result.get("NewID"))
+            if row is None or row in written_rows or not result.get("analysis"):
+                continue
+            written_rows.add(row)
+            parquet_writer.write(row, output_columns["ResponseID"][row], result["NewID"],
+                                 output_columns["Text"][row], result["analysis"],
+                                 duplicate_of=pipeline.representative_of.get(result["NewID"]),
+                                 scoring_tier=pipeline.tier_of.get(result["NewID"]))
 
-    output_df = df[all_required_columns].copy()
-    output_df['Model_Response'] = output_df['NewID'].map(results_map)
+    try:
+        for col in all_required_columns:
+            if col not in reader.columns:
+                raise ValueError(f"Missing required column '{col}' in sheet '{sheet_name}'")
 
-    now = datetime.datetime.now()
-    timestamp = now.strftime("%Y-%m-%d_%H-%M-%S")
-    output_filename = f"llm_raw_output_{SHEET_NAME.replace(' ', '_')}_{timestamp}.xlsx"
-    output_file_path = os.path.join(OUTPUT_DIR, output_filename)
+        if RAW_OUTPUT_FORMAT == "parquet":
+            samples = getattr(classifier_client, "samples", 1)
+            parquet_writer = ParquetResultWriter(f"{output_base_path}.parquet", EMOTION_CODEBOOK,
+                                                 row_group_size=PARQUET_ROW_GROUP_SIZE,
+                                                 sample_stats=isinstance(samples, int) and samples > 1,
+                                                 metadata={FINGERPRINT_METADATA_KEY: json.dumps(fingerprints)})
+
+        print(f"{prefix}Beginning processing of '{file_path}' (sheet '{sheet_name}') in chunks of "
+              f"{INPUT_CHUNK_SIZE} rows ({max_workers} batches at a time).")
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            pipeline = _BatchPipeline(scheduler, executor, max_in_flight=2 * max_workers,
+                                      journal=journal, cache=cache,
+                                      on_results=write_parquet_rows if parquet_writer is not None else None,
+                                      batch_job=batch_job, question=question, label=label, metrics=metrics,
+                                      fingerprint=fingerprint, near_duplicate_threshold=NEAR_DUPLICATE_THRESHOLD,
+                                      local_scorer=local_scorer, local_confidence=LOCAL_SCORER_CONFIDENCE,
+                                      previous=previous, rescore_scheduler=rescore_scheduler)
+            for chunk in reader.iter_chunks(all_required_columns, INPUT_CHUNK_SIZE):
+                if parquet_writer is not None:
+                    first_row = len(output_columns["NewID"])
+                    row_by_id.update((record["NewID"], first_row + i) for i, record in enumerate(chunk))
+                for col in all_required_columns:
+                    output_columns[col].extend(record[col] for record in chunk)
+                pipeline.add(chunk)
+            results_map = pipeline.finish()
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+        if parquet_writer is not None:
+            # Rows resumed from the journal and rows without a result are written last.
+            for row, new_id in enumerate(output_columns["NewID"]):
+                if row not in written_rows:
+                    parquet_writer.write(row, output_columns["ResponseID"][row], new_id, output_columns["Text"][row],
+                                         results_map.analysis(new_id),
+                                         duplicate_of=pipeline.representative_of.get(new_id),
+                                         scoring_tier=pipeline.tier_of.get(new_id))
+    finally:
+        reader.close()
+        if parquet_writer is not None:
+            parquet_writer.close()
+
+    counts = pipeline.counts
+    print(f"{prefix}Processed {counts['excerpts']} excerpts: {counts['sent']} sent in {pipeline.batches_sent} batches, "
+          f"{counts['local']} scored locally, {counts['resumed']} resumed from the journal, "
+          f"{counts['cached']} from the response cache, "
+          f"{counts['duplicates']} duplicates, {counts['near_duplicates']} near-duplicates.")
+    if previous is not None:
+        print(f"{prefix}From the previous output: {counts['unchanged']} rows unchanged, {counts['rescored']} rows with "
+              f"{len(previous.changed_emotions)} emotion(s) re-scored.")
+    if metrics is not None:
+        metrics.report(job=label, rows=counts["excerpts"], elapsed=time.perf_counter() - run_started)
+
+    if parquet_writer is not None:
+        print(f"\n✅ {prefix}Raw model results saved to: {parquet_writer.path}")
+        if not EXPORT_EXCEL:
+            return parquet_writer.path
+        if len(output_columns["NewID"]) >= EXCEL_MAX_ROWS:
+            print(f"⚠️ {len(output_columns['NewID'])} rows exceed Excel's row limit; skipping the Excel export.")
+            return parquet_writer.path
+
+    import pandas as pd
+    output_df = pd.DataFrame(output_columns)
+    output_df['Duplicate_Of'] = output_df['NewID'].map(pipeline.representative_of)
+    output_df['Scoring_Tier'] = output_df['NewID'].map(pipeline.tier_of)
+    # Each analysis is turned back into JSON only here, one row at a time.
+    output_df['Model_Response'] = [results_map.get(new_id) for new_id in output_columns["NewID"]]
+
+    output_file_path = f"{output_base_path}.xlsx"
     
-    output_df.to_excel(output_file_path, sheet_name='LLM_Raw_Output', index=False)
-    print(f"\n✅ Processing complete. Raw model results saved to: {output_file_path}")
+    with pd.ExcelWriter(output_file_path) as writer:
+        output_df.to_excel(writer, sheet_name='LLM_Raw_Output', index=False)
+        pd.DataFrame(fingerprint_rows(fingerprints)).to_excel(writer, sheet_name=FINGERPRINT_SHEET, index=False)
+    print(f"\n✅ {prefix}Processing complete. Raw model results saved to: {output_file_path}")
+    return output_file_path
+
+
+def _merge_results(results_map, results, journal=None):
+    """Adds the analysis of each well-formed result to `results_map` (a ScoreStore), keyed by NewID, and journals them."""
+    if journal is not None:
+        journal.record(results)
+    for result in results:
+        if result.get("NewID") and result.get("analysis"):
+            results_map.add(result["NewID"], result["analysis"])
 
 
-def main():
+class _BatchPlan:
+    """Takes the place of a BatchPredictionJob in a dry run: tallies the planned batches instead of sending them."""
+    def __init__(self):
+        self.batches = 0
+        self.excerpts = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def add(self, excerpts_batch):
+        self.batches += 1
+        self.excerpts += len(excerpts_batch)
+        self.input_tokens += estimate_batch_tokens(excerpts_batch)
+        self.output_tokens += sum(estimate_output_tokens(estimate_tokens(json.dumps(excerpt, default=str)))
+                                  for excerpt in excerpts_batch)
+
+
+def plan_spreadsheet(file_path, sheet_name=SHEET_NAME, question=QUESTION, journal=None, cache=None,
+                     local_scorer=None, label=None):
+    """
+    Plans the run of `process_spreadsheet` without creating a client or calling the API.
+
+    The input is read and passed through the same journal, duplicate, near-duplicate, cache and local
+    scoring steps, and the excerpts left over are packed into batches. Nothing is written: pass a
+    read-only journal to account for a resumed run.
+
+    Returns:
+        dict: The excerpt counts of `process_spreadsheet`, plus the number of batches and their estimated
+              input and output tokens. None if the input could not be read.
+    """
+    try:
+        reader = ExcerptReader(file_path, sheet_name=sheet_name)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"❌ Error reading spreadsheet: {e}")
+        return None
+
+    columns = ["ResponseID", "NewID", "Text"]
+    plan = _BatchPlan()
+    pipeline = _BatchPipeline(None, None, max_in_flight=1, journal=journal, cache=cache, batch_job=plan,
+                              question=question, label=label, near_duplicate_threshold=NEAR_DUPLICATE_THRESHOLD,
+                              local_scorer=local_scorer, local_confidence=LOCAL_SCORER_CONFIDENCE)
+    try:
+        for col in columns:
+            if col not in reader.columns:
+                raise ValueError(f"Missing required column '{col}' in sheet '{sheet_name}'")
+        for chunk in reader.iter_chunks(columns, INPUT_CHUNK_SIZE):
+            pipeline.add(chunk)
+    finally:
+        reader.close()
+    return {**pipeline.counts, "batches": plan.batches, "input_tokens": plan.input_tokens,
+            "output_tokens": plan.output_tokens}
+
+
+def load_manifest(manifest_path):
+    """
+    Reads a job manifest: a JSON list of jobs, each an object with a "file" (relative to INPUT_DIR unless
+    absolute) and optionally a "sheet", "question" and "name" (default: SHEET_NAME, QUESTION and
+    "<file>_<sheet>"), and a "previous" raw output (relative to OUTPUT_DIR unless absolute) to run the
+    job incrementally against. A plain string is taken as a file name.
+
+    Returns:
+        list: One dictionary per job with "file", "sheet", "question", "previous" (or None) and a unique "name".
+
+    Raises:
+        ValueError: If the manifest is not a list of jobs or a job has no file.
+    """
+    with open(manifest_path, encoding='utf-8') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise ValueError(f"The manifest '{manifest_path}' must be a JSON list of jobs")
+
+    jobs = []
+    names = set()
+    for number, entry in enumerate(entries, start=1):
+        if isinstance(entry, str):
+            entry = {"file": entry}
+        if not isinstance(entry, dict) or not entry.get("file"):
+            raise ValueError(f"Job {number} in '{manifest_path}' has no 'file'")
+        sheet = entry.get("sheet", SHEET_NAME)
+        name = entry.get("name") or f"{os.path.splitext(os.path.basename(entry['file']))[0]}_{sheet}"
+        name = unique_name = name.replace(' ', '_')
+        suffix = 2
+        while unique_name in names:
+            unique_name = f"{name}_{suffix}"
+            suffix += 1
+        names.add(unique_name)
+        jobs.append({
+            "file": os.path.join(INPUT_DIR, entry["file"]),
+            "sheet": sheet,
+            "question": entry.get("question", QUESTION),
+            "previous": os.path.join(OUTPUT_DIR, entry["previous"]) if entry.get("previous") else None,
+            "name": unique_name,
+        })
+    return jobs
+
+
+def run_manifest(jobs, classifier_client, scheduler=None, cache=None, resume=False,
+                 max_concurrent_batches=MAX_CONCURRENT_BATCHES, max_concurrent_jobs=MAX_CONCURRENT_JOBS,
+                 batch_job_factory=None, metrics=None, local_scorer=None):
+    """
+    Processes several (file, sheet, question) jobs in one process.
+
+    All jobs share the classifier client, the rate limits of `scheduler`, the response cache and one
+    pool of `max_concurrent_batches` API workers. Up to `max_concurrent_jobs` jobs read their input
+    and plan batches at the same time, so the pool stays busy while a job is reading a file or
+    writing its output. Each job has its own checkpoint journal (`checkpoint_<name>.jsonl`), raw
+    output file, dead-letter queue and progress messages prefixed with its name.
+
+    Args:
+        jobs (list): Jobs as returned by `load_manifest`.
+        classifier_client (EmotionClassifierClient): The shared client.
+        scheduler (BatchScheduler): The shared rate limits and retry policy (default: from config.py).
+        cache (ResponseCache): An optional response cache shared by all jobs.
+        resume (bool): Resume each job from its checkpoint journal.
+        batch_job_factory (callable): With the batch backend, called as `(job_client, name)` to create
+            each job's BatchPredictionJob.
+        metrics (RunMetrics): Records per-batch metrics for every job, with a summary per job and for the run.
+        local_scorer: An optional local scorer shared by all jobs (see `process_spreadsheet`).
+
+    Returns:
+        dict: Job name -> raw output path, or None for a job that failed.
+    """
+    if scheduler is None:
+        scheduler = build_scheduler(classifier_client)
+    max_workers = max(1, max_concurrent_batches)
+
+    def run_job(job):
+        job_client = classifier_client.for_question(job["question"])
+        journal = CheckpointJournal(os.path.join(OUTPUT_DIR, f"checkpoint_{job['name']}.jsonl"), resume=resume)
+        try:
+            return process_spreadsheet(
+                job["file"], job_client, max_concurrent_batches=max_workers,
+                scheduler=scheduler.for_client(job_client), journal=journal, cache=cache,
+                batch_job=batch_job_factory(job_client, job["name"]) if batch_job_factory is not None else None,
+                sheet_name=job["sheet"], question=job["question"], executor=batch_executor,
+                output_name=job["name"], label=job["name"], metrics=metrics, local_scorer=local_scorer,
+                previous_output=job.get("previous"),
+            )
+        finally:
+            journal.close()
+
+    run_started = time.perf_counter()
+    print(f"📋 Running {len(jobs)} job(s), {max(1, max_concurrent_jobs)} at a time, "
+          f"sharing {max_workers} API workers.")
+    outputs = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as batch_executor, \
+         ThreadPoolExecutor(max_workers=max(1, max_concurrent_jobs)) as job_executor:
+        futures = {job_executor.submit(run_job, job): job["name"] for job in jobs}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                outputs[name] = future.result()
+            except Exception as e:
+                print(f"❌ [{name}] Job failed: {type(e).__name__}: {e}")
+                outputs[name] = None
+
+    print("\n📋 Job summary:")
+    for job in jobs:
+        output_path = outputs.get(job["name"])
+        status = f"✅ {output_path}" if output_path else "❌ no output"
+        print(f"  - {job['name']} ('{job['file']}', sheet '{job['sheet']}'): {status}")
+    if metrics is not None:
+        metrics.report(elapsed=time.perf_counter() - run_started)
+    return outputs
+
+
+def dry_run(jobs, cache=None, local_scorer=None, resume=False, journal_paths=None):
+    """
+    Prints the plan of every job (see `plan_spreadsheet`) and the minimum time the configured rate limits allow.
+
+    Args:
+        jobs (list): Jobs as returned by `load_manifest`.
+        journal_paths (dict): Job name -> checkpoint journal to read with `resume`
+                              (default: OUTPUT_DIR/checkpoint_<name>.jsonl).
+
+    Returns:
+        dict: Job name -> plan, or None for a job whose input could not be read.
+    """
+    journal_paths = journal_paths or {}
+    plans = {}
+    for job in jobs:
+        journal = None
+        if resume:
+            journal_path = journal_paths.get(job["name"]) or os.path.join(OUTPUT_DIR, f"checkpoint_{job['name']}.jsonl")
+            journal = CheckpointJournal(journal_path, resume=True, read_only=True)
+        plan = plans[job["name"]] = plan_spreadsheet(job["file"], sheet_name=job["sheet"], question=job["question"],
+                                                     journal=journal, cache=cache, local_scorer=local_scorer,
+                                                     label=job["name"])
+        if plan is None:
+            continue
+        print(f"🧮 [{job['name']}] {plan['excerpts']} excerpts: {plan['sent']} to send in {plan['batches']} batches "
+              f"(~{plan['input_tokens']} input and ~{plan['output_tokens']} output tokens), "
+              f"{plan['local']} to score locally, {plan['resumed']} resumed from the journal, "
+              f"{plan['cached']} from the response cache, {plan['duplicates']} duplicates, "
+              f"{plan['near_duplicates']} near-duplicates.")
+
+    planned = [plan for plan in plans.values() if plan is not None]
+    batches = sum(plan["batches"] for plan in planned)
+    input_tokens = sum(plan["input_tokens"] for plan in planned)
+    output_tokens = sum(plan["output_tokens"] for plan in planned)
+    minutes = max(batches / REQUESTS_PER_MINUTE if REQUESTS_PER_MINUTE else 0,
+                  input_tokens / TOKENS_PER_MINUTE if TOKENS_PER_MINUTE else 0)
+    print(f"\n🧮 Dry run: {batches} API calls, ~{input_tokens} input tokens "
+          f"({batches * CODEBOOK_TOKEN_ESTIMATE} of them the codebook) and ~{output_tokens} output tokens. "
+          f"The rate limits allow this in no less than {minutes:.1f} minutes. Nothing was sent.")
+    return plans
+
+
+def _make_batch_job(runner, timestamp, job_client, name):
+    """Creates the BatchPredictionJob of one input with the batch backend (see `batch_job_factory` in run_manifest)."""
+    return BatchPredictionJob(job_client, runner, OUTPUT_DIR, name=f"batch_prediction_{name}_{timestamp}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Classify emotions in a spreadsheet with Gemini and save the raw model output.")
+    parser.add_argument("--resume", action="store_true", help="Skip excerpts already recorded in the checkpoint journal of an interrupted run.")
+    parser.add_argument("--journal", type=str, default=None, help="Path to the checkpoint journal (default: output_files/checkpoint_<sheet>.jsonl).")
+    parser.add_argument("--no-cache", action="store_true", help="Classify every excerpt without reading from or writing to the response cache.")
+    parser.add_argument("--backend", choices=["online", "batch"], default=BACKEND,
+                        help="Send batches as online calls, or as one Vertex AI batch prediction job (default: %(default)s).")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="JSON list of (file, sheet, question) jobs to process together instead of the file and sheet in config.py.")
+    parser.add_argument("--incremental-from", type=str, default=None, metavar="RAW_OUTPUT",
+                        help="A previous raw output (.xlsx or .parquet) to update: only new or edited rows are classified, "
+                             "and only the emotions whose codebook entries changed are re-scored on the other rows.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Report the batches and estimated tokens of the run without creating the API client or sending anything.")
+
+    args = parser.parse_args(argv)
+    if args.incremental_from and args.manifest:
+        parser.error("--incremental-from updates a single output; give each manifest job a \"previous\" output instead.")
+
+    journal = None
+    cache = None
+    classifier_client = None
+    metrics = None
     try:
         os.makedirs(OUTPUT_DIR, exist_ok=True)
         
         now = datetime.datetime.now()
         timestamp = now.strftime("%Y-%m-%d_%H-%M-%S")
-        log_filename = f"prompt_log_{timestamp}.txt"
+        log_filename = f"prompt_log_{timestamp}.jsonl.gz"
         log_file_path = os.path.join(OUTPUT_DIR, log_filename)
 
-        classifier_client = EmotionClassifierClient(log_file_path=log_file_path)
+        jobs = load_manifest(args.manifest) if args.manifest else None
+        sheet_label = SHEET_NAME.replace(' ', '_')
+        if not args.no_cache and RESPONSE_CACHE_PATH:
+            cache = ResponseCache(RESPONSE_CACHE_PATH, max_entries=RESPONSE_CACHE_MAX_ENTRIES)
+        local_scorer = load_local_scorer(LOCAL_SCORER)
+        if args.dry_run:
+            if jobs is None:
+                jobs = [{"file": os.path.join(INPUT_DIR, SPREADSHEET_FILENAME), "sheet": SHEET_NAME,
+                         "question": QUESTION, "name": sheet_label}]
+            dry_run(jobs, cache=cache, local_scorer=local_scorer, resume=args.resume,
+                    journal_paths={sheet_label: args.journal} if args.journal and not args.manifest else None)
+            return
+
+        if WRITE_RUN_METRICS:
+            metrics = RunMetrics(os.path.join(OUTPUT_DIR, f"run_metrics_{timestamp}.jsonl"))
+        # A batch prediction job can outlive a cached context, so batch requests carry the full prompt.
+        classifier_client = EmotionClassifierClient(log_file_path=log_file_path,
+                                                    use_context_cache=USE_CONTEXT_CACHE and args.backend == "online")
+        if args.backend == "batch":
+            runner = VertexBatchRunner(classifier_client.client, GEMINI_MODEL, BATCH_PREDICTION_GCS_PREFIX,
+                                       poll_interval=BATCH_PREDICTION_POLL_INTERVAL, timeout=BATCH_PREDICTION_TIMEOUT)
+            batch_job_factory = partial(_make_batch_job, runner, timestamp)
+        else:
+            batch_job_factory = None
+
+        if jobs is not None:
+            run_manifest(jobs, classifier_client, cache=cache, resume=args.resume, batch_job_factory=batch_job_factory,
+                         metrics=metrics, local_scorer=local_scorer)
+            return
+
+        journal_path = args.journal or os.path.join(OUTPUT_DIR, f"checkpoint_{sheet_label}.jsonl")
+        journal = CheckpointJournal(journal_path, resume=args.resume)
+        batch_job = batch_job_factory(classifier_client, sheet_label) if batch_job_factory is not None else None
         file_path = os.path.join(INPUT_DIR, SPREADSHEET_FILENAME)
-        process_spreadsheet(file_path, classifier_client)
+        process_spreadsheet(file_path, classifier_client, journal=journal, cache=cache, batch_job=batch_job,
+                            metrics=metrics, local_scorer=local_scorer, previous_output=args.incremental_from)
     except Exception as e:
         print(f"\nScript terminated due to a critical error: {e}")
         traceback.print_exc()
+    finally:
+        if journal is not None:
+            journal.close()
+        if cache is not None:
+            cache.close()
+        if classifier_client is not None:
+            classifier_client.close()
+        if metrics is not None:
+            metrics.close()
 
 if __name__ == "__main__":
     main()
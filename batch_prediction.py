@@ -0,0 +1,204 @@
+# batch_prediction.py
+
+import json
+import os
+import time
+
+# Terminal states of a batch prediction job.
+_SUCCEEDED_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"}
+_FAILED_STATES = {"JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+
+class BatchPredictionError(Exception):
+    """Raised when a batch prediction job fails, is cancelled or does not finish in time."""
+
+
+class BatchPredictionJob:
+    """
+    Collects batches into one Vertex AI batch prediction job instead of sending each batch online.
+
+    Each batch is written to a JSONL request file as soon as it is added, so memory use does not grow
+    with the prompts. `run` hands the file to a runner, which produces the output JSONL, and parses
+    every response with the same decoding and validation as an online call.
+    """
+    def __init__(self, classifier_client, runner, work_dir, name=None):
+        """
+        Args:
+            classifier_client (EmotionClassifierClient): Builds the requests and parses the responses.
+            runner: A VertexBatchRunner, or any object with a `run(request_path, output_path)` method
+                    that writes one output line per request line.
+            work_dir (str): Where the request and output files are written.
+            name (str): Base name of the files (default: a timestamp).
+        """
+        self.classifier_client = classifier_client
+        self.runner = runner
+        name = name or time.strftime("batch_prediction_%Y-%m-%d_%H-%M-%S")
+        self.request_path = os.path.join(work_dir, f"{name}_requests.jsonl")
+        self.output_path = os.path.join(work_dir, f"{name}_output.jsonl")
+        self.batches = {}
+        self._request_file = None
+
+    def add(self, excerpts_batch):
+        """Appends the request for one batch to the request file."""
+        if self._request_file is None:
+            self._request_file = open(self.request_path, 'w', encoding='utf-8')
+        key = f"batch-{len(self.batches) + 1}"
+        self.batches[key] = excerpts_batch
+        request = self.classifier_client.build_batch_request(excerpts_batch)
+        # The key is also set as a request label, which the output keeps alongside the response.
+        request["labels"] = {"batch_key": key}
+        self._request_file.write(json.dumps({"key": key, "request": request}) + "\n")
+
+    def run(self):
+        """
+        Submits the request file through the runner, waits for the output and parses it.
+
+        Returns:
+            tuple: The valid results of every batch, and the excerpts that have no valid result
+                   (failed requests, malformed responses and excerpts missing from a response).
+        """
+        if self._request_file is None:
+            return [], []
+        self._request_file.close()
+        print(f"\n📦 Wrote {len(self.batches)} batch request(s) to '{self.request_path}'.")
+        self.runner.run(self.request_path, self.output_path)
+
+        results = []
+        answered = set()
+        with open(self.output_path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                key = _batch_key(entry)
+                excerpts_batch = self.batches.get(key)
+                response_texts = _response_texts(entry)
+                if excerpts_batch is None or not response_texts:
+                    if entry.get("status"):
+                        print(f"⚠️ Batch prediction request {key} failed: {entry['status']}")
+                    continue
+                try:
+                    if getattr(self.classifier_client, "samples", 1) > 1:
+                        batch_results, rejected = self.classifier_client.parse_candidate_texts(response_texts,
+                                                                                               excerpts_batch)
+                    else:
+                        batch_results, rejected = self.classifier_client.parse_response_text(response_texts[0],
+                                                                                             excerpts_batch)
+                except json.JSONDecodeError as e:
+                    print(f"⚠️ Could not decode the response to batch prediction request {key}: {e}")
+                    continue
+                if rejected:
+                    print(f"⚠️ Batch prediction request {key}: {rejected} malformed element(s).")
+                results.extend(batch_results)
+                answered.update(str(result["NewID"]) for result in batch_results)
+
+        missing = [excerpt for excerpts_batch in self.batches.values() for excerpt in excerpts_batch
+                   if str(excerpt["NewID"]) not in answered]
+        print(f"✅ Batch prediction returned {len(results)} result(s); {len(missing)} excerpt(s) without a result.")
+        return results, missing
+
+
+def _batch_key(entry):
+    labels = (entry.get("request") or {}).get("labels") or {}
+    return entry.get("key") or labels.get("batch_key")
+
+
+def _response_texts(entry):
+    """The text of each candidate of an output line; empty if the request failed."""
+    response = entry.get("response") or {}
+    return ["".join(part.get("text", "") for part in (candidate.get("content") or {}).get("parts") or [])
+            for candidate in response.get("candidates") or []]
+
+
+class VertexBatchRunner:
+    """
+    Runs a request file as a Vertex AI batch prediction job: uploads it to Cloud Storage, submits the
+    job, polls until it finishes and downloads the output files.
+
+    Requires google-cloud-storage (installed with google-cloud-aiplatform).
+    """
+    def __init__(self, genai_client, model, gcs_prefix, poll_interval=30, timeout=None,
+                 clock=time.monotonic, sleep=time.sleep):
+        """
+        Args:
+            genai_client (genai.Client): A Vertex AI client.
+            model (str): The model to run the job with.
+            gcs_prefix (str): A gs://bucket/path prefix for the job's input and output files.
+            poll_interval (float): Seconds between job status checks.
+            timeout (float): Seconds to wait for the job before giving up, or None to wait indefinitely.
+        """
+        if not gcs_prefix or not gcs_prefix.startswith("gs://"):
+            raise ValueError(f"Batch prediction needs a gs:// prefix for its files, got '{gcs_prefix}'")
+        self.client = genai_client
+        self.model = model
+        self.gcs_prefix = gcs_prefix.rstrip("/")
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._clock = clock
+        self._sleep = sleep
+
+    def run(self, request_path, output_path):
+        from google.cloud import storage
+        from google.genai import types
+
+        bucket_name, _, prefix = self.gcs_prefix[len("gs://"):].partition("/")
+        run_prefix = "/".join(filter(None, [prefix, os.path.splitext(os.path.basename(request_path))[0]]))
+        storage_client = storage.Client()
+        bucket = storage_client.bucket(bucket_name)
+        bucket.blob(f"{run_prefix}/requests.jsonl").upload_from_filename(request_path)
+
+        job = self.client.batches.create(
+            model=self.model,
+            src=f"gs://{bucket_name}/{run_prefix}/requests.jsonl",
+            config=types.CreateBatchJobConfig(dest=f"gs://{bucket_name}/{run_prefix}/output"),
+        )
+        print(f"🚀 Submitted batch prediction job '{job.name}'. Polling every {self.poll_interval}s...")
+
+        started = self._clock()
+        state = _state_name(job)
+        while state not in _SUCCEEDED_STATES | _FAILED_STATES:
+            if self.timeout is not None and self._clock() - started > self.timeout:
+                raise BatchPredictionError(f"Batch prediction job '{job.name}' did not finish within {self.timeout}s "
+                                           f"(last state {state}).")
+            self._sleep(self.poll_interval)
+            job = self.client.batches.get(name=job.name)
+            state = _state_name(job)
+        if state in _FAILED_STATES:
+            raise BatchPredictionError(f"Batch prediction job '{job.name}' ended in state {state}: {job.error}")
+        print(f"✅ Batch prediction job '{job.name}' finished ({state}).")
+
+        with open(output_path, 'wb') as out:
+            for blob in storage_client.list_blobs(bucket_name, prefix=f"{run_prefix}/output"):
+                if blob.name.endswith(".jsonl"):
+                    blob.download_to_file(out)
+                    out.write(b"\n")
+
+
+def _state_name(job):
+    state = job.state
+    return getattr(state, "name", None) or str(state)
+
+
+class LocalBatchRunner:
+    """
+    A stand-in for VertexBatchRunner that runs a request file locally, for tests and dry runs. Each
+    request is answered by `respond(request)`, which returns the response text, or raises to record
+    the request as failed.
+    """
+    def __init__(self, respond):
+        self.respond = respond
+
+    def run(self, request_path, output_path):
+        with open(request_path, encoding='utf-8') as requests, open(output_path, 'w', encoding='utf-8') as out:
+            for line in requests:
+                entry = json.loads(line)
+                try:
+                    text = self.respond(entry["request"])
+                except Exception as e:
+                    out.write(json.dumps({**entry, "status": f"{type(e).__name__}: {e}"}) + "\n")
+                    continue
+                response = {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}
+                out.write(json.dumps({**entry, "response": response}) + "\n")
@@ -0,0 +1,238 @@
+# batch_scheduler.py
+
+import copy
+import json
+import random
+import threading
+import time
+
+from run_metrics import add_metrics
+
+# HTTP status codes that indicate a transient failure worth retrying.
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RATE_LIMIT_STATUS_CODES = {429}
+
+
+def _status_code(error):
+    """Returns the HTTP status code carried by an API error, if any."""
+    for attr in ("code", "status_code"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def is_rate_limit_error(error):
+    """True if the error is a quota / rate-limit rejection (e.g. 429 RESOURCE_EXHAUSTED)."""
+    return _status_code(error) in RATE_LIMIT_STATUS_CODES or "RESOURCE_EXHAUSTED" in str(error)
+
+
+def is_retryable_error(error):
+    """True for quota errors, server errors, timeouts, dropped connections and truncated JSON responses."""
+    if is_rate_limit_error(error) or _status_code(error) in RETRYABLE_STATUS_CODES:
+        return True
+    return isinstance(error, (TimeoutError, ConnectionError, json.JSONDecodeError))
+
+
+class IncompleteResponseError(Exception):
+    """Recorded in the dead-letter queue when responses kept leaving some excerpts of a batch unanswered."""
+
+
+def _missing_excerpts(excerpts_batch, results):
+    """Returns the excerpts of a batch that have no well-formed result. IDs are compared as strings."""
+    answered = {str(result.get("NewID")) for result in results
+                if isinstance(result, dict) and result.get("analysis")}
+    return [excerpt for excerpt in excerpts_batch if str(excerpt.get("NewID")) not in answered]
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket that refills continuously at `rate_per_minute`.
+    A rate of None or 0 disables the limit.
+    """
+    def __init__(self, rate_per_minute, clock=time.monotonic, sleep=time.sleep):
+        self.capacity = rate_per_minute
+        self.rate_per_minute = rate_per_minute
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = rate_per_minute or 0
+        self._last_refill = clock()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate_per_minute):
+        """Changes the refill rate, keeping the bucket's capacity at the configured limit."""
+        with self._lock:
+            self._refill()
+            self.rate_per_minute = rate_per_minute
+
+    def acquire(self, amount=1):
+        """Blocks until `amount` tokens are available and takes them. Requests larger than the capacity are clamped."""
+        if not self.capacity:
+            return
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                wait = (amount - self._tokens) * 60.0 / self.rate_per_minute
+            self._sleep(wait)
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate_per_minute / 60.0)
+
+
+class BatchScheduler:
+    """
+    Wraps an EmotionClassifierClient with request and token rate limiting, retries with exponential
+    backoff and jitter, and a dead-letter queue of batches that failed every attempt.
+
+    The scheduler exposes the same `classify_batch` method as the client it wraps, so it can be used
+    anywhere a client is expected.
+    """
+    def __init__(self, client, requests_per_minute=None, tokens_per_minute=None, max_retries=5,
+                 base_delay=2.0, max_delay=60.0, estimate_tokens=None,
+                 clock=time.monotonic, sleep=time.sleep, rng=None):
+        """
+        Args:
+            client: Any object with a `classify_batch(excerpts_batch, batch_num, total_batches)` method
+                    that raises on failure.
+            requests_per_minute (int): Request budget per minute, or None for no limit.
+            tokens_per_minute (int): Input token budget per minute, or None for no limit.
+            max_retries (int): Retries per batch before it is moved to the dead-letter queue.
+            base_delay (float): Backoff delay in seconds before the first retry; doubles on each retry.
+            max_delay (float): Upper bound for a single backoff delay in seconds.
+            estimate_tokens (callable): Returns the estimated input tokens for a batch.
+        """
+        self.client = client
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.estimate_tokens = estimate_tokens or (lambda batch: len(json.dumps(batch, default=str)) // 4)
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_bucket = TokenBucket(requests_per_minute, clock=clock, sleep=sleep)
+        self.token_bucket = TokenBucket(tokens_per_minute, clock=clock, sleep=sleep)
+        self.dead_letters = []
+        self._sleep = sleep
+        self._rng = rng or random.Random()
+        self._lock = threading.Lock()
+        # Fraction of the configured rates currently in use; lowered on 429s and slowly restored on success.
+        # Held in a dict so that schedulers created with `for_client` share it along with the buckets.
+        self._rate_state = {"fraction": 1.0}
+        self._rate_lock = threading.Lock()
+
+    def for_client(self, client):
+        """
+        Returns a scheduler for another client that shares this scheduler's rate limits and retry
+        settings, so that several jobs can run against one quota. Each scheduler keeps its own
+        dead-letter queue.
+        """
+        scheduler = copy.copy(self)
+        scheduler.client = client
+        scheduler.dead_letters = []
+        scheduler._lock = threading.Lock()
+        return scheduler
+
+    def classify_batch(self, excerpts_batch, batch_num, total_batches):
+        """
+        Classifies a batch through the wrapped client, retrying transient errors. Excerpts missing from
+        a partial response (e.g. a truncated stream) are re-sent on their own.
+
+        Returns:
+            list: The client's results. Excerpts that could not be classified after every retry are
+                  moved to the dead-letter queue and have no result.
+        """
+        collected = []
+        pending = excerpts_batch
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                add_metrics(retries=1)
+            wait_started = time.perf_counter()
+            # A client that samples each batch several times (self-consistency) makes several requests per call.
+            requests = getattr(self.client, "requests_per_batch", 1)
+            requests = requests if isinstance(requests, int) else 1
+            self.request_bucket.acquire(requests)
+            self.token_bucket.acquire(self.estimate_tokens(pending) * requests)
+            add_metrics(rate_limit_wait_s=time.perf_counter() - wait_started)
+            try:
+                results = self.client.classify_batch(pending, batch_num, total_batches)
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    self._adjust_rate(0.5)
+                if not is_retryable_error(e) or attempt == self.max_retries:
+                    self._dead_letter(pending, batch_num, total_batches, e, attempt)
+                    return collected
+                delay = self._backoff_delay(attempt)
+                print(f"🔁 Batch {batch_num}/{total_batches}: {type(e).__name__} on attempt {attempt + 1}. "
+                      f"Retrying in {delay:.1f}s.")
+                self._sleep(delay)
+                continue
+
+            self._adjust_rate(1.05)
+            if attempt:
+                add_metrics(rows_recovered=len(results))
+            collected.extend(results)
+            pending = _missing_excerpts(pending, results)
+            if not pending:
+                return collected
+            if attempt == self.max_retries:
+                error = IncompleteResponseError(f"{len(pending)} excerpt(s) missing from the response")
+                self._dead_letter(pending, batch_num, total_batches, error, attempt)
+                return collected
+            print(f"🔁 Batch {batch_num}/{total_batches}: {len(pending)} excerpt(s) missing from the response. "
+                  "Re-sending them.")
+        return collected
+
+    def _dead_letter(self, excerpts_batch, batch_num, total_batches, error, attempt):
+        add_metrics(dead_lettered=len(excerpts_batch))
+        print(f"⚠️ Batch {batch_num}/{total_batches} failed after {attempt + 1} attempt(s) "
+              f"({type(error).__name__}: {error}). Queued for a retry at the end of the run.")
+        with self._lock:
+            self.dead_letters.append((excerpts_batch, batch_num, total_batches, error))
+
+    def retry_dead_letters(self):
+        """
+        Retries every dead-lettered batch once more with the full retry policy.
+
+        Returns:
+            list: The combined results of the batches that succeeded. Batches that fail again stay
+                  in `self.dead_letters`.
+        """
+        with self._lock:
+            pending, self.dead_letters = self.dead_letters, []
+        if not pending:
+            return []
+
+        print(f"\n🔁 Retrying {len(pending)} failed batch(es) from the dead-letter queue...")
+        recovered = []
+        for excerpts_batch, batch_num, total_batches, _ in pending:
+            recovered.extend(self.classify_batch(excerpts_batch, batch_num, total_batches))
+        return recovered
+
+    def take_dead_letters(self):
+        """Removes and returns the dead-lettered batches, for callers that report failures instead of retrying them."""
+        with self._lock:
+            taken, self.dead_letters = self.dead_letters, []
+        return taken
+
+    def _backoff_delay(self, attempt):
+        """Exponential backoff with equal jitter: half the delay is fixed, the other half random."""
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return delay / 2 + self._rng.uniform(0, delay / 2)
+
+    def _adjust_rate(self, factor):
+        """Scales the effective request and token rates, staying between 10% and 100% of the configured limits."""
+        with self._rate_lock:
+            fraction = min(1.0, max(0.1, self._rate_state["fraction"] * factor))
+            if fraction == self._rate_state["fraction"]:
+                return
+            self._rate_state["fraction"] = fraction
+        if self.requests_per_minute:
+            self.request_bucket.set_rate(self.requests_per_minute * fraction)
+        if self.tokens_per_minute:
+            self.token_bucket.set_rate(self.tokens_per_minute * fraction)
@@ -0,0 +1,216 @@
+# benchmark_analyzer.py
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+import ai_emotion_analyzer
+from ai_emotion_analyzer import EmotionClassifierClient, estimate_batch_tokens, process_spreadsheet
+from batch_scheduler import BatchScheduler
+from checkpoint_journal import CheckpointJournal
+from config import SHEET_NAME, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE, MAX_CONCURRENT_BATCHES, MAX_RETRIES
+from fake_genai import FakeGenAIClient
+from result_processor import process_results
+from run_metrics import RunMetrics
+
+WORDS = ("care arrangements are fine but the school changes every term and my child is anxious about it "
+         "we are grateful for the support although the waiting list was long and frustrating honestly "
+         "nothing has changed since last year so I feel the same as before").split()
+
+# Result fields compared against a baseline run; a drop of more than the tolerance is a regression.
+THROUGHPUT_FIELDS = ["analyze_rows_per_s", "process_rows_per_s"]
+# Options passed on to the process that runs each size.
+RUN_OPTIONS = ["input_format", "raw_format", "concurrency", "latency", "latency_sigma", "chunk_size", "error_rate",
+               "truncation_rate", "requests_per_minute", "tokens_per_minute", "log_verbosity", "threshold", "seed"]
+
+
+def make_input_sheet(path, num_rows, seed=0):
+    """Writes a synthetic input file (.xlsx, .csv or .parquet) with excerpts of varied length."""
+    rng = random.Random(seed)
+    df = pd.DataFrame({
+        "ResponseID": range(num_rows),
+        "NewID": [f"{i}_1" for i in range(num_rows)],
+        # The row number keeps every excerpt unique, so none are skipped as duplicates.
+        "Text": [f"{i}: " + " ".join(rng.choices(WORDS, k=rng.randint(5, 80))) for i in range(num_rows)],
+    })
+    if path.endswith(".csv"):
+        df.to_csv(path, index=False)
+    elif path.endswith(".parquet"):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_excel(path, sheet_name=SHEET_NAME, index=False)
+
+
+def peak_rss_mb():
+    """The peak resident set size of this process so far, in MB, or None if it cannot be measured."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_benchmark(num_rows, work_dir, args):
+    """
+    Runs the analyzer and the result processor end to end on a synthetic sheet against a FakeGenAIClient.
+
+    Returns:
+        dict: Rows/sec of each step, API calls, simulated errors and truncations, retries, batch latency
+              percentiles and peak RSS.
+    """
+    input_path = os.path.join(work_dir, f"benchmark_input.{args.input_format}")
+    make_input_sheet(input_path, num_rows, seed=args.seed)
+    fake = FakeGenAIClient(latency=args.latency, latency_sigma=args.latency_sigma, chunk_size=args.chunk_size,
+                           error_rate=args.error_rate, truncation_rate=args.truncation_rate, seed=args.seed)
+    client = EmotionClassifierClient(os.path.join(work_dir, "prompt_log.jsonl.gz"), use_context_cache=False,
+                                     log_verbosity=args.log_verbosity, genai_client=fake)
+    scheduler = BatchScheduler(client, requests_per_minute=args.requests_per_minute,
+                               tokens_per_minute=args.tokens_per_minute, max_retries=MAX_RETRIES,
+                               base_delay=0.01, max_delay=0.1, estimate_tokens=estimate_batch_tokens)
+    journal = CheckpointJournal(os.path.join(work_dir, "checkpoint.jsonl"))
+    metrics = RunMetrics()
+    rss_before = peak_rss_mb()
+
+    # Progress messages for every batch would dominate the timings of large runs.
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+            patch.object(ai_emotion_analyzer, "RAW_OUTPUT_FORMAT", args.raw_format):
+        try:
+            start = time.perf_counter()
+            raw_output = process_spreadsheet(input_path, client, max_concurrent_batches=args.concurrency,
+                                             scheduler=scheduler, journal=journal, metrics=metrics,
+                                             output_dir=work_dir)
+            analyze_time = time.perf_counter() - start
+        finally:
+            journal.close()
+            client.close()
+        rss_after_analyze = peak_rss_mb()
+
+        start = time.perf_counter()
+        process_results(raw_output, args.threshold)
+        process_time = time.perf_counter() - start
+
+    summary = metrics.summary(rows=num_rows, elapsed=analyze_time)
+    return {
+        "rows": num_rows,
+        "analyze_s": round(analyze_time, 3),
+        "analyze_rows_per_s": round(num_rows / analyze_time, 1),
+        "process_s": round(process_time, 3),
+        "process_rows_per_s": round(num_rows / process_time, 1),
+        "api_calls": fake.calls,
+        "simulated_errors": fake.errors,
+        "simulated_truncations": fake.truncations,
+        "retries": summary["retries"],
+        "latency_p50_s": summary["latency_p50_s"],
+        "latency_p95_s": summary["latency_p95_s"],
+        "peak_rss_before_mb": rss_before,
+        "peak_rss_analyze_mb": rss_after_analyze,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_in_subprocess(num_rows, argv):
+    """Runs one size in a fresh interpreter, so each size's peak RSS is measured on its own."""
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--single", str(num_rows), *argv],
+                               capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Benchmark of {num_rows} rows failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def find_regressions(results, baseline, tolerance):
+    """Lists the throughput figures that fell more than `tolerance` below the baseline of the same size."""
+    baseline_by_rows = {entry["rows"]: entry for entry in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline_by_rows.get(result["rows"])
+        if previous is None:
+            continue
+        for field in THROUGHPUT_FIELDS:
+            if previous.get(field) and result[field] < previous[field] * (1 - tolerance):
+                regressions.append(f"{result['rows']} rows: {field} {result[field]} < baseline {previous[field]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the analyzer and result processor offline against a simulated Gemini backend.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000, 100_000],
+                        help="Sheet sizes to benchmark (e.g. 1000 10000 100000 1000000). Each runs in its own process.")
+    parser.add_argument("--input-format", choices=["csv", "xlsx", "parquet"], default="csv", help="Format of the synthetic input sheet.")
+    parser.add_argument("--raw-format", choices=["xlsx", "parquet"], default="xlsx", help="RAW_OUTPUT_FORMAT for the run.")
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENT_BATCHES, help="Batches sent at the same time.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Median simulated seconds per API call.")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Spread of the log-normal latency distribution.")
+    parser.add_argument("--chunk-size", type=int, default=256, help="Characters per streamed response chunk.")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="Fraction of calls that fail with a 429 or 503.")
+    parser.add_argument("--truncation-rate", type=float, default=0.02, help="Fraction of responses cut off partway.")
+    parser.add_argument("--requests-per-minute", type=int, default=None,
+                        help=f"Request budget per minute (default: no limit; config.py uses {REQUESTS_PER_MINUTE}).")
+    parser.add_argument("--tokens-per-minute", type=int, default=None,
+                        help=f"Input token budget per minute (default: no limit; config.py uses {TOKENS_PER_MINUTE}).")
+    parser.add_argument("--log-verbosity", default="batches", help="LOG_VERBOSITY for the run.")
+    parser.add_argument("--threshold", type=float, default=0.6, help="Threshold for the result processor.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", type=str, default=None, help="A previous --output file to check for regressions.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed throughput drop against the baseline.")
+    parser.add_argument("--single", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        work_dir = tempfile.mkdtemp(prefix="emotion_benchmark_")
+        try:
+            print(json.dumps(run_benchmark(args.single, work_dir, args)))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return
+
+    passthrough = []
+    for name in RUN_OPTIONS:
+        value = getattr(args, name)
+        if value is not None:
+            passthrough += [f"--{name.replace('_', '-')}", str(value)]
+
+    results = []
+    for num_rows in args.rows:
+        print(f"Benchmarking {num_rows} rows...")
+        result = run_in_subprocess(num_rows, passthrough)
+        results.append(result)
+        print(f"  Analyze: {result['analyze_rows_per_s']} rows/sec ({result['analyze_s']}s, {result['api_calls']} API calls, "
+              f"{result['simulated_errors']} errors and {result['simulated_truncations']} truncations simulated, "
+              f"{result['retries']} retries)")
+        print(f"  Process: {result['process_rows_per_s']} rows/sec ({result['process_s']}s)")
+        print(f"  Peak RSS: {result['peak_rss_analyze_mb']} MB after analyzing, {result['peak_rss_mb']} MB overall")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"📝 Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        if regressions:
+            print("❌ Throughput regressions against the baseline:")
+            for regression in regressions:
+                print(f"  - {regression}")
+            sys.exit(1)
+        print("✅ No throughput regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
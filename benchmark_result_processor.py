@@ -0,0 +1,63 @@
+# benchmark_result_processor.py
+
+import argparse
+import json
+import random
+import time
+
+import pandas as pd
+
+from config import EMOTION_CODEBOOK
+from result_processor import build_analysis_frames, build_analysis_frames_rowwise, parse_model_responses
+
+
+def make_raw_output(num_rows, seed=0):
+    """Builds a synthetic LLM_Raw_Output sheet with a full analysis for every row."""
+    rng = random.Random(seed)
+    emotions = list(EMOTION_CODEBOOK.keys())
+    rows = []
+    for i in range(num_rows):
+        analysis = {
+            emotion: {"score": round(rng.random(), 2), "justification": f"Justification for {emotion} in row {i}."}
+            for emotion in emotions
+        }
+        rows.append({
+            "ResponseID": i,
+            "NewID": f"{i}_1",
+            "Text": f"Excerpt number {i}.",
+            "Model_Response": json.dumps(analysis),
+        })
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the row-by-row and vectorized result processors.")
+    parser.add_argument("--rows", type=int, default=100_000, help="Number of synthetic rows.")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.5, 0.6, 0.7],
+                        help="Thresholds to classify at; the vectorized path parses the responses only once.")
+    args = parser.parse_args()
+
+    df = make_raw_output(args.rows)
+    print(f"Benchmarking {args.rows} rows at thresholds {args.thresholds}.")
+
+    start = time.perf_counter()
+    rowwise = [build_analysis_frames_rowwise(df, threshold) for threshold in args.thresholds]
+    rowwise_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    parsed = parse_model_responses(df)
+    parse_time = time.perf_counter() - start
+    vectorized = [build_analysis_frames(parsed, threshold) for threshold in args.thresholds]
+    vectorized_time = time.perf_counter() - start
+
+    for (detailed, summary), (expected_detailed, expected_summary) in zip(vectorized, rowwise):
+        pd.testing.assert_frame_equal(detailed, expected_detailed)
+        pd.testing.assert_frame_equal(summary, expected_summary)
+
+    print(f"Row-by-row: {rowwise_time:.2f}s")
+    print(f"Vectorized: {vectorized_time:.2f}s (of which {parse_time:.2f}s parsing JSON)")
+    print(f"✅ Outputs are identical. Speedup: {rowwise_time / vectorized_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
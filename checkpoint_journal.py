@@ -0,0 +1,85 @@
+# checkpoint_journal.py
+
+import json
+import os
+import threading
+
+
+class CheckpointJournal:
+    """
+    An append-only JSONL journal of completed results, one line per excerpt keyed by NewID.
+
+    Each batch's results are flushed to disk as soon as the batch completes, so an interrupted run
+    can be resumed without paying again for excerpts that were already classified. A result's
+    scoring "tier" is journaled with it when present.
+    """
+    def __init__(self, path, resume=False, read_only=False):
+        """
+        Args:
+            path (str): Location of the journal file.
+            resume (bool): If True, previously journaled results are loaded and new results are appended.
+                           If False, any existing journal at `path` is replaced.
+            read_only (bool): Only load the journal (with `resume`); `record` does nothing and the file is
+                              left untouched. Used by dry runs.
+        """
+        self.path = path
+        self.tiers = {}
+        self.completed = self._load() if resume else {}
+        self._file = None
+        self._lock = threading.Lock()
+        if read_only:
+            return
+        if not resume and os.path.exists(path):
+            print(f"⚠️ Starting a new checkpoint journal; the previous one at '{path}' will be overwritten.")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        needs_newline = resume and self._ends_with_partial_line()
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        if needs_newline:
+            # Terminate a torn final line so new entries start on a line of their own.
+            self._file.write('\n')
+
+    def _ends_with_partial_line(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return False
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b'\n'
+
+    def _load(self):
+        """Reads the journal into a NewID -> analysis JSON mapping. A torn final line from a crash is ignored."""
+        completed = {}
+        if not os.path.exists(self.path):
+            return completed
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, start=1):
+                try:
+                    entry = json.loads(line)
+                    completed[entry["NewID"]] = json.dumps(entry["analysis"])
+                    if "tier" in entry:
+                        self.tiers[entry["NewID"]] = entry["tier"]
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    print(f"⚠️ Skipping unreadable checkpoint line {line_number} in '{self.path}'.")
+        print(f"♻️ Loaded {len(completed)} completed excerpts from checkpoint journal '{self.path}'.")
+        return completed
+
+    def record(self, results):
+        """Appends well-formed results (with NewID and analysis) and forces them to disk."""
+        lines = [
+            json.dumps({"NewID": result["NewID"], "analysis": result["analysis"],
+                        **({"tier": result["tier"]} if "tier" in result else {})}, default=str) + '\n'
+            for result in results
+            if result.get("NewID") and result.get("analysis")
+        ]
+        if not lines or self._file is None:
+            return
+        with self._lock:
+            self._file.writelines(lines)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
@@ -1,12 +1,20 @@
 import os
-from dotenv import load_dotenv
-
-load_dotenv() # Load environment variables from .env file
 
 # Project Configuration
-PROJECT_ID = os.getenv("PROJECT_ID")
-LOCATION = os.getenv("LOCATION")
-GEMINI_MODEL = os.getenv("GEMINI_MODEL")
+# PROJECT_ID, LOCATION, GEMINI_MODEL and BATCH_PREDICTION_GCS_PREFIX are read from the environment. The .env
+# file is only loaded when one of them is first used, so scripts that never touch them (such as
+# result_processor.py) start without reading it.
+_ENV_SETTINGS = ("PROJECT_ID", "LOCATION", "GEMINI_MODEL", "BATCH_PREDICTION_GCS_PREFIX")
+
+
+def __getattr__(name):
+    if name not in _ENV_SETTINGS:
+        raise AttributeError(f"module 'config' has no attribute '{name}'")
+    from dotenv import load_dotenv
+    load_dotenv() # Load environment variables from .env file
+    values = {setting: os.getenv(setting) for setting in _ENV_SETTINGS}
+    globals().update(values)
+    return values[name]
 
 # Directory Setup
 INPUT_DIR = "input_files"
@@ -18,8 +26,143 @@ SPREADSHEET_FILENAME = "Full Data Uncoded.xlsx" # The name of your input spreads
 QUESTION = "Are you satisfied with the current care arrangements? Please explain your response"
 # The name of the sheet within the spreadsheet to process.
 SHEET_NAME = "Validation Set" # Modify as needed (e.g., "Concerns", "Challenges")
-# Number of text excerpts to process in a single API call.
-BATCH_SIZE = 5
+# Batches are packed to fill a token budget rather than a fixed number of excerpts, so short answers
+# share a call and long answers never overflow the model's output limit.
+# Maximum estimated input tokens of the excerpts in a single API call (the codebook is not counted).
+BATCH_TOKEN_BUDGET = 4000
+# Expected response size per excerpt (scores plus justifications for every emotion), in tokens.
+OUTPUT_TOKENS_PER_EXCERPT = 350
+# Maximum number of text excerpts to process in a single API call.
+BATCH_SIZE = 20
+# Pack excerpts shortest-first so that similar-size excerpts are batched together.
+SORT_BATCHES_BY_LENGTH = True
+# Rows read from the input file at a time. The input is streamed, so memory use stays flat and the
+# first batches are sent while the rest of the file is still being read.
+INPUT_CHUNK_SIZE = 5000
+# Maximum number of batches sent to the API at the same time. Set to 1 to process batches one after another.
+MAX_CONCURRENT_BATCHES = 4
+# With --manifest, the number of jobs (file, sheet and question) read and batched at the same time. All jobs
+# share the MAX_CONCURRENT_BATCHES API workers.
+MAX_CONCURRENT_JOBS = 2
+
+# Run Metrics
+# Write one JSON line per batch (queue wait, time to first chunk, latency, token usage, parse time, retries)
+# to output_files/run_metrics_<timestamp>.jsonl and print a latency and throughput summary at the end.
+WRITE_RUN_METRICS = True
+
+# Prompt Log
+# How much of each run is written to output_files/prompt_log_<timestamp>.jsonl.gz: "off", "errors" (failed
+# API calls only), "batches" (every batch's excerpts and response) or "debug" (as "batches", and every entry
+# is also printed to the console). The codebook and instructions are logged once per file, not per batch.
+LOG_VERBOSITY = "batches"
+# The log is gzip-compressed and rotated to a new file after this many bytes of uncompressed log text.
+LOG_MAX_BYTES = 100 * 1024 * 1024
+
+# Near-Duplicate Grouping
+# Identical excerpts are always sent once. Excerpts that are nearly identical once normalized (case, accents,
+# punctuation and whitespace ignored) are grouped too when the estimated Jaccard similarity of their character
+# shingles (MinHash/LSH) reaches this threshold: only the first excerpt of a group is sent, its analysis is
+# copied to the rest, and the raw output's Duplicate_Of column records where each copy came from.
+# Lower values save more API calls but group answers that differ more; 0.9 is a reasonable starting point.
+# None (the default) groups identical texts only.
+NEAR_DUPLICATE_THRESHOLD = None
+
+# Local Scoring Tier
+# A fast local scorer answers the excerpts it is confident about without an API call; only the rest are
+# sent to Gemini. None (the default) sends every excerpt to Gemini. "lexicon" uses the codebook's language
+# clues and examples and only handles codebook examples and answers without emotional content (e.g. "Yes",
+# "N/A"); its confidences are fixed estimates, not calibrated against the model. Or give the path of a model
+# trained on previous runs' scores with
+# `python local_scorer.py output_files/llm_raw_output_*.xlsx --out cache/local_scorer.npz`.
+LOCAL_SCORER = None
+# Minimum confidence (0-1) for an excerpt to be scored locally. The Scoring_Tier column records the tier of each row.
+LOCAL_SCORER_CONFIDENCE = 0.9
+
+# Service Mode
+# `python emotion_service.py` keeps one client, response cache and API connection pool open and classifies
+# excerpts posted to http://SERVICE_HOST:SERVICE_PORT/classify. Excerpts posted at about the same time are
+# answered by one API call: a batch is sent once it is full or SERVICE_BATCH_WINDOW seconds after its first excerpt.
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8080
+SERVICE_BATCH_WINDOW = 0.05
+# Seconds a request waits for its excerpts before they are reported as failed.
+SERVICE_REQUEST_TIMEOUT = 300
+
+# Self-Consistency
+# Samples taken of every batch. With more than one, each emotion's score in Model_Response is the mean of the
+# samples, stored with the "variance" and "agreement" of the samples (see --max-variance in result_processor.py).
+# 1 takes a single sample, as before.
+SELF_CONSISTENCY_SAMPLES = 1
+# "parallel" sends the samples as concurrent calls and can stop early; "candidates" asks for all of them in one
+# request (candidate_count) where the model supports it. The batch backend always uses candidates.
+SELF_CONSISTENCY_MODE = "parallel"
+# In "parallel" mode, the first SELF_CONSISTENCY_MIN_SAMPLES samples are taken together, and the rest are skipped
+# if every emotion's scores across them lie within SELF_CONSISTENCY_EARLY_STOP_SPREAD of each other.
+SELF_CONSISTENCY_MIN_SAMPLES = 2
+SELF_CONSISTENCY_EARLY_STOP_SPREAD = 0.1
+# The agreement rate is the share of samples on the majority side of this score.
+SELF_CONSISTENCY_THRESHOLD = 0.5
+
+# Rate Limiting and Retries
+# Request and input-token budgets per minute for the Gemini API (None disables the limit).
+REQUESTS_PER_MINUTE = 120
+TOKENS_PER_MINUTE = 1_000_000
+# How many times a failed batch is retried (quota errors, timeouts, dropped streams) before it is
+# set aside and retried once more at the end of the run.
+MAX_RETRIES = 5
+# Exponential backoff between retries, in seconds.
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 60.0
+
+# Response Cache
+# Analyses are cached per excerpt, keyed on the excerpt text, QUESTION, EMOTION_CODEBOOK, GEMINI_MODEL
+# and the generation settings, so reruns only pay for excerpts whose prompt actually changed.
+# Set RESPONSE_CACHE_PATH to None to disable the cache.
+RESPONSE_CACHE_PATH = os.path.join("cache", "response_cache.sqlite")
+# Least recently used excerpts are evicted beyond this many entries (None for no limit).
+RESPONSE_CACHE_MAX_ENTRIES = 1_000_000
+
+# Context Caching
+# Upload the system instruction and codebook once as a Vertex AI cached context instead of sending them
+# with every batch. Cached input tokens are billed at a reduced rate. Requires a model that supports
+# context caching; the analyzer falls back to full prompts if the cache cannot be created.
+USE_CONTEXT_CACHE = False
+# How long the cached context is kept alive (it is deleted at the end of the run).
+CONTEXT_CACHE_TTL = "3600s"
+
+# Backend
+# "online" sends each batch as a streaming API call as soon as it is planned. "batch" collects every batch
+# into one Vertex AI batch prediction job, which has higher total throughput and discounted pricing but
+# can take hours to complete. Use it for large runs that are not latency-sensitive.
+BACKEND = "online"
+# BATCH_PREDICTION_GCS_PREFIX (from .env, see Project Configuration): the Cloud Storage prefix (gs://bucket/path)
+# for the batch prediction input and output files.
+# Seconds between status checks of a batch prediction job, and the longest to wait for it (None: no limit).
+BATCH_PREDICTION_POLL_INTERVAL = 60
+BATCH_PREDICTION_TIMEOUT = 24 * 60 * 60
+
+# Output Format
+# Set to True to constrain the model's output with a JSON schema built from the EMOTION_CODEBOOK keys.
+# Either way, every returned item is validated on its own, so one malformed item no longer fails the whole batch.
+USE_RESPONSE_SCHEMA = False
+# Ask only for scores, without justifications. Cuts output tokens and latency substantially when the
+# justifications are not needed; the Detailed_Analysis justification columns will read "N/A".
+SCORES_ONLY = False
+
+# Raw Output
+# "xlsx" writes the raw results as one Excel sheet with a JSON Model_Response column at the end of the run.
+# "parquet" writes them to a Parquet file as batches complete, with a float32 score column and a
+# justification column per emotion (requires pyarrow). Use Parquet for very large sheets.
+RAW_OUTPUT_FORMAT = "xlsx"
+# With Parquet output, also export the usual Excel workbook at the end of the run.
+EXPORT_EXCEL = False
+# Rows per Parquet row group.
+PARQUET_ROW_GROUP_SIZE = 10_000
+
+# Results Processing
+# Column with human-coded labels (comma-separated emotions, e.g. "anger, sadness", or "neutral") that the
+# threshold sweep in result_processor.py scores against. It is read from --labels-file or the raw output.
+LABEL_COLUMN = "Human_Label"
 
 # Data Extraction Targets (modify as needed)
 EMOTION_CODEBOOK = {
@@ -0,0 +1,333 @@
+# emotion_service.py
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import (
+    QUESTION,
+    OUTPUT_DIR,
+    BATCH_SIZE,
+    MAX_CONCURRENT_BATCHES,
+    RESPONSE_CACHE_PATH,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    LOCAL_SCORER,
+    LOCAL_SCORER_CONFIDENCE,
+    SERVICE_HOST,
+    SERVICE_PORT,
+    SERVICE_BATCH_WINDOW,
+    SERVICE_REQUEST_TIMEOUT,
+)
+from ai_emotion_analyzer import (EmotionClassifierClient, build_scheduler, client_fingerprints, excerpt_cache_key,
+                                 plan_batches)
+from local_scorer import confident_analyses, load_local_scorer
+from response_cache import ResponseCache
+from run_metrics import RunMetrics, set_metrics
+
+# Batch metrics records kept in memory for the /health latency percentiles.
+_METRICS_WINDOW = 1000
+
+
+class ClassificationError(Exception):
+    """Raised for an excerpt the model did not return a valid analysis for after every retry."""
+
+
+class MicroBatcher:
+    """
+    Classifies excerpts for concurrent callers, coalescing excerpts that arrive at about the same time
+    into shared `classify_batch` calls.
+
+    `classify` answers each excerpt from the response cache or the local scorer when it can and queues
+    the rest. A collector thread takes the first queued excerpt, waits up to `window` seconds for more
+    (or until `max_batch_size` are queued), packs them with `plan_batches` and sends the batches
+    through the scheduler on a pool of `max_concurrent_batches` workers. An excerpt that is already
+    queued or in flight for another request is not queued again; both requests wait for the same answer.
+    Analyses from the model are written to the cache, so every request shares what earlier ones paid for.
+    """
+    def __init__(self, scheduler, cache=None, local_scorer=None, local_confidence=1.0, question=QUESTION,
+                 window=SERVICE_BATCH_WINDOW, max_batch_size=BATCH_SIZE,
+                 max_concurrent_batches=MAX_CONCURRENT_BATCHES, metrics=None):
+        """
+        Args:
+            scheduler: A BatchScheduler (or any object with `classify_batch` and `take_dead_letters`).
+            cache (ResponseCache): Shared response cache, or None.
+            local_scorer: A local scorer (see local_scorer.py), or None to send every excerpt to the model.
+            local_confidence (float): Minimum confidence for an excerpt to be scored locally.
+            question (str): The question the excerpts answer.
+            window (float): Seconds to wait for more excerpts after the first one of a batch arrives.
+            max_batch_size (int): Excerpts that close a batch without waiting for the rest of the window.
+            max_concurrent_batches (int): Batches sent to the API at the same time.
+            metrics (RunMetrics): Receives a record per batch (default: an in-memory RunMetrics of the latest batches).
+        """
+        self.scheduler = scheduler
+        self.cache = cache
+        self.local_scorer = local_scorer
+        self.local_confidence = local_confidence
+        self.question = question
+        # Cache keys fingerprint the prompt and settings of the client behind the scheduler.
+        self.prompt_fingerprint = client_fingerprints(getattr(scheduler, "client", None), question)[0]
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.metrics = metrics or RunMetrics(max_records=_METRICS_WINDOW)
+        self.started_at = time.time()
+        self.counts = {"requests": 0, "excerpts": 0, "cached": 0, "local": 0, "coalesced": 0, "sent": 0,
+                       "failed": 0}
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._queue = queue.Queue()
+        self._ids = itertools.count(1)
+        self._batch_numbers = itertools.count(1)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_batches)
+        self._collector = threading.Thread(target=self._collect, name="micro-batcher", daemon=True)
+        self._collector.start()
+
+    def classify(self, texts, timeout=SERVICE_REQUEST_TIMEOUT):
+        """
+        Classifies excerpts, blocking until every one has an answer or failed.
+
+        Args:
+            texts (list): The excerpt texts.
+            timeout (float): Seconds to wait for the model before the remaining excerpts are reported as failed.
+
+        Returns:
+            list: One dictionary per text: {"analysis": ..., "source": "cache", "local" or "gemini"}, or
+                  {"error": ...} if it could not be classified.
+        """
+        answers = {}
+        text_keys = [excerpt_cache_key(text, self.prompt_fingerprint) if text else None for text in texts]
+        keys = {key: text for key, text in zip(text_keys, texts) if key is not None}
+        self._count(requests=1, excerpts=len(texts))
+
+        if self.cache is not None and keys:
+            for key, analysis_json in self.cache.get_many(keys).items():
+                answers[key] = {"analysis": json.loads(analysis_json), "source": "cache"}
+            self._count(cached=len(answers))
+        remaining = [key for key in keys if key not in answers]
+
+        if self.local_scorer is not None and remaining:
+            analyses = confident_analyses(self.local_scorer, [keys[key] for key in remaining], self.local_confidence)
+            for index, analysis in analyses.items():
+                answers[remaining[index]] = {"analysis": analysis, "source": "local"}
+            self._count(local=len(analyses))
+            remaining = [key for key in remaining if key not in answers]
+
+        futures = {}
+        with self._lock:
+            for key in remaining:
+                future = self._in_flight.get(key)
+                if future is None:
+                    future = self._in_flight[key] = Future()
+                    self._queue.put((key, keys[key], future))
+                else:
+                    self.counts["coalesced"] += 1
+                futures[key] = future
+
+        deadline = time.monotonic() + timeout
+        for key, future in futures.items():
+            try:
+                answers[key] = {"analysis": future.result(timeout=max(0.0, deadline - time.monotonic())),
+                                "source": "gemini"}
+            # Before Python 3.11, Future.result raises concurrent.futures.TimeoutError, not the builtin.
+            except FutureTimeoutError:
+                answers[key] = {"error": f"No answer from the model within {timeout}s."}
+            except Exception as e:
+                answers[key] = {"error": f"{type(e).__name__}: {e}"}
+
+        return [answers[key] if key is not None else {"error": "The excerpt is empty."} for key in text_keys]
+
+    def health(self):
+        """The service's counters, queue state and a summary of its latest batches."""
+        summary = self.metrics.summary()
+        with self._lock:
+            counts = dict(self.counts)
+            in_flight = len(self._in_flight)
+        return {
+            "status": "ok",
+            "uptime_s": round(time.time() - self.started_at, 1),
+            "queued": self._queue.qsize(),
+            "in_flight": in_flight,
+            "cache_entries": len(self.cache) if self.cache is not None else None,
+            **counts,
+            "batches": {name: value for name, value in summary.items()
+                        if name not in ("event", "job", "rows", "elapsed_s", "rows_per_s")},
+        }
+
+    def close(self):
+        """Sends the excerpts still queued, waits for every batch and stops the worker threads."""
+        self._queue.put(None)
+        self._collector.join()
+        self._executor.shutdown(wait=True)
+
+    def _count(self, **values):
+        with self._lock:
+            for name, value in values.items():
+                self.counts[name] += value
+
+    def _collect(self):
+        """Runs on the collector thread: gathers queued excerpts into batches and hands them to the workers."""
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                return
+            items = [item]
+            deadline = time.monotonic() + self.window
+            while len(items) < self.max_batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                items.append(item)
+            self._dispatch(items)
+
+    def _dispatch(self, items):
+        excerpts = []
+        pending = {}
+        for key, text, future in items:
+            new_id = f"s{next(self._ids)}"
+            excerpts.append({"NewID": new_id, "Text": text})
+            pending[new_id] = (key, future)
+        self._count(sent=len(excerpts))
+        for batch in plan_batches(excerpts):
+            self._executor.submit(self._run_batch, batch, pending, time.perf_counter())
+
+    def _run_batch(self, batch, pending, submitted_at):
+        batch_num = next(self._batch_numbers)
+        results = []
+        error = None
+        try:
+            with self.metrics.batch(batch_num=batch_num, excerpts=len(batch),
+                                    queue_wait_s=round(time.perf_counter() - submitted_at, 4)):
+                results = self.scheduler.classify_batch(batch, batch_num, "?")
+                set_metrics(results=len(results))
+        except Exception as e:
+            error = e
+            traceback.print_exc()
+        # The service reports failed excerpts to the caller instead of retrying them at the end of a run.
+        self.scheduler.take_dead_letters()
+
+        analyses = {result["NewID"]: result["analysis"] for result in results if result.get("analysis")}
+        if self.cache is not None:
+            self.cache.put_many({pending[new_id][0]: json.dumps(analysis) for new_id, analysis in analyses.items()})
+        failed = 0
+        with self._lock:
+            for excerpt in batch:
+                key, future = pending[excerpt["NewID"]]
+                self._in_flight.pop(key, None)
+                analysis = analyses.get(excerpt["NewID"])
+                if analysis is not None:
+                    future.set_result(analysis)
+                    continue
+                failed += 1
+                future.set_exception(ClassificationError(
+                    f"{type(error).__name__}: {error}" if error is not None
+                    else "The model did not return a valid analysis after every retry."))
+            self.counts["failed"] += failed
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /health: the MicroBatcher's health and metrics.
+    POST /classify: {"text": "..."} or {"texts": ["...", ...]} -> {"results": [...]} in the same order.
+    """
+    server_version = "EmotionService/1.0"
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._send_json(404, {"error": f"Unknown path '{self.path}'"})
+            return
+        self._send_json(200, self.server.batcher.health())
+
+    def do_POST(self):
+        if self.path != "/classify":
+            self._send_json(404, {"error": f"Unknown path '{self.path}'"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            texts = body["texts"] if "texts" in body else [body["text"]]
+            if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+                raise TypeError("'texts' must be a list of strings")
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": f"Expected a JSON object with 'text' or 'texts' ({type(e).__name__}: {e})."})
+            return
+
+        results = self.server.batcher.classify(texts, timeout=self.server.request_timeout)
+        # A request whose excerpts all failed reports the upstream failure; partial failures are per excerpt.
+        status = 502 if results and all("error" in result for result in results) else 200
+        self._send_json(status, {"results": [{"text": text, **result} for text, result in zip(texts, results)]})
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # The analyzer already prints a line per batch; an access line per request would bury it.
+        pass
+
+
+def create_server(batcher, host=SERVICE_HOST, port=SERVICE_PORT, request_timeout=SERVICE_REQUEST_TIMEOUT):
+    """
+    Creates the HTTP server for a MicroBatcher. Each request is handled on its own thread; call
+    `serve_forever()` to start serving (port 0 picks a free port, see `server.server_address`).
+    """
+    server = ThreadingHTTPServer((host, port), _RequestHandler)
+    server.daemon_threads = True
+    server.batcher = batcher
+    server.request_timeout = request_timeout
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve emotion classification over a local HTTP/JSON endpoint.")
+    parser.add_argument("--host", default=SERVICE_HOST, help="Interface to listen on (default: %(default)s).")
+    parser.add_argument("--port", type=int, default=SERVICE_PORT, help="Port to listen on (default: %(default)s).")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read from or write to the response cache.")
+    parser.add_argument("--fake", action="store_true",
+                        help="Answer with the simulated backend of the offline benchmark instead of calling Gemini.")
+    args = parser.parse_args(argv)
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    genai_client = None
+    if args.fake:
+        from fake_genai import FakeGenAIClient
+        genai_client = FakeGenAIClient()
+    cache = None
+    if not args.no_cache and RESPONSE_CACHE_PATH:
+        cache = ResponseCache(RESPONSE_CACHE_PATH, max_entries=RESPONSE_CACHE_MAX_ENTRIES)
+    classifier_client = EmotionClassifierClient(os.path.join(OUTPUT_DIR, f"prompt_log_service_{timestamp}.jsonl.gz"),
+                                                genai_client=genai_client)
+    batcher = MicroBatcher(build_scheduler(classifier_client), cache=cache, local_scorer=load_local_scorer(LOCAL_SCORER),
+                           local_confidence=LOCAL_SCORER_CONFIDENCE)
+    server = create_server(batcher, args.host, args.port)
+    print(f"🚀 Serving on http://{args.host}:{server.server_address[1]} (POST /classify, GET /health). Press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping the service...")
+    finally:
+        server.server_close()
+        batcher.close()
+        if cache is not None:
+            cache.close()
+        classifier_client.close()
+
+
+if __name__ == "__main__":
+    main()
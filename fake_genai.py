@@ -0,0 +1,158 @@
+# fake_genai.py
+
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from config import EMOTION_CODEBOOK
+
+# The entry format the output instructions use when justifications are requested.
+_JUSTIFICATION_FORMAT = '"justification": "..."'
+
+
+class FakeAPIError(Exception):
+    """A simulated API error carrying an HTTP status code, like the errors of google-genai."""
+    def __init__(self, code, message):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class FakeGenAIClient:
+    """
+    A local stand-in for `genai.Client` that answers `models.generate_content_stream` with synthetic
+    streaming responses, so the analyzer can be benchmarked end to end without calling the API.
+
+    Each call reads the excerpts from the prompt and streams back a JSON list with a random score (and
+    a justification, unless the prompt asks for scores only) for every emotion in the codebook. Call
+    latency follows a log-normal distribution around `latency`; a share of it passes before the first
+    chunk and the rest is spread over the remaining chunks. A fraction of calls fail with a retryable
+    503 or 429 error, and a fraction of streams stop early, as a response cut off at the output limit
+    would. Usage metadata with estimated token counts is attached to the last chunk.
+
+    `models.generate_content` answers a whole (non-streamed) request with `candidate_count` candidates.
+    With `score_noise`, every excerpt has a fixed base score per emotion (derived from its text) and each
+    call adds Gaussian noise to it, so repeated samples of an excerpt scatter like a model's would.
+
+    The counters (`calls`, `errors`, `truncations`, `excerpts`) are safe to read after the run.
+    """
+    def __init__(self, latency=0.05, latency_sigma=0.5, first_chunk_share=0.3, chunk_size=256,
+                 error_rate=0.0, rate_limit_share=0.5, truncation_rate=0.0, score_noise=None, seed=0,
+                 sleep=time.sleep):
+        """
+        Args:
+            latency (float): Median seconds per call.
+            latency_sigma (float): Spread of the log-normal latency distribution (0 for a fixed latency).
+            first_chunk_share (float): Share of a call's latency that passes before the first chunk.
+            chunk_size (int): Characters of response text per streamed chunk.
+            error_rate (float): Fraction of calls that raise a FakeAPIError before streaming.
+            rate_limit_share (float): Fraction of those errors that are 429s rather than 503s.
+            truncation_rate (float): Fraction of streams that stop partway through the response.
+            score_noise (float): Standard deviation of the noise around each excerpt's base scores, or None
+                                 for independent random scores on every call.
+            seed (int): Seed for the latencies, errors, truncations and scores.
+        """
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.first_chunk_share = first_chunk_share
+        self.chunk_size = max(1, chunk_size)
+        self.error_rate = error_rate
+        self.rate_limit_share = rate_limit_share
+        self.truncation_rate = truncation_rate
+        self.score_noise = score_noise
+        self.emotions = list(EMOTION_CODEBOOK)
+        self._rng = random.Random(seed)
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.truncations = 0
+        self.excerpts = 0
+        self.models = SimpleNamespace(generate_content_stream=self.generate_content_stream,
+                                      generate_content=self.generate_content)
+        self.caches = SimpleNamespace(create=self._create_cache, delete=lambda name: None)
+
+    def generate_content_stream(self, model, contents, config=None):
+        prompt, (response,), latency, truncate_at = self._call(contents, 1)
+        if truncate_at is not None:
+            response = response[:int(len(response) * truncate_at)]
+        usage = SimpleNamespace(prompt_token_count=len(prompt) // 4, candidates_token_count=len(response) // 4,
+                                cached_content_token_count=None)
+        return self._stream(response, latency, usage)
+
+    def generate_content(self, model, contents, config=None):
+        candidate_count = getattr(config, "candidate_count", None) or 1
+        prompt, responses, latency, truncate_at = self._call(contents, candidate_count)
+        if truncate_at is not None:
+            responses[-1] = responses[-1][:int(len(responses[-1]) * truncate_at)]
+        self._sleep(latency)
+        candidates = [SimpleNamespace(content=SimpleNamespace(parts=[SimpleNamespace(text=response)]))
+                      for response in responses]
+        usage = SimpleNamespace(prompt_token_count=len(prompt) // 4,
+                                candidates_token_count=sum(len(response) for response in responses) // 4,
+                                cached_content_token_count=None)
+        return SimpleNamespace(candidates=candidates, text=responses[0], usage_metadata=usage)
+
+    def _call(self, contents, candidate_count):
+        """Draws the outcome of one call and returns the prompt, the response texts, the latency and the truncation point."""
+        prompt = contents[0] if isinstance(contents, list) else contents
+        excerpts = _excerpts_from_prompt(prompt)
+        with self._lock:
+            self.calls += 1
+            self.excerpts += len(excerpts)
+            latency = self.latency * math.exp(self._rng.gauss(0, self.latency_sigma)) if self.latency else 0.0
+            failure = self._rng.random() < self.error_rate
+            rate_limited = self._rng.random() < self.rate_limit_share
+            truncate_at = self._rng.random() if self._rng.random() < self.truncation_rate else None
+            scores = [[[self._score(excerpt, emotion) for emotion in self.emotions] for excerpt in excerpts]
+                      for _ in range(candidate_count)]
+            if failure:
+                self.errors += 1
+            elif truncate_at is not None:
+                self.truncations += 1
+
+        if failure:
+            self._sleep(latency * self.first_chunk_share)
+            if rate_limited:
+                raise FakeAPIError(429, "RESOURCE_EXHAUSTED: simulated quota error")
+            raise FakeAPIError(503, "UNAVAILABLE: simulated server error")
+
+        include_justification = _JUSTIFICATION_FORMAT in prompt
+        responses = [json.dumps([
+            {"NewID": excerpt.get("NewID"), "analysis": {
+                emotion: ({"score": score, "justification": f"Simulated justification for {emotion}."}
+                          if include_justification else {"score": score})
+                for emotion, score in zip(self.emotions, excerpt_scores)
+            }}
+            for excerpt, excerpt_scores in zip(excerpts, candidate_scores)
+        ]) for candidate_scores in scores]
+        return prompt, responses, latency, truncate_at
+
+    def _score(self, excerpt, emotion):
+        """One sampled score (call with the lock held, as it draws from the shared random generator)."""
+        if self.score_noise is None:
+            return round(self._rng.random(), 2)
+        digest = hashlib.blake2b(f"{emotion}\0{excerpt.get('Text')}".encode('utf-8'), digest_size=8).digest()
+        base = int.from_bytes(digest, "little") / 2 ** 64
+        return round(min(1.0, max(0.0, self._rng.gauss(base, self.score_noise))), 2)
+
+    def _stream(self, response, latency, usage):
+        chunks = [response[i:i + self.chunk_size] for i in range(0, len(response), self.chunk_size)] or [""]
+        self._sleep(latency * self.first_chunk_share)
+        chunk_delay = latency * (1 - self.first_chunk_share) / max(1, len(chunks) - 1)
+        for i, text in enumerate(chunks):
+            if i:
+                self._sleep(chunk_delay)
+            yield SimpleNamespace(text=text, usage_metadata=usage if i == len(chunks) - 1 else None)
+
+    def _create_cache(self, model, config):
+        return SimpleNamespace(name="cachedContents/fake")
+
+
+def _excerpts_from_prompt(prompt):
+    """The excerpts of the JSON payload that follows the prompt intro."""
+    payload, _ = json.JSONDecoder().raw_decode(prompt, prompt.index("{"))
+    return payload.get("excerpts_to_classify", [])
@@ -0,0 +1,198 @@
+# incremental.py
+
+import hashlib
+import json
+
+# The worksheet of the Excel raw output, and the Parquet schema metadata key, that hold the fingerprints
+# of the codebook and prompt settings the output was produced with.
+FINGERPRINT_SHEET = "Run_Fingerprints"
+FINGERPRINT_METADATA_KEY = b"emotion_analyzer.fingerprints"
+
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def codebook_fingerprints(codebook):
+    """One fingerprint per codebook entry, so that an edit to one emotion's definition can be told apart."""
+    return {emotion: _digest(entry) for emotion, entry in codebook.items()}
+
+
+def text_fingerprint(text):
+    """The fingerprint of an excerpt's text, compared with the previous output to find edited rows."""
+    return hashlib.sha256(str(text).encode('utf-8')).hexdigest()[:16]
+
+
+def run_fingerprints(codebook, settings):
+    """
+    The fingerprints stored with a raw output.
+
+    Args:
+        codebook (dict): The codebook the run used.
+        settings (str): The fingerprint of everything else in the prompt (see `settings_fingerprint` in
+                        ai_emotion_analyzer.py).
+    """
+    return {"settings": settings, "codebook": codebook_fingerprints(codebook)}
+
+
+def fingerprint_rows(fingerprints):
+    """The fingerprints as rows of the Run_Fingerprints sheet."""
+    return ([{"Kind": "settings", "Name": "", "Fingerprint": fingerprints["settings"]}]
+            + [{"Kind": "emotion", "Name": emotion, "Fingerprint": fingerprint}
+               for emotion, fingerprint in fingerprints["codebook"].items()])
+
+
+def read_fingerprints(path):
+    """
+    Reads the fingerprints stored with a raw output (.xlsx or .parquet).
+
+    Returns:
+        dict: {"settings": ..., "codebook": {emotion: fingerprint}}, or None for outputs written before
+              fingerprints were stored.
+    """
+    if path.lower().endswith('.parquet'):
+        import pyarrow.parquet as pq
+        metadata = pq.read_schema(path).metadata or {}
+        if FINGERPRINT_METADATA_KEY not in metadata:
+            return None
+        return json.loads(metadata[FINGERPRINT_METADATA_KEY])
+
+    import pandas as pd
+    try:
+        rows = pd.read_excel(path, sheet_name=FINGERPRINT_SHEET, dtype=str, keep_default_na=False)
+    except ValueError:
+        return None
+    fingerprints = {"settings": None, "codebook": {}}
+    for row in rows.to_dict('records'):
+        if row["Kind"] == "settings":
+            fingerprints["settings"] = row["Fingerprint"]
+        else:
+            fingerprints["codebook"][row["Name"]] = row["Fingerprint"]
+    return fingerprints
+
+
+def merge_analyses(previous, rescored, emotions):
+    """
+    Replaces the re-scored emotions of a previous analysis, keeping the entries in codebook order.
+
+    Args:
+        previous (dict): The analysis of the previous run.
+        rescored (dict): The new entries of the re-scored emotions.
+        emotions (list): The emotions of the current codebook; entries for any other emotion are dropped.
+    """
+    return {emotion: rescored[emotion] if emotion in rescored else previous[emotion]
+            for emotion in emotions if emotion in rescored or emotion in previous}
+
+
+class PreviousRun:
+    """
+    The analyses of an earlier run's raw output, for an incremental run that only pays for what changed.
+
+    `compare` finds the emotions whose codebook entries were added or edited since that run. A row whose
+    NewID and text are unchanged keeps its previous analysis (`match`), with just those emotions re-scored;
+    new and edited rows are classified in full.
+
+    Attributes:
+        path (str): The previous raw output.
+        changed_emotions (list): Emotions to re-score on unchanged rows, set by `compare`.
+        removed_emotions (list): Emotions of the previous run that are no longer in the codebook.
+    """
+    def __init__(self, path, rows, fingerprints):
+        """
+        Args:
+            path (str): The previous raw output.
+            rows (dict): str(NewID) -> (text fingerprint, analysis dict, scoring tier, Duplicate_Of value).
+            fingerprints (dict): The fingerprints stored with the output, or None if it has none.
+        """
+        self.path = path
+        self.rows = rows
+        self.fingerprints = fingerprints
+        self.emotions = []
+        self.changed_emotions = []
+        self.removed_emotions = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def compare(self, codebook, settings):
+        """
+        Compares the previous run's fingerprints with the current codebook and prompt settings.
+
+        Returns:
+            bool: False if the prompt settings (question, model, generation or output settings) changed,
+                  in which case no previous analysis can be reused.
+        """
+        self.emotions = list(codebook)
+        current = codebook_fingerprints(codebook)
+        if self.fingerprints is None:
+            print(f"⚠️ '{self.path}' has no codebook fingerprints (it predates incremental runs). "
+                  "Assuming the codebook is unchanged; only new and edited rows are classified.")
+            self.changed_emotions, self.removed_emotions = [], []
+            return True
+        if self.fingerprints.get("settings") != settings:
+            print(f"⚠️ The prompt settings changed since '{self.path}' was written. Every row is classified again.")
+            return False
+        previous = self.fingerprints.get("codebook", {})
+        self.changed_emotions = [emotion for emotion in current if previous.get(emotion) != current[emotion]]
+        self.removed_emotions = [emotion for emotion in previous if emotion not in current]
+        return True
+
+    def match(self, new_id, text):
+        """
+        The previous analysis of an unchanged row (without removed emotions) and its scoring tier, or
+        (None, None) if the row is new, its text was edited, or its analysis lacks an unchanged emotion.
+        """
+        row = self.rows.get(str(new_id))
+        if row is None or row[0] != text_fingerprint(text):
+            return None, None
+        _, analysis, tier, _ = row
+        changed = set(self.changed_emotions)
+        if any(emotion not in analysis for emotion in self.emotions if emotion not in changed):
+            return None, None
+        return {emotion: entry for emotion, entry in analysis.items() if emotion in self.emotions}, tier
+
+    def duplicate_of(self, new_id):
+        """The NewID the previous run copied the analysis of `new_id` from (its Duplicate_Of value), or None."""
+        row = self.rows.get(str(new_id))
+        return row[3] if row is not None else None
+
+
+def _new_id_cell(value):
+    """A NewID read back from a raw output column, or None for an empty cell."""
+    if value is None or value != value:  # NaN: an empty cell
+        return None
+    # Excel reads integer NewIDs in a column with empty cells as floats.
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def load_previous_run(path):
+    """
+    Reads a previous raw output (.xlsx or .parquet) for an incremental run. Rows without an analysis are
+    left out, so they are classified again.
+
+    Returns:
+        PreviousRun: The previous analyses, not yet compared with the current codebook.
+    """
+    import pandas as pd
+    from result_processor import load_raw_output
+
+    df = load_raw_output(path)
+    missing = pd.Series([None] * len(df))
+    tiers = df["Scoring_Tier"] if "Scoring_Tier" in df.columns else missing
+    duplicates = df["Duplicate_Of"] if "Duplicate_Of" in df.columns else missing
+    rows = {}
+    for new_id, text, response, tier, duplicate_of in zip(df["NewID"], df["Text"], df["Model_Response"], tiers,
+                                                          duplicates):
+        if not isinstance(response, str):
+            continue
+        try:
+            analysis = json.loads(response)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(analysis, dict) and analysis:
+            rows[str(new_id)] = (text_fingerprint(text), analysis, tier if isinstance(tier, str) else "gemini",
+                                 _new_id_cell(duplicate_of))
+    print(f"♻️ Loaded {len(rows)} analyses from the previous output '{path}'.")
+    return PreviousRun(path, rows, read_fingerprints(path))
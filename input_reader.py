@@ -0,0 +1,103 @@
+# input_reader.py
+
+import os
+
+
+class ExcerptReader:
+    """
+    Streams rows of an input file in fixed-size chunks, keeping only the requested columns, so that
+    memory stays flat and processing can start before the whole file has been read.
+
+    Supported formats are .xlsx/.xlsm (openpyxl read-only mode), .csv and .parquet (requires pyarrow).
+    """
+    def __init__(self, file_path, sheet_name=None):
+        """
+        Opens the file and reads its header.
+
+        Args:
+            file_path (str): The input file.
+            sheet_name (str): The worksheet to read (Excel files only).
+
+        Raises:
+            FileNotFoundError: If the file does not exist.
+            ValueError: If the file type is not supported or the worksheet does not exist.
+        """
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"No such file: '{file_path}'")
+        self.file_path = file_path
+        self.sheet_name = sheet_name
+        self.format = os.path.splitext(file_path)[1].lower().lstrip('.')
+        self._workbook = None
+
+        if self.format in ("xlsx", "xlsm"):
+            import openpyxl
+            self._workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+            if sheet_name not in self._workbook.sheetnames:
+                self.close()
+                raise ValueError(f"Worksheet named '{sheet_name}' not found")
+            self._rows = self._workbook[sheet_name].iter_rows(values_only=True)
+            header = next(self._rows, ())
+            self.columns = [str(name) if name is not None else "" for name in header]
+        elif self.format == "csv":
+            import pandas as pd
+            self.columns = list(pd.read_csv(file_path, nrows=0).columns)
+        elif self.format == "parquet":
+            import pyarrow.parquet as pq
+            self._parquet = pq.ParquetFile(file_path)
+            self.columns = list(self._parquet.schema_arrow.names)
+        else:
+            raise ValueError(f"Unsupported input file type '.{self.format}'. Use .xlsx, .csv or .parquet.")
+
+    def iter_chunks(self, columns, chunk_size):
+        """
+        Yields the rows of the file in order, as lists of at most `chunk_size` dictionaries holding
+        only `columns`.
+        """
+        if self.format in ("xlsx", "xlsm"):
+            yield from self._iter_excel_chunks(columns, chunk_size)
+        elif self.format == "csv":
+            import pandas as pd
+            for frame in pd.read_csv(self.file_path, usecols=list(columns), chunksize=chunk_size):
+                yield frame[list(columns)].to_dict('records')
+        else:
+            for record_batch in self._parquet.iter_batches(batch_size=chunk_size, columns=list(columns)):
+                yield record_batch.to_pylist()
+
+    def _iter_excel_chunks(self, columns, chunk_size):
+        indices = [self.columns.index(column) for column in columns]
+        chunk = []
+        # Fully empty rows are held back until a non-empty row follows, so trailing blank rows are dropped
+        # the same way pandas.read_excel drops them.
+        blank_rows = 0
+        for row in self._rows:
+            values = [_excel_value(row[i]) if i < len(row) else None for i in indices]
+            if all(value is None for value in values):
+                blank_rows += 1
+                continue
+            for _ in range(blank_rows):
+                chunk.append(dict.fromkeys(columns))
+            blank_rows = 0
+            chunk.append(dict(zip(columns, values)))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def close(self):
+        if self._workbook is not None:
+            self._workbook.close()
+            self._workbook = None
+
+
+def _excel_value(value):
+    """Converts whole-number floats to int, matching how pandas.read_excel reads numeric IDs."""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def has_text(record):
+    """True if a record's Text is present and not empty (and not a missing value read from CSV)."""
+    text = record.get("Text")
+    return text is not None and text == text and text != ""
@@ -0,0 +1,259 @@
+# local_scorer.py
+
+import argparse
+import hashlib
+import math
+import re
+
+import numpy as np
+
+from config import EMOTION_CODEBOOK
+from near_duplicates import normalize_text
+
+# Answers that carry no emotion on their own, after normalize_text. A bare "No" is left out: as an answer to
+# a question like "Are you satisfied...?" it is often a complaint.
+NEUTRAL_ANSWERS = {
+    "", "yes", "n a", "na", "none", "nothing", "no comment", "not applicable", "not sure", "unsure", "same",
+    "ok", "okay", "idk", "i don t know", "dont know", "don t know", "yep", "yeah", "nil", "no answer", "skip",
+    "pass", "maybe", "nothing to add", "no thanks", "nothing else",
+}
+
+
+def _normalize_scores(scores):
+    return np.clip(scores, 0.0, 1.0)
+
+
+class LexiconScorer:
+    """
+    Scores excerpts with the language clues and examples of the codebook, without any training data.
+
+    It is deliberately conservative. Excerpts that match a codebook example get that example's
+    emotion with high confidence, and answers with no emotional content ("Yes", "N/A", "Not sure")
+    are scored neutral with high confidence. Any other excerpt is scored from the clue words and
+    phrases it contains, with a confidence below any sensible cutoff, so it goes to the model.
+    """
+    name = "lexicon"
+
+    def __init__(self, clues, examples, emotions, neutral_emotion="neutral"):
+        """
+        Args:
+            clues (dict): Emotion -> list of normalized clue words and phrases.
+            examples (dict): Normalized example text -> emotion.
+            emotions (list): The emotions to score, in output order.
+            neutral_emotion (str): The emotion that stands for "no emotion".
+        """
+        self.emotions = list(emotions)
+        self.neutral_emotion = neutral_emotion if neutral_emotion in self.emotions else None
+        self.examples = examples
+        self._patterns = {
+            emotion: re.compile(r"\b(?:" + "|".join(re.escape(clue) for clue in sorted(phrases, key=len, reverse=True)) + r")\b")
+            for emotion, phrases in clues.items() if phrases
+        }
+
+    @classmethod
+    def from_codebook(cls, codebook=None):
+        """Builds the lexicon from the quoted phrases under each emotion's "Language Clues" and its examples."""
+        codebook = codebook or EMOTION_CODEBOOK
+        clues, examples = {}, {}
+        for emotion, entry in codebook.items():
+            section = entry.get("chain_of_thought", "").partition("Language Clues")[2]
+            phrases = {normalize_text(phrase) for phrase in re.findall(r'"([^"]+)"', section)}
+            # Fragments such as "What if...?" keep their leading words only.
+            clues[emotion] = sorted(phrase for phrase in phrases if phrase)
+            for example in entry.get("examples", []):
+                examples.setdefault(normalize_text(example), emotion)
+        return cls(clues, examples, list(codebook))
+
+    def score(self, texts):
+        """
+        Returns:
+            tuple: A (len(texts), len(emotions)) array of scores in [0, 1] and an array of confidences in [0, 1].
+        """
+        scores = np.zeros((len(texts), len(self.emotions)))
+        confidence = np.zeros(len(texts))
+        for row, text in enumerate(texts):
+            normalized = normalize_text(text)
+            example_emotion = self.examples.get(normalized)
+            if example_emotion is not None:
+                scores[row, self.emotions.index(example_emotion)] = 0.9
+                confidence[row] = 0.95
+                continue
+            hits = {emotion: len(pattern.findall(normalized)) for emotion, pattern in self._patterns.items()}
+            if any(hits.values()):
+                for emotion, count in hits.items():
+                    scores[row, self.emotions.index(emotion)] = 1 - 0.5 ** count
+                confidence[row] = 0.5
+                continue
+            if self.neutral_emotion is not None:
+                scores[row, self.emotions.index(self.neutral_emotion)] = 0.9
+            if normalized in NEUTRAL_ANSWERS:
+                confidence[row] = 0.95
+            else:
+                # Without a clue the lexicon cannot tell a factual answer from an emotional one.
+                confidence[row] = 0.7 if len(normalized.split()) <= 2 else 0.4
+        return _normalize_scores(scores), confidence
+
+
+def _features(texts, dim):
+    """Binary hashed unigram and bigram features of each normalized text, L2-normalized, plus a bias column."""
+    matrix = np.zeros((len(texts), dim + 1))
+    for row, text in enumerate(texts):
+        words = normalize_text(text).split()
+        grams = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        for gram in grams:
+            digest = hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest()
+            matrix[row, int.from_bytes(digest, "little") % dim] = 1.0
+        norm = math.sqrt(matrix[row, :dim].sum())
+        if norm:
+            matrix[row, :dim] /= norm
+    matrix[:, dim] = 1.0
+    return matrix
+
+
+class LinearScorer:
+    """
+    A ridge regression from hashed words and word pairs to each emotion's score, trained on the
+    Model_Response scores of previous runs (see `train`).
+
+    Each prediction's confidence estimates the probability that every emotion falls on the same side
+    of `decision_threshold` as the model's score would. It treats the training residuals of each
+    emotion as normally distributed and is scaled by the share of the excerpt's features that were
+    seen at least `min_count` times in training, so unfamiliar text is never scored confidently.
+    """
+    name = "linear"
+
+    def __init__(self, weights, residual_std, feature_counts, emotions, dim, decision_threshold=0.5, min_count=3):
+        self.weights = weights
+        self.residual_std = np.maximum(residual_std, 1e-3)
+        self.feature_counts = feature_counts
+        self.emotions = list(emotions)
+        self.dim = dim
+        self.decision_threshold = decision_threshold
+        self.min_count = min_count
+
+    @classmethod
+    def train(cls, texts, scores, emotions, dim=2048, alpha=1.0, chunk_size=10_000, **kwargs):
+        """
+        Fits the model on `texts` and their (len(texts), len(emotions)) `scores`, in chunks so that the
+        feature matrix of a large training set never has to be held in memory at once.
+        """
+        gram = np.zeros((dim + 1, dim + 1))
+        moment = np.zeros((dim + 1, len(emotions)))
+        counts = np.zeros(dim)
+        for start in range(0, len(texts), chunk_size):
+            features = _features(texts[start:start + chunk_size], dim)
+            gram += features.T @ features
+            moment += features.T @ scores[start:start + chunk_size]
+            counts += (features[:, :dim] > 0).sum(axis=0)
+        regularization = alpha * np.eye(dim + 1)
+        regularization[dim, dim] = 0.0  # The bias is not penalized.
+        weights = np.linalg.solve(gram + regularization, moment)
+
+        squared_error = np.zeros(len(emotions))
+        for start in range(0, len(texts), chunk_size):
+            predicted = _normalize_scores(_features(texts[start:start + chunk_size], dim) @ weights)
+            squared_error += ((predicted - scores[start:start + chunk_size]) ** 2).sum(axis=0)
+        residual_std = np.sqrt(squared_error / max(1, len(texts)))
+        return cls(weights, residual_std, counts, emotions, dim, **kwargs)
+
+    def score(self, texts):
+        features = _features(texts, self.dim)
+        scores = _normalize_scores(features @ self.weights)
+        # Probability of landing on the same side of the threshold as the model, per emotion.
+        z = np.abs(scores - self.decision_threshold) / self.residual_std
+        same_side = 0.5 * (1 + np.vectorize(math.erf)(z / math.sqrt(2)))
+        present = features[:, :self.dim] > 0
+        known = present & (self.feature_counts >= self.min_count)
+        coverage = np.divide(known.sum(axis=1), present.sum(axis=1),
+                             out=np.zeros(len(texts)), where=present.any(axis=1))
+        return scores, coverage * same_side.prod(axis=1)
+
+    def save(self, path):
+        np.savez_compressed(path, weights=self.weights, residual_std=self.residual_std,
+                            feature_counts=self.feature_counts, emotions=np.array(self.emotions), dim=self.dim,
+                            decision_threshold=self.decision_threshold, min_count=self.min_count)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["weights"], data["residual_std"], data["feature_counts"], data["emotions"].tolist(),
+                   int(data["dim"]), decision_threshold=float(data["decision_threshold"]),
+                   min_count=int(data["min_count"]))
+
+
+def confident_analyses(scorer, texts, min_confidence):
+    """
+    Scores `texts` and builds the analyses of those scored with at least `min_confidence`, in the format
+    of the model's analyses.
+
+    Returns:
+        dict: Index in `texts` -> analysis, for the confidently scored texts only.
+    """
+    scores, confidence = scorer.score(texts)
+    analyses = {}
+    for index, (row_scores, row_confidence) in enumerate(zip(scores, confidence)):
+        if row_confidence < min_confidence:
+            continue
+        justification = f"Scored locally by the {scorer.name} scorer (confidence {row_confidence:.2f})."
+        analyses[index] = {emotion: {"score": round(float(score), 2), "justification": justification}
+                           for emotion, score in zip(scorer.emotions, row_scores)}
+    return analyses
+
+
+def load_local_scorer(setting):
+    """
+    Builds the local scorer named by the LOCAL_SCORER setting: None, "lexicon", or the path of a saved
+    LinearScorer (.npz).
+    """
+    if not setting:
+        return None
+    if setting == "lexicon":
+        return LexiconScorer.from_codebook()
+    scorer = LinearScorer.load(setting)
+    if scorer.emotions != list(EMOTION_CODEBOOK):
+        raise ValueError(f"The local scorer '{setting}' was trained for emotions {scorer.emotions}, "
+                         f"but the codebook has {list(EMOTION_CODEBOOK)}. Retrain it with local_scorer.py.")
+    return scorer
+
+
+def load_training_data(paths):
+    """
+    Reads the texts and model scores of previous raw outputs (.xlsx or .parquet). Rows that were
+    scored locally rather than by the model are left out.
+    """
+    import pandas as pd
+    from result_processor import load_raw_output, parse_model_responses
+
+    frames = []
+    for path in paths:
+        df = load_raw_output(path)
+        if "Scoring_Tier" in df.columns:
+            df = df[df["Scoring_Tier"].fillna("") != "local"]
+        frames.append(df)
+    parsed = parse_model_responses(pd.concat(frames, ignore_index=True), coerce=True)
+    return parsed.base["Text"], parsed.scores, parsed.emotions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the local scorer on the model scores of previous runs.")
+    parser.add_argument("raw_outputs", nargs="+", help="Raw output files (llm_raw_output_*.xlsx or .parquet).")
+    parser.add_argument("--out", required=True, help="Where to save the model (.npz); set LOCAL_SCORER to this path.")
+    parser.add_argument("--dim", type=int, default=2048, help="Number of hashed features.")
+    parser.add_argument("--alpha", type=float, default=1.0, help="Ridge regularization strength.")
+    parser.add_argument("--decision-threshold", type=float, default=0.5,
+                        help="The score threshold the confidence is measured against (the result processor's threshold).")
+    args = parser.parse_args()
+
+    texts, scores, emotions = load_training_data(args.raw_outputs)
+    if list(emotions) != list(EMOTION_CODEBOOK):
+        raise SystemExit(f"❌ The raw outputs cover emotions {emotions}, but the codebook has {list(EMOTION_CODEBOOK)}.")
+    print(f"Training on {len(texts)} excerpts...")
+    scorer = LinearScorer.train([str(text) for text in texts], scores, emotions, dim=args.dim, alpha=args.alpha,
+                                decision_threshold=args.decision_threshold)
+    scorer.save(args.out)
+    residuals = ", ".join(f"{emotion} {std:.3f}" for emotion, std in zip(emotions, scorer.residual_std))
+    print(f"✅ Saved the local scorer to '{args.out}'. Training residual std: {residuals}.")
+
+
+if __name__ == "__main__":
+    main()
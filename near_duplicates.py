@@ -0,0 +1,146 @@
+# near_duplicates.py
+
+import hashlib
+import re
+import unicodedata
+
+import numpy as np
+
+# The MinHash permutations are multiply-shift hashes: the top 32 bits of (a * x + b) mod 2**64.
+_HASH_SHIFT = np.uint64(32)
+# Multiplier that combines the code points of a shingle into one 64-bit value.
+_SHINGLE_BASE = np.uint64(1_000_003)
+
+
+def normalize_text(text):
+    """Lowercases text and strips accents, punctuation and repeated whitespace, so trivial variants compare equal."""
+    text = str(text)
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(char for char in text if not unicodedata.combining(char))
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return " ".join(text.split())
+
+
+def _shingle_hashes(text, size):
+    """
+    Hashes of the distinct overlapping character `size`-grams of a normalized text (one hash of the whole
+    text if it is shorter), computed from the code points with array operations.
+    """
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    size = min(size, len(codes))
+    count = len(codes) - size + 1
+    hashes = np.zeros(count, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for offset in range(size):
+            hashes = hashes * _SHINGLE_BASE + codes[offset:offset + count]
+    return np.unique(hashes)
+
+
+def choose_bands(num_perm, threshold):
+    """
+    Picks the LSH banding (bands x rows per band = num_perm) whose S-curve midpoint (1/bands)^(1/rows)
+    is closest to `threshold` without exceeding it, so that pairs at the threshold are very likely to
+    share a bucket. Candidates are then checked against the threshold exactly.
+    """
+    options = [(bands, num_perm // bands) for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+    below = [option for option in options if (1 / option[0]) ** (1 / option[1]) <= threshold]
+    if not below:
+        return max(options, key=lambda option: option[0])
+    return max(below, key=lambda option: (1 / option[0]) ** (1 / option[1]))
+
+
+class NearDuplicateIndex:
+    """
+    Groups near-identical texts incrementally with MinHash and locality-sensitive hashing.
+
+    Each text is normalized (see `normalize_text`) and described by the MinHash signature of its
+    character shingles. Texts that normalize to the same string are grouped directly. Otherwise the
+    signature's bands are looked up in the LSH buckets, and the text joins the group of the most similar
+    candidate representative whose estimated Jaccard similarity reaches `threshold` and that contains
+    the same numbers (so "2 year wait list" and "3 year wait list" stay apart). A text without
+    such a representative becomes the representative of a new group. Members are only ever compared
+    with representatives, so a group cannot drift away from its representative through a chain of
+    small edits.
+    """
+    def __init__(self, threshold=0.9, num_perm=64, shingle_size=4, seed=1):
+        """
+        Args:
+            threshold (float): Minimum estimated Jaccard similarity (0-1) of the shingle sets.
+            num_perm (int): Number of MinHash permutations; more are slower but estimate more precisely.
+            shingle_size (int): Characters per shingle.
+            seed (int): Seed of the permutations, fixed so that groups are the same from run to run.
+        """
+        if not 0 < threshold <= 1:
+            raise ValueError(f"The near-duplicate threshold must be between 0 and 1, got {threshold}")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands, self.rows = choose_bands(num_perm, threshold)
+        rng = np.random.RandomState(seed)
+        # Multiply-shift hashing needs odd multipliers.
+        self._a = rng.randint(1, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64) | np.uint64(1)
+        self._b = rng.randint(0, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64)
+        self._by_normalized = {}
+        self._signatures = {}
+        self._numbers = {}
+        self._buckets = [{} for _ in range(self.bands)]
+
+    def signature(self, normalized):
+        """The MinHash signature of a normalized text, as an array of `num_perm` 32-bit values."""
+        hashes = _shingle_hashes(normalized, self.shingle_size)
+        # Overflow wraps around modulo 2**64, which is what multiply-shift hashing relies on.
+        with np.errstate(over="ignore"):
+            permuted = (np.outer(hashes, self._a) + self._b) >> _HASH_SHIFT
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def add(self, key, text):
+        """
+        Assigns a text to a group.
+
+        Args:
+            key: An identifier for the text, returned for every later text that joins its group.
+            text (str): The text.
+
+        Returns:
+            tuple: The key of the group's representative (`key` itself if the text starts a new group)
+                   and the estimated similarity to it (1.0 for a new group or an identical normalized text).
+        """
+        normalized = normalize_text(text)
+        if not normalized:
+            # Nothing but punctuation: there is nothing to compare, so it stays on its own.
+            return key, 1.0
+        digest = hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).digest()
+        representative = self._by_normalized.get(digest)
+        if representative is not None:
+            return representative, 1.0
+
+        numbers = tuple(re.findall(r"\d+", normalized))
+        signature = self.signature(normalized)
+        band_keys = [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+        best, best_similarity = None, 0.0
+        seen = set()
+        for buckets, band_key in zip(self._buckets, band_keys):
+            for candidate in buckets.get(band_key, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                if self._numbers[candidate] != numbers:
+                    continue
+                similarity = float(np.mean(np.frombuffer(self._signatures[candidate], dtype=np.uint32) == signature))
+                if similarity >= self.threshold and similarity > best_similarity:
+                    best, best_similarity = candidate, similarity
+        if best is not None:
+            self._by_normalized[digest] = best
+            return best, best_similarity
+
+        self._by_normalized[digest] = key
+        self._signatures[key] = signature.tobytes()
+        self._numbers[key] = numbers
+        for buckets, band_key in zip(self._buckets, band_keys):
+            buckets.setdefault(band_key, []).append(key)
+        return key, 1.0
+
+    def __len__(self):
+        """The number of groups with a signature (representatives)."""
+        return len(self._signatures)
@@ -0,0 +1,277 @@
+# prompt_logger.py
+
+import argparse
+import datetime
+import gzip
+import json
+import os
+import queue
+import threading
+
+# Verbosity levels, from least to most output.
+VERBOSITY_LEVELS = {
+    "off": 0,      # No prompt log at all.
+    "errors": 1,   # Only batches whose API call failed.
+    "batches": 2,  # Every batch's excerpts and the model's response.
+    "debug": 3,    # As "batches", and every entry is also printed to the console.
+}
+
+_LOG_SUFFIX = ".jsonl.gz"
+
+
+class PromptLogger:
+    """
+    Writes the prompt log on a background thread, so API workers never wait on disk or compression.
+
+    The parts of the prompt that are the same for every batch (system instruction, intro, codebook and
+    output format) are logged once, as the first record of each log file. Each batch record then only
+    holds the batch payload (the question and excerpts) and the model's response; the full prompt is
+    `prompt_intro + json.dumps(payload, indent=2) + "\\n\\n" + prompt_suffix`. A client that sends a
+    different static prompt (such as the reduced codebook of an incremental re-scoring) logs it as a
+    further static record with a `prompt_id`, and its batch records carry the same `prompt_id`.
+
+    Every record is written as its own gzip member, so the files can be read with `gzip.open` or `zcat`
+    and any single record can be decompressed on its own. A file is rotated to `<base>.1.jsonl.gz`,
+    `<base>.2.jsonl.gz`, ... once it holds `max_bytes` of uncompressed log text. The index file
+    (`<base>.index.jsonl`) records the file and byte offset of the record for every NewID, which
+    `read_log_entries` uses to pull out the entries of one excerpt without reading the whole log.
+    """
+    def __init__(self, path, verbosity="batches", max_bytes=100 * 1024 * 1024, echo=print):
+        """
+        Args:
+            path (str): The first log file; `.jsonl.gz` (or any other extension) is replaced by `.jsonl.gz`.
+            verbosity (str): One of VERBOSITY_LEVELS.
+            max_bytes (int): Uncompressed log text per file before rotating to a new file.
+            echo: Called with a readable version of each record at "debug" verbosity.
+        """
+        if verbosity not in VERBOSITY_LEVELS:
+            raise ValueError(f"Unknown log verbosity '{verbosity}'; expected one of {', '.join(VERBOSITY_LEVELS)}")
+        self.verbosity = verbosity
+        self.level = VERBOSITY_LEVELS[verbosity]
+        self.max_bytes = max_bytes
+        self._echo = echo
+        self._static = {}
+        self._file = None
+        self._index = None
+        self._thread = None
+        self._failed = False
+        base = path[:-len(_LOG_SUFFIX)] if path.endswith(_LOG_SUFFIX) else os.path.splitext(path)[0]
+        self._base = base
+        self._file_number = 0
+        self.path = f"{base}{_LOG_SUFFIX}"
+        self.index_path = f"{base}.index.jsonl"
+        if not self.enabled:
+            return
+
+        # The files are opened here rather than on the writer thread, so they exist as soon as the logger does.
+        self._open_file(self.path)
+        self._index = open(self.index_path, 'w', encoding='utf-8')
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="prompt-logger", daemon=True)
+        self._thread.start()
+
+    @property
+    def enabled(self):
+        return self.level > 0
+
+    def log_static(self, prompt_id=None, **fields):
+        """
+        Logs the parts of the prompt shared by every batch. They are repeated at the top of each rotated file.
+
+        Args:
+            prompt_id (str): Identifies a static prompt other than the main one; batches sent with it are
+                             logged with the same `prompt_id` (see `read_static_record`).
+        """
+        if self.enabled:
+            record = {"type": "static", "time": _now(), **fields}
+            if prompt_id is not None:
+                record["prompt_id"] = prompt_id
+            self._queue.put(record)
+
+    def log_batch(self, batch_num, total_batches, payload, response, error=None, prompt_id=None):
+        """
+        Queues the log record of one API call.
+
+        Args:
+            batch_num (int): The batch number.
+            total_batches (int): The total number of batches, or "?".
+            payload (dict): The variable part of the prompt: the question and the excerpts.
+            response (str): The response text received (partial if the call failed), or a list with the
+                            text of each candidate of a multi-candidate request.
+            error (str): A description of the error if the call failed.
+            prompt_id (str): The static prompt the batch was sent with, if not the main one.
+        """
+        if self.level < (VERBOSITY_LEVELS["errors"] if error is not None else VERBOSITY_LEVELS["batches"]):
+            return
+        record = {
+            "type": "batch" if error is None else "error",
+            "time": _now(),
+            "batch": batch_num,
+            "total": total_batches,
+            "payload": payload,
+            "response": response,
+        }
+        if error is not None:
+            record["error"] = error
+        if prompt_id is not None:
+            record["prompt_id"] = prompt_id
+        self._queue.put(record)
+
+    def close(self):
+        """Writes every queued record and closes the files."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+        self._index.close()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            try:
+                self._write(record)
+            except Exception as e:
+                # Losing log records must never stop the run; warn once and keep draining the queue.
+                if not self._failed:
+                    self._failed = True
+                    print(f"⚠️ Could not write to the prompt log '{self.path}': {type(e).__name__}: {e}")
+
+    def _write(self, record):
+        line = (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode('utf-8')
+        if record["type"] == "static":
+            self._static[record.get("prompt_id")] = record
+        elif self._bytes and self._bytes + len(line) > self.max_bytes:
+            self._rotate()
+        offset = self._append(line)
+        file_name = os.path.basename(self._file.name)
+        if record["type"] == "static" and "prompt_id" in record:
+            entry = {"prompt_id": record["prompt_id"], "file": file_name, "offset": offset}
+            self._index.write(json.dumps(entry) + "\n")
+            self._index.flush()
+        new_ids = [excerpt.get("NewID") for excerpt in (record.get("payload") or {}).get("excerpts_to_classify", [])]
+        if new_ids:
+            self._index.write("".join(json.dumps({"NewID": new_id, "file": file_name, "offset": offset}, default=str)
+                                      + "\n" for new_id in new_ids))
+            self._index.flush()
+        if self.level >= VERBOSITY_LEVELS["debug"]:
+            self._echo(format_record(record))
+
+    def _append(self, line):
+        """Writes one line as a gzip member and returns the byte offset it starts at."""
+        offset = self._file.tell()
+        self._file.write(gzip.compress(line, compresslevel=6))
+        self._file.flush()
+        self._bytes += len(line)
+        return offset
+
+    def _rotate(self):
+        self._file.close()
+        self._file_number += 1
+        self._open_file(f"{self._base}.{self._file_number}{_LOG_SUFFIX}")
+        for static in self._static.values():
+            self._append((json.dumps(static, ensure_ascii=False, default=str) + "\n").encode('utf-8'))
+
+    def _open_file(self, path):
+        self._file = open(path, 'wb')
+        self._bytes = 0
+
+
+def _now():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def format_record(record):
+    """A readable version of a log record, in the layout of the console output."""
+    if record["type"] == "static":
+        return (f"\n{'='*80}\nSTATIC PROMPT - {record['time']}\n{'='*80}\n"
+                + "\n\n".join(f"---------- {name.upper()} ----------\n{value}"
+                              for name, value in record.items() if name not in ("type", "time")))
+    response = record['response']
+    if isinstance(response, list):
+        response = "\n".join(f"[Candidate {number}]\n{candidate}" for number, candidate in enumerate(response, start=1))
+    prompt = f" (static prompt '{record['prompt_id']}')" if "prompt_id" in record else ""
+    text = (f"\n{'='*80}\nBATCH {record['batch']}/{record['total']}{prompt} - {record['time']}\n{'='*80}\n\n"
+            f"---------- PROMPT SENT TO MODEL (VARIABLE PART) ----------\n"
+            f"{json.dumps(record['payload'], indent=2, ensure_ascii=False, default=str)}\n"
+            f"\n---------- FULL RESPONSE FROM MODEL ----------\n{response}\n")
+    if record.get("error"):
+        text += f"\n---------- ERROR ----------\n{record['error']}\n"
+    return text
+
+
+def read_log_entries(index_path, new_id):
+    """
+    Reads the log records of every API call that included an excerpt, using the index to decompress only
+    those records.
+
+    Args:
+        index_path (str): The `<base>.index.jsonl` file of a prompt log.
+        new_id: The NewID of the excerpt.
+
+    Returns:
+        list: The matching batch and error records, in the order they were logged.
+    """
+    directory = os.path.dirname(index_path)
+    locations = []
+    with open(index_path, encoding='utf-8') as f:
+        for line in f:
+            entry = json.loads(line)
+            location = (entry["file"], entry["offset"])
+            if "NewID" in entry and str(entry["NewID"]) == str(new_id) and location not in locations:
+                locations.append(location)
+    return [_read_record(directory, file_name, offset) for file_name, offset in locations]
+
+
+def read_static_record(index_path, prompt_id):
+    """
+    Reads the static prompt a batch record with a `prompt_id` was sent with.
+
+    Args:
+        index_path (str): The `<base>.index.jsonl` file of a prompt log.
+        prompt_id (str): The `prompt_id` of the batch record.
+
+    Returns:
+        dict: The static record, or None if the log has none with that `prompt_id`.
+    """
+    with open(index_path, encoding='utf-8') as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry.get("prompt_id") == prompt_id:
+                return _read_record(os.path.dirname(index_path), entry["file"], entry["offset"])
+    return None
+
+
+def _read_record(directory, file_name, offset):
+    with open(os.path.join(directory, file_name), 'rb') as f:
+        f.seek(offset)
+        with gzip.GzipFile(fileobj=f) as member:
+            return json.loads(member.readline())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the logged prompts and responses for one excerpt.")
+    parser.add_argument("index", help="The prompt log index (output_files/prompt_log_<timestamp>.index.jsonl).")
+    parser.add_argument("new_id", help="The NewID of the excerpt.")
+    args = parser.parse_args()
+
+    records = read_log_entries(args.index, args.new_id)
+    if not records:
+        print(f"No log entries for NewID '{args.new_id}'.")
+    shown = set()
+    for record in records:
+        # Batches sent with a different static prompt are shown after that prompt, once.
+        prompt_id = record.get("prompt_id")
+        if prompt_id is not None and prompt_id not in shown:
+            shown.add(prompt_id)
+            static = read_static_record(args.index, prompt_id)
+            if static is not None:
+                print(format_record(static))
+        print(format_record(record))
+
+
+if __name__ == "__main__":
+    main()
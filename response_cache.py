@@ -0,0 +1,96 @@
+# response_cache.py
+
+import os
+import sqlite3
+import threading
+import time
+
+
+class ResponseCache:
+    """
+    A persistent, content-addressed cache of per-excerpt model analyses backed by SQLite.
+
+    Entries are keyed by a hash of everything that determines the model's answer for an excerpt
+    (see `ai_emotion_analyzer.excerpt_cache_key`), and the least recently used entries are evicted
+    once the cache grows beyond `max_entries`.
+    """
+    def __init__(self, path, max_entries=None):
+        """
+        Args:
+            path (str): Location of the SQLite database file.
+            max_entries (int): Maximum number of cached excerpts, or None for no limit.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " analysis TEXT NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        """
+        Looks up several keys at once and marks the hits as recently used.
+
+        Returns:
+            dict: Cached analysis JSON strings for the keys that were found.
+        """
+        found = {}
+        with self._lock:
+            found.update(self._select("key, analysis", keys))
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE responses SET last_used = ? WHERE key = ?",
+                                       [(now, key) for key in found])
+                self._conn.commit()
+        return found
+
+    def put_many(self, entries):
+        """Stores a mapping of key -> analysis JSON string, then evicts the least recently used entries if needed."""
+        if not entries:
+            return
+        now = time.time()
+        with self._lock:
+            already_cached = len(self._select("key", entries))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO responses (key, analysis, last_used) VALUES (?, ?, ?)",
+                [(key, analysis, now) for key, analysis in entries.items()]
+            )
+            self._count += len(entries) - already_cached
+            if self.max_entries and self._count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    " SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                    (self._count - self.max_entries,)
+                )
+                self._count = self.max_entries
+            self._conn.commit()
+
+    def _select(self, columns, keys):
+        """Fetches rows for `keys` in chunks that stay well below SQLite's limit on bound parameters."""
+        keys = list(dict.fromkeys(keys))
+        rows = []
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows.extend(self._conn.execute(
+                f"SELECT {columns} FROM responses WHERE key IN ({placeholders})", chunk
+            ).fetchall())
+        return rows
+
+    def __len__(self):
+        with self._lock:
+            return self._count
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,78 @@
+# response_schema.py
+
+from numbers import Real
+
+
+def build_response_schema(emotions, include_justification=True):
+    """
+    Builds the JSON response schema for a batch: a list with one object per excerpt holding its
+    NewID and a score (and optionally a justification) for every emotion.
+
+    Args:
+        emotions (list): Emotion names, normally the keys of EMOTION_CODEBOOK.
+        include_justification (bool): Whether each emotion also carries a free-text justification.
+
+    Returns:
+        dict: A schema in the OpenAPI subset accepted by `GenerateContentConfig.response_schema`.
+    """
+    emotion_properties = {"score": {"type": "NUMBER"}}
+    if include_justification:
+        emotion_properties["justification"] = {"type": "STRING"}
+    emotion_schema = {
+        "type": "OBJECT",
+        "properties": emotion_properties,
+        "required": list(emotion_properties),
+    }
+    return {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {
+                "NewID": {"type": "STRING"},
+                "analysis": {
+                    "type": "OBJECT",
+                    "properties": {emotion: emotion_schema for emotion in emotions},
+                    "required": list(emotions),
+                },
+            },
+            "required": ["NewID", "analysis"],
+        },
+    }
+
+
+def compile_item_validator(emotions, include_justification=True):
+    """
+    Compiles a validator for single response items, so that a malformed item is rejected on its own
+    instead of failing the whole batch.
+
+    The returned function takes a decoded item and returns a normalized copy (scores as floats
+    clamped to [0, 1], only the expected emotions and fields) or None if the item is malformed.
+    """
+    emotions = tuple(emotions)
+
+    def validate(item):
+        if not isinstance(item, dict):
+            return None
+        new_id = item.get("NewID")
+        analysis = item.get("analysis")
+        if new_id in (None, "") or not isinstance(analysis, dict):
+            return None
+
+        normalized = {}
+        for emotion in emotions:
+            entry = analysis.get(emotion)
+            if not isinstance(entry, dict):
+                return None
+            score = entry.get("score")
+            if isinstance(score, bool) or not isinstance(score, Real):
+                return None
+            normalized_entry = {"score": min(1.0, max(0.0, float(score)))}
+            if include_justification:
+                justification = entry.get("justification")
+                if not isinstance(justification, str):
+                    return None
+                normalized_entry["justification"] = justification
+            normalized[emotion] = normalized_entry
+        return {"NewID": new_id, "analysis": normalized}
+
+    return validate
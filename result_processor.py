@@ -1,31 +1,346 @@
 # result_processor.py
 
 import pandas as pd
+import numpy as np
 import json
 import argparse
-from config import EMOTION_CODEBOOK
+import math
+import os
+from config import EMOTION_CODEBOOK, LABEL_COLUMN, SHEET_NAME, INPUT_CHUNK_SIZE
+from input_reader import ExcerptReader
+from result_store import read_parquet_results, analysis_from_row, score_column, justification_column, variance_column
 
-def process_results(file_path, threshold):
+BASE_COLUMNS = ["ResponseID", "NewID", "Text"]
+# Largest integer score that converts to a float without losing precision.
+_MAX_EXACT_INT = 2 ** 53
+
+
+def load_raw_output(file_path):
     """
-    Reads a file with raw LLM output, processes it, and adds two new sheets:
-    1. A detailed analysis with binary classifications for all emotions.
-    2. A summary sheet with only the top-scoring emotion.
-    
+    Loads the raw model output as a DataFrame with ResponseID, NewID, Text and Model_Response columns,
+    from either the Excel workbook or the Parquet file written by ai_emotion_analyzer.py.
+    """
+    if file_path.lower().endswith('.parquet'):
+        df = read_parquet_results(file_path)
+        emotions = list(EMOTION_CODEBOOK.keys())
+        df['Model_Response'] = [analysis_from_row(row, emotions) for row in df.to_dict('records')]
+        return df
+    return pd.read_excel(file_path, sheet_name='LLM_Raw_Output')
+
+
+class ParsedResults:
+    """
+    Raw model output parsed once into arrays, so it can be classified at any threshold without
+    touching the JSON again.
+
+    Attributes:
+        base (dict): The ResponseID, NewID and Text values of every parsed row, by column.
+        emotions (list): The codebook emotions, in the column order of `scores`.
+        scores (np.ndarray): A (rows x emotions) float64 score matrix. Missing emotions score 0.0.
+        justifications (dict): Each emotion's justifications, one per row ("N/A" where missing), with
+            repeated texts shared. None if the results were parsed with `scores_only`.
+        top_emotion, top_score, top_justification (list): The highest-scoring entry of each row's
+            analysis, as shown in the Top_Emotion_Summary sheet (top_justification is None with
+            `scores_only`).
+        variances (np.ndarray): A (rows x emotions) matrix of the self-consistency score variances
+            (NaN where unknown), or None if the output has no self-consistency statistics.
+    """
+    def __init__(self, base, emotions, scores, justifications, top_emotion, top_score, top_justification,
+                 variances=None):
+        self.base = base
+        self.emotions = emotions
+        self.scores = scores
+        self.justifications = justifications
+        self.top_emotion = top_emotion
+        self.top_score = top_score
+        self.top_justification = top_justification
+        self.variances = variances
+
+    def __len__(self):
+        return len(self.scores)
+
+
+def _is_regular(analysis):
+    """True if every entry of an analysis is a dict whose score (if any) is a finite int or float."""
+    if not isinstance(analysis, dict):
+        return False
+    for entry in analysis.values():
+        if not isinstance(entry, dict):
+            return False
+        score = entry.get('score', 0.0)
+        if type(score) is float:
+            if not math.isfinite(score):
+                return False
+        elif type(score) is not int or abs(score) > _MAX_EXACT_INT:
+            return False
+    return True
+
+
+def _coerce_analysis(analysis):
+    """A copy of an irregular analysis with every score converted to a float, or None if that fails."""
+    if not isinstance(analysis, dict):
+        return None
+    coerced = {}
+    for key, entry in analysis.items():
+        if not isinstance(entry, dict):
+            return None
+        try:
+            score = float(entry.get('score', 0.0))
+        except (TypeError, ValueError):
+            return None
+        if not math.isfinite(score):
+            return None
+        coerced[key] = {**entry, 'score': score}
+    return coerced
+
+
+def _interned(texts, pool):
+    """`texts` with every repeated string replaced by one shared copy from `pool`."""
+    return [pool.setdefault(text, text) for text in texts]
+
+
+def _scores_only(analysis):
+    """A copy of an analysis without its justifications, so their text can be freed right away."""
+    return {key: {field: entry[field] for field in ('score', 'variance') if field in entry}
+            for key, entry in analysis.items()}
+
+
+def _variance(entry):
+    """The self-consistency variance of an analysis entry, or NaN if it has none."""
+    variance = entry.get('variance')
+    return float(variance) if type(variance) in (int, float) else np.nan
+
+
+def _argmax_first(matrix):
+    """Column index of each row's maximum (the first one on ties), and a mask of rows with a tie."""
+    top = matrix.argmax(axis=1)
+    best = matrix[np.arange(len(matrix)), top]
+    ties = (matrix == best[:, None]).sum(axis=1) > 1
+    return top, ties
+
+
+def parse_model_responses(df, emotions=None, coerce=False, scores_only=False):
+    """
+    Parses the Model_Response JSON of every row once into a ParsedResults.
+
+    Rows without a response are skipped, and rows whose JSON cannot be parsed are skipped with a
+    warning, exactly as in `build_analysis_frames_rowwise`.
+
     Args:
-        file_path (str): The path to the input .xlsx file.
-        threshold (float): The cutoff score for classifying an emotion as present (1) or not (0)
-                         in the detailed analysis sheet.
+        df (pd.DataFrame): The raw output, with ResponseID, NewID, Text and Model_Response columns.
+        emotions (list): The codebook emotions (defaults to the keys of EMOTION_CODEBOOK).
+        coerce (bool): Convert irregular scores (such as numbers given as strings) to floats instead of
+                       giving up, and skip rows where that fails. Used by the threshold sweep, which
+                       only needs the scores.
+        scores_only (bool): Drop the justifications as each response is parsed, for sheets without them.
+
+    Returns:
+        ParsedResults: The parsed rows, or None if some response has an irregular structure that only
+                       the row-by-row implementation handles and `coerce` is False.
     """
-    try:
-        df = pd.read_excel(file_path, sheet_name='LLM_Raw_Output')
-        print(f"✅ Successfully loaded '{file_path}'. Processing {len(df)} rows.")
-    except (FileNotFoundError, ValueError) as e:
-        print(f"❌ Error reading the Excel file or sheet: {e}")
-        return
+    emotions = list(emotions or EMOTION_CODEBOOK.keys())
+    responses = df['Model_Response'].tolist()
+    missing = df['Model_Response'].isna().to_numpy()
+    new_ids = df['NewID'].tolist()
 
+    positions, analyses, warnings = [], [], []
+    for position, response in enumerate(responses):
+        if missing[position]:
+            continue
+        try:
+            analysis = json.loads(response)
+        except (json.JSONDecodeError, TypeError) as e:
+            warnings.append(f"⚠️ Could not parse JSON for NewID {new_ids[position]}: {e}")
+            continue
+        if not _is_regular(analysis):
+            if not coerce:
+                return None
+            analysis = _coerce_analysis(analysis)
+            if analysis is None:
+                warnings.append(f"⚠️ Could not read the scores for NewID {new_ids[position]}.")
+                continue
+        if scores_only:
+            analysis = _scores_only(analysis)
+        positions.append(position)
+        analyses.append(analysis)
+    for warning in warnings:
+        print(warning)
+
+    # Every key that appears in any analysis, in order of first appearance. The codebook emotions
+    # are included even when no row mentions them.
+    key_index = dict.fromkeys(emotions)
+    for analysis in analyses:
+        key_index.update(dict.fromkeys(analysis))
+    keys = list(key_index)
+
+    # One column per key, with -inf where a row's analysis does not contain the key.
+    all_scores = np.empty((len(analyses), len(keys)), dtype=np.float64)
+    for column, key in enumerate(keys):
+        all_scores[:, column] = [analysis[key].get('score', 0.0) if key in analysis else -np.inf
+                                 for analysis in analyses]
+    scores = all_scores[:, :len(emotions)].copy()
+    scores[np.isneginf(scores)] = 0.0
+    justifications = None
+    if not scores_only:
+        # Duplicates and locally scored rows repeat the same justifications; keep one copy of each text.
+        pool = {}
+        justifications = {
+            emotion: _interned([analysis[emotion].get('justification', 'N/A') if emotion in analysis else 'N/A'
+                                for analysis in analyses], pool)
+            for emotion in emotions
+        }
+    variances = None
+    if any('variance' in entry for analysis in analyses for entry in analysis.values()):
+        variances = np.column_stack([[_variance(analysis[emotion]) if emotion in analysis else np.nan
+                                      for analysis in analyses]
+                                     for emotion in emotions])
+
+    top_emotion, top_score, top_justification = [], [], []
+    top_columns, ties = _argmax_first(all_scores)
+    for row, analysis in enumerate(analyses):
+        if not analysis:
+            top_emotion.append('neutral')
+            top_score.append(0.0)
+            top_justification.append('No dominant emotion found.')
+            continue
+        if ties[row]:
+            # The first maximum in the row's own key order, which may differ from the column order.
+            key = max(analysis.items(), key=lambda item: item[1].get('score', 0.0))[0]
+        else:
+            key = keys[top_columns[row]]
+        entry = analysis[key]
+        top_emotion.append(key)
+        top_score.append(entry.get('score', 0.0))
+        top_justification.append(entry.get('justification', 'N/A'))
+    if scores_only:
+        top_justification = None
+
+    base = {}
+    for col in BASE_COLUMNS:
+        values = df[col].tolist()
+        base[col] = [values[position] for position in positions]
+    return ParsedResults(base, emotions, scores, justifications, top_emotion, top_score, top_justification,
+                         variances)
+
+
+def parse_score_columns(df, emotions=None, scores_only=False):
+    """
+    Builds a ParsedResults directly from the score and justification columns of a Parquet raw output,
+    without going through JSON. Scores are rounded to 6 decimals, as `analysis_from_row` does. The
+    self-consistency variances are read from the variance columns, if the file has them. With
+    `scores_only`, the justification columns are not used (and need not have been read).
+    """
+    emotions = list(emotions or EMOTION_CODEBOOK.keys())
+    raw_scores = np.column_stack([df[score_column(e)].to_numpy(dtype=np.float64, na_value=np.nan)
+                                  for e in emotions])
+    present = ~np.isnan(raw_scores)
+    keep = present.any(axis=1)
+    present = present[keep]
+
+    all_scores = np.full(present.shape, -np.inf)
+    justifications = None if scores_only else {}
+    pool = {}
+    for column, emotion in enumerate(emotions):
+        values = df[score_column(emotion)].to_numpy(dtype=np.float64, na_value=np.nan)[keep]
+        all_scores[:, column] = [round(float(value), 6) if value == value else -np.inf for value in values]
+        if scores_only:
+            continue
+        texts = df[justification_column(emotion)].to_numpy(dtype=object)[keep]
+        justifications[emotion] = _interned([text if is_present and text is not None else 'N/A'
+                                             for text, is_present in zip(texts, present[:, column])], pool)
+    scores = np.where(present, all_scores, 0.0)
+
+    # Entries are in codebook order, so the first maximum is also the one max() would pick.
+    top_columns, _ = _argmax_first(all_scores)
+    top_emotion = [emotions[column] for column in top_columns]
+    top_score = all_scores[np.arange(len(all_scores)), top_columns].tolist()
+    top_justification = None
+    if not scores_only:
+        top_justification = [justifications[emotions[column]][row] for row, column in enumerate(top_columns)]
+
+    variances = None
+    if all(variance_column(e) in df.columns for e in emotions):
+        variances = np.column_stack([df[variance_column(e)].to_numpy(dtype=np.float64, na_value=np.nan)[keep]
+                                     for e in emotions])
+
+    base = {col: df[col].to_numpy(dtype=object)[keep].tolist() for col in BASE_COLUMNS}
+    return ParsedResults(base, emotions, scores, justifications, top_emotion, top_score, top_justification,
+                         variances)
+
+
+def low_confidence_flags(variances, max_variance):
+    """
+    The largest self-consistency variance of each row and whether it exceeds `max_variance`.
+
+    Args:
+        variances (np.ndarray): A (rows x emotions) variance matrix, NaN where unknown.
+        max_variance (float): The largest variance an emotion may have before its row is flagged.
+
+    Returns:
+        tuple: The per-row maximum variance (NaN for rows without statistics) and the boolean flags.
+    """
+    known = ~np.isnan(variances)
+    row_max = np.where(known, variances, -np.inf).max(axis=1, initial=-np.inf)
+    row_max[~known.any(axis=1)] = np.nan
+    return row_max, np.nan_to_num(row_max, nan=-np.inf) > max_variance
+
+
+def build_analysis_frames(parsed, threshold, max_variance=None):
+    """
+    Builds the Detailed_Analysis and Top_Emotion_Summary sheets from parsed results with array operations.
+    Results parsed with `scores_only` give sheets without justification columns.
+
+    Args:
+        parsed (ParsedResults): The output of `parse_model_responses` or `parse_score_columns`.
+        threshold (float): The cutoff score for classifying an emotion as present.
+        max_variance (float): If given and the results have self-consistency statistics, add the
+                              Max_Variance and Low_Confidence columns to the detailed sheet.
+
+    Returns:
+        tuple: The detailed and summary DataFrames, or (None, None) if there are no rows.
+    """
+    if not len(parsed):
+        return None, None
+
+    binary = parsed.scores >= threshold
+    # Label each distinct combination of present emotions once instead of once per row.
+    patterns, inverse = np.unique(binary, axis=0, return_inverse=True)
+    labels = [", ".join(e for e, is_present in zip(parsed.emotions, pattern) if is_present) or 'neutral'
+              for pattern in patterns]
+    final_classification = [labels[i] for i in inverse.reshape(-1)]
+
+    detailed = dict(parsed.base)
+    detailed['Final_Classification'] = final_classification
+    detailed['is_neutral'] = (~binary.any(axis=1)).astype(np.int64)
+    for column, emotion in enumerate(parsed.emotions):
+        detailed[f"{emotion}_binary"] = binary[:, column].astype(np.int64)
+        if parsed.justifications is not None:
+            detailed[f"{emotion}_justification"] = parsed.justifications[emotion]
+    if max_variance is not None and parsed.variances is not None:
+        detailed['Max_Variance'], low_confidence = low_confidence_flags(parsed.variances, max_variance)
+        detailed['Low_Confidence'] = low_confidence.astype(np.int64)
+
+    summary = dict(parsed.base)
+    summary['Top_Emotion'] = parsed.top_emotion
+    summary['Top_Score'] = parsed.top_score
+    if parsed.top_justification is not None:
+        summary['Top_Justification'] = parsed.top_justification
+    return pd.DataFrame(detailed), pd.DataFrame(summary)
+
+
+def build_analysis_frames_rowwise(df, threshold, max_variance=None, scores_only=False):
+    """
+    Row-by-row reference implementation of `build_analysis_frames`. It is used for responses whose
+    structure the vectorized path does not handle (e.g. scores given as strings) and as the
+    baseline of benchmark_result_processor.py.
+
+    Returns:
+        tuple: The detailed and summary DataFrames, or (None, None) if no row could be processed.
+    """
     # Lists to hold the data for our new sheets
     detailed_data = []
     summary_data = []
+    row_variances = []
     
     base_cols = ["ResponseID", "NewID", "Text"]
     
@@ -39,6 +354,7 @@ def process_results(file_path, threshold):
             # --- Prepare data for the Detailed_Analysis sheet ---
             detailed_row = {col: row[col] for col in base_cols}
             emotions_present = []
+            variances = []
             
             for emotion in EMOTION_CODEBOOK.keys():
                 emotion_data = analysis.get(emotion, {"score": 0.0, "justification": "N/A"})
@@ -46,7 +362,10 @@ def process_results(file_path, threshold):
                 
                 is_present = 1 if score >= threshold else 0
                 detailed_row[f"{emotion}_binary"] = is_present
-                detailed_row[f"{emotion}_justification"] = emotion_data.get("justification", "N/A")
+                if not scores_only:
+                    detailed_row[f"{emotion}_justification"] = emotion_data.get("justification", "N/A")
+                if emotion_data.get("variance") is not None:
+                    variances.append(float(emotion_data["variance"]))
                 
                 if is_present == 1:
                     emotions_present.append(emotion)
@@ -59,6 +378,7 @@ def process_results(file_path, threshold):
                 detailed_row['is_neutral'] = 0
 
             detailed_data.append(detailed_row)
+            row_variances.append(max(variances) if variances else np.nan)
 
             # --- Prepare data for the Top_Emotion_Summary sheet ---
             summary_row = {col: row[col] for col in base_cols}
@@ -77,7 +397,8 @@ def process_results(file_path, threshold):
 
             summary_row['Top_Emotion'] = top_emotion
             summary_row['Top_Score'] = top_score
-            summary_row['Top_Justification'] = top_justification
+            if not scores_only:
+                summary_row['Top_Justification'] = top_justification
             summary_data.append(summary_row)
             
         except (json.JSONDecodeError, TypeError) as e:
@@ -85,8 +406,7 @@ def process_results(file_path, threshold):
             continue
 
     if not detailed_data:
-        print("No data was processed. Exiting.")
-        return
+        return None, None
 
     # Create DataFrames for the new sheets
     detailed_df = pd.DataFrame(detailed_data)
@@ -96,33 +416,350 @@ def process_results(file_path, threshold):
     final_cols_order = base_cols + ['Final_Classification', 'is_neutral'] + \
                        [col for col in detailed_df.columns if col not in base_cols + ['Final_Classification', 'is_neutral']]
     detailed_df = detailed_df[final_cols_order]
+    if max_variance is not None and not all(np.isnan(row_variances)):
+        detailed_df['Max_Variance'] = row_variances
+        detailed_df['Low_Confidence'] = (np.nan_to_num(row_variances, nan=-np.inf) > max_variance).astype(np.int64)
+    return detailed_df, summary_df
+
+
+def _score_columns_to_read(file_path):
+    """The columns of a Parquet raw output needed without justifications: base, score and variance columns."""
+    import pyarrow.parquet as pq
+
+    emotions = list(EMOTION_CODEBOOK.keys())
+    columns = BASE_COLUMNS + [score_column(e) for e in emotions]
+    available = set(pq.read_schema(file_path).names)
+    if all(variance_column(e) in available for e in emotions):
+        columns += [variance_column(e) for e in emotions]
+    return columns
+
+
+def _load_parsed(file_path, coerce=False, scores_only=False):
+    """
+    Loads a raw output file and parses it. With `scores_only`, justifications are left out: the
+    justification columns of a Parquet file are not read at all.
+
+    Returns:
+        tuple: (df, parsed), where parsed is None if the responses need the row-by-row implementation,
+               or None if the file could not be read.
+    """
+    try:
+        # Parquet scores are read straight from their columns; only Excel output needs its JSON parsed.
+        if file_path.lower().endswith('.parquet'):
+            df = read_parquet_results(file_path, _score_columns_to_read(file_path) if scores_only else None)
+            print(f"✅ Successfully loaded '{file_path}'. Processing {len(df)} rows.")
+            return df, parse_score_columns(df, scores_only=scores_only)
+        df = load_raw_output(file_path)
+        print(f"✅ Successfully loaded '{file_path}'. Processing {len(df)} rows.")
+    except (FileNotFoundError, ValueError, OSError) as e:
+        print(f"❌ Error reading the Excel file or sheet: {e}")
+        return None
+    return df, parse_model_responses(df, coerce=coerce, scores_only=scores_only)
+
+
+def analysis_output_path(file_path):
+    """The workbook that result sheets are written to by default: `<raw output name>_analysis.xlsx`."""
+    return f"{os.path.splitext(file_path)[0]}_analysis.xlsx"
+
+
+def _write_sheets(file_path, sheets, in_place=False):
+    """
+    Writes DataFrames as sheets next to the raw output, replacing sheets with the same name.
+
+    By default the sheets are streamed into a separate workbook (`<name>_analysis.xlsx`), so the time
+    and memory needed do not depend on the size of the raw output. With `in_place`, they are appended
+    to the raw output workbook itself, which makes openpyxl load and rewrite every sheet in it. A
+    Parquet raw output always uses the separate workbook.
+    """
+    in_place = in_place and not file_path.lower().endswith('.parquet')
+    output_path = file_path if in_place else analysis_output_path(file_path)
 
     try:
-        # Use ExcelWriter to add multiple sheets to the same file
-        with pd.ExcelWriter(file_path, engine='openpyxl', mode='a', if_sheet_exists='replace') as writer:
-            # Write the detailed analysis sheet
-            detailed_sheet_name = f'Detailed_Analysis_T{str(threshold).replace(".", "")}'
-            detailed_df.to_excel(writer, sheet_name=detailed_sheet_name, index=False)
-            print(f"✅ Successfully added '{detailed_sheet_name}' sheet.")
-
-            # Write the top emotion summary sheet
-            summary_sheet_name = 'Top_Emotion_Summary'
-            summary_df.to_excel(writer, sheet_name=summary_sheet_name, index=False)
-            print(f"✅ Successfully added '{summary_sheet_name}' sheet.")
-
-        print(f"\nProcessing complete. All sheets saved to '{file_path}'.")
+        if in_place:
+            # Use ExcelWriter to add multiple sheets to the same file
+            with pd.ExcelWriter(output_path, engine='openpyxl', mode='a', if_sheet_exists='replace') as writer:
+                for sheet_name, sheet_df in sheets.items():
+                    sheet_df.to_excel(writer, sheet_name=sheet_name, index=False)
+        else:
+            # openpyxl's write-only mode is only needed once there is something to write.
+            from sheet_writer import write_sheets
+            write_sheets(output_path, sheets)
+        for sheet_name in sheets:
+            print(f"✅ Successfully added '{sheet_name}' sheet.")
+
+        print(f"\nProcessing complete. All sheets saved to '{output_path}'.")
     except Exception as e:
         print(f"❌ An error occurred while writing the new sheets to the Excel file: {e}")
 
 
+def process_results(file_path, threshold, in_place=False, max_variance=None, scores_only=False):
+    """
+    Reads a file with raw LLM output, processes it, and writes two sheets:
+    1. A detailed analysis with binary classifications for all emotions.
+    2. A summary sheet with only the top-scoring emotion.
+
+    The sheets are written to a workbook next to the raw output (`<name>_analysis.xlsx`). Sheets from
+    earlier runs with other thresholds are kept.
+    
+    Args:
+        file_path (str): The path to the input .xlsx or .parquet file.
+        threshold (float): The cutoff score for classifying an emotion as present (1) or not (0)
+                         in the detailed analysis sheet.
+        in_place (bool): Add the sheets to the raw output workbook itself instead (Excel input only).
+        max_variance (float): Flag rows where some emotion's self-consistency variance exceeds this
+                              value in a Low_Confidence column of the detailed sheet.
+        scores_only (bool): Leave the justifications out of both sheets. They are dropped as the raw
+                            output is parsed, which cuts memory use and the size of the workbook.
+    """
+    loaded = _load_parsed(file_path, scores_only=scores_only)
+    if loaded is None:
+        return
+    df, parsed = loaded
+
+    if parsed is not None:
+        detailed_df, summary_df = build_analysis_frames(parsed, threshold, max_variance)
+    else:
+        print("ℹ️ Some responses have an irregular structure. Falling back to row-by-row processing.")
+        detailed_df, summary_df = build_analysis_frames_rowwise(df, threshold, max_variance, scores_only)
+
+    if detailed_df is None:
+        print("No data was processed. Exiting.")
+        return
+    if max_variance is not None:
+        if 'Low_Confidence' not in detailed_df:
+            print("⚠️ The raw output has no self-consistency statistics (SELF_CONSISTENCY_SAMPLES was 1). "
+                  "Ignoring --max-variance.")
+        else:
+            print(f"ℹ️ {int(detailed_df['Low_Confidence'].sum())} of {len(detailed_df)} rows have a score "
+                  f"variance above {max_variance} and are flagged as Low_Confidence.")
+
+    detailed_sheet_name = f'Detailed_Analysis_T{str(threshold).replace(".", "")}'
+    _write_sheets(file_path, {detailed_sheet_name: detailed_df, 'Top_Emotion_Summary': summary_df}, in_place)
+
+
+def parse_threshold_range(text):
+    """
+    Parses a `start:stop:step` threshold range (stop included), e.g. "0.3:0.9:0.05".
+
+    Returns:
+        list: The thresholds, rounded to 10 decimals so that steps like 0.05 give 0.35 rather than 0.35000000000000003.
+    """
+    try:
+        start, stop, step = (float(part) for part in text.split(':'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{text}' is not a start:stop:step range, e.g. 0.3:0.9:0.05")
+    if step <= 0 or stop < start:
+        raise argparse.ArgumentTypeError(f"'{text}' needs a positive step and start <= stop")
+    count = int(math.floor((stop - start) / step + 1e-9)) + 1
+    return [round(start + i * step, 10) for i in range(count)]
+
+
+def load_labels(df, label_column, labels_file=None, labels_sheet=None):
+    """
+    Collects human-coded labels by NewID, from `label_column` of `labels_file` (any file ExcerptReader
+    can read) or, without a labels file, of the raw output itself.
+
+    Returns:
+        dict: NewID (as a string) -> label, or None if no labels were found.
+    """
+    if labels_file:
+        try:
+            reader = ExcerptReader(labels_file, labels_sheet)
+        except (FileNotFoundError, ValueError) as e:
+            print(f"❌ Error reading the labels file: {e}")
+            return None
+        try:
+            if label_column not in reader.columns or 'NewID' not in reader.columns:
+                print(f"⚠️ '{labels_file}' has no 'NewID' and '{label_column}' columns. Skipping precision/recall.")
+                return None
+            records = [record for chunk in reader.iter_chunks(['NewID', label_column], INPUT_CHUNK_SIZE)
+                       for record in chunk]
+        finally:
+            reader.close()
+    elif label_column in df.columns:
+        records = df[['NewID', label_column]].to_dict('records')
+    else:
+        return None
+
+    labels = {str(record['NewID']): record[label_column] for record in records
+              if not pd.isna(record[label_column]) and str(record[label_column]).strip()}
+    return labels or None
+
+
+def label_matrix(new_ids, labels, emotions):
+    """
+    Converts labels into a boolean (rows x emotions) matrix aligned with `new_ids`. A label is a
+    comma-separated list of emotions, e.g. "anger, sadness" or "neutral".
+
+    Returns:
+        tuple: The label matrix and a mask of the rows that have a label.
+    """
+    emotion_index = {emotion: i for i, emotion in enumerate(emotions)}
+    gold = np.zeros((len(new_ids), len(emotions)), dtype=bool)
+    labelled = np.zeros(len(new_ids), dtype=bool)
+    unknown = set()
+    for row, new_id in enumerate(new_ids):
+        label = labels.get(str(new_id))
+        if label is None:
+            continue
+        labelled[row] = True
+        for name in str(label).split(','):
+            name = name.strip().lower()
+            if name in emotion_index:
+                gold[row, emotion_index[name]] = True
+            elif name:
+                unknown.add(name)
+    if unknown:
+        print(f"⚠️ Ignoring labels that are not in the codebook: {', '.join(sorted(unknown))}")
+    return gold, labelled
+
+
+def _safe_ratio(numerator, denominator):
+    """Element-wise numerator / denominator, with 0.0 where the denominator is 0."""
+    return np.divide(numerator, denominator, out=np.zeros(numerator.shape), where=denominator > 0)
+
+
+def sweep_thresholds(parsed, thresholds, labels=None):
+    """
+    Classifies the parsed scores at every threshold in one vectorized pass.
+
+    Args:
+        parsed (ParsedResults): The parsed raw output.
+        thresholds (list): The thresholds to evaluate.
+        labels (dict): Optional NewID -> human-coded label, to score each threshold against.
+
+    Returns:
+        dict: Sheet name -> DataFrame. 'Threshold_Prevalence' holds the share of rows classified with
+              each emotion, 'Threshold_Neutral_Rate' the share with no emotion present and, when labels
+              are given, 'Threshold_Metrics' the per-emotion precision, recall and F1.
+    """
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    emotions = parsed.emotions
+    # (thresholds x rows x emotions)
+    predicted = parsed.scores[None, :, :] >= thresholds[:, None, None]
+    rows = len(parsed)
+
+    prevalence = pd.DataFrame(predicted.mean(axis=1), columns=emotions)
+    prevalence.insert(0, 'Threshold', thresholds)
+    neutral_counts = (~predicted.any(axis=2)).sum(axis=1)
+    neutral_rate = pd.DataFrame({
+        'Threshold': thresholds,
+        'Neutral_Count': neutral_counts,
+        'Rows': rows,
+        'Neutral_Rate': neutral_counts / rows,
+    })
+    sheets = {'Threshold_Prevalence': prevalence, 'Threshold_Neutral_Rate': neutral_rate}
+
+    if labels:
+        gold, labelled = label_matrix(parsed.base['NewID'], labels, emotions)
+        if labelled.any():
+            print(f"ℹ️ Scoring thresholds against {int(labelled.sum())} labelled rows.")
+            predicted_labelled = predicted[:, labelled, :]
+            gold = gold[labelled]
+            true_positives = (predicted_labelled & gold[None]).sum(axis=1)
+            predicted_counts = predicted_labelled.sum(axis=1)
+            support = np.broadcast_to(gold.sum(axis=0), true_positives.shape)
+            precision = _safe_ratio(true_positives, predicted_counts)
+            recall = _safe_ratio(true_positives, support)
+            f1 = _safe_ratio(2 * precision * recall, precision + recall)
+            metrics = pd.DataFrame({
+                'Threshold': np.repeat(thresholds, len(emotions)),
+                'Emotion': np.tile(emotions, len(thresholds)),
+                'Support': support.reshape(-1),
+                'Predicted': predicted_counts.reshape(-1),
+                'True_Positives': true_positives.reshape(-1),
+                'Precision': precision.reshape(-1),
+                'Recall': recall.reshape(-1),
+                'F1': f1.reshape(-1),
+            })
+            macro = pd.DataFrame({
+                'Threshold': thresholds,
+                'Emotion': 'macro_avg',
+                'Support': support.sum(axis=1),
+                'Predicted': predicted_counts.sum(axis=1),
+                'True_Positives': true_positives.sum(axis=1),
+                'Precision': precision.mean(axis=1),
+                'Recall': recall.mean(axis=1),
+                'F1': f1.mean(axis=1),
+            })
+            metrics = pd.concat([metrics, macro]).sort_values('Threshold', kind='stable').reset_index(drop=True)
+            sheets['Threshold_Metrics'] = metrics
+        else:
+            print("⚠️ None of the labelled NewIDs appear in the raw output. Skipping precision/recall.")
+    return sheets
+
+
+def process_threshold_sweep(file_path, thresholds, label_column=LABEL_COLUMN, labels_file=None, labels_sheet=None,
+                            in_place=False):
+    """
+    Parses a raw output file once and adds threshold sweep sheets: emotion prevalence and neutral rate
+    per threshold and, when human-coded labels are available, per-emotion precision, recall and F1.
+
+    Args:
+        file_path (str): The path to the input .xlsx or .parquet file.
+        thresholds (list): The thresholds to evaluate.
+        label_column (str): The column holding human-coded labels.
+        labels_file (str): A file with NewID and `label_column` columns, such as the coded validation
+                           set. Without it, the labels are looked for in the raw output.
+        labels_sheet (str): The worksheet of `labels_file` (Excel only).
+        in_place (bool): Add the sheets to the raw output workbook instead of `<name>_analysis.xlsx`.
+    """
+    # The sweep only needs the scores.
+    loaded = _load_parsed(file_path, coerce=True, scores_only=True)
+    if loaded is None:
+        return
+    df, parsed = loaded
+    if not len(parsed):
+        print("No data was processed. Exiting.")
+        return
+
+    labels = load_labels(df, label_column, labels_file, labels_sheet)
+    if labels is None:
+        print(f"ℹ️ No '{label_column}' labels found. Reporting prevalence and neutral rate only.")
+    sheets = sweep_thresholds(parsed, thresholds, labels)
+
+    print(f"\n{'Threshold':>9}  {'Neutral rate':>12}" + ("  Macro F1" if 'Threshold_Metrics' in sheets else ""))
+    for row in sheets['Threshold_Neutral_Rate'].itertuples():
+        line = f"{row.Threshold:>9.3f}  {row.Neutral_Rate:>12.1%}"
+        if 'Threshold_Metrics' in sheets:
+            metrics = sheets['Threshold_Metrics']
+            macro_f1 = metrics[(metrics['Threshold'] == row.Threshold) & (metrics['Emotion'] == 'macro_avg')]['F1'].iloc[0]
+            line += f"  {macro_f1:>8.3f}"
+        print(line)
+
+    _write_sheets(file_path, sheets, in_place)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Process LLM raw output to create detailed analysis and summary sheets.")
-    parser.add_argument("--file", type=str, required=True, help="Path to the Excel file with LLM raw output.")
-    parser.add_argument("--threshold", type=float, required=True, help="A cutoff score (e.g., 0.6) to classify an emotion as present.")
+    parser.add_argument("--file", type=str, required=True, help="Path to the Excel or Parquet file with LLM raw output.")
+    threshold_group = parser.add_mutually_exclusive_group(required=True)
+    threshold_group.add_argument("--threshold", type=float, help="A cutoff score (e.g., 0.6) to classify an emotion as present.")
+    threshold_group.add_argument("--thresholds", type=parse_threshold_range,
+                                 help="Sweep a range of thresholds given as start:stop:step (e.g., 0.3:0.9:0.05) "
+                                      "and report prevalence, neutral rate and, with labels, precision/recall/F1.")
+    parser.add_argument("--label-column", type=str, default=LABEL_COLUMN,
+                        help=f"Column with human-coded labels for the sweep (default: '{LABEL_COLUMN}').")
+    parser.add_argument("--labels-file", type=str, help="File with NewID and label columns, e.g. the coded validation set.")
+    parser.add_argument("--labels-sheet", type=str, default=SHEET_NAME, help="Worksheet of --labels-file.")
+    parser.add_argument("--in-place", action="store_true",
+                        help="Add the sheets to the raw output workbook instead of a separate <name>_analysis.xlsx. "
+                             "Slower for large files, as the whole workbook is rewritten.")
+    parser.add_argument("--scores-only", action="store_true",
+                        help="Leave the justifications out of the analysis sheets. Uses much less memory and "
+                             "writes a much smaller workbook for large outputs.")
+    parser.add_argument("--max-variance", type=float,
+                        help="Flag rows where the variance of some emotion's self-consistency samples exceeds "
+                             "this value (e.g., 0.02) in a Low_Confidence column. Requires output written "
+                             "with SELF_CONSISTENCY_SAMPLES > 1.")
     
     args = parser.parse_args()
     
-    process_results(args.file, args.threshold)
+    if args.thresholds is not None:
+        process_threshold_sweep(args.file, args.thresholds, args.label_column, args.labels_file, args.labels_sheet,
+                                args.in_place)
+    else:
+        process_results(args.file, args.threshold, args.in_place, args.max_variance, args.scores_only)
 
 if __name__ == "__main__":
     main()
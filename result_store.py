@@ -0,0 +1,134 @@
+# result_store.py
+
+import json
+
+# Columns that identify each row of the raw output.
+ID_COLUMNS = ["Row", "ResponseID", "NewID", "Text", "Duplicate_Of", "Scoring_Tier"]
+
+
+def score_column(emotion):
+    return f"{emotion}_score"
+
+
+def justification_column(emotion):
+    return f"{emotion}_justification"
+
+
+def variance_column(emotion):
+    return f"{emotion}_variance"
+
+
+def agreement_column(emotion):
+    return f"{emotion}_agreement"
+
+
+class ParquetResultWriter:
+    """
+    Writes raw model results to a Parquet file as they arrive, as an alternative to the Excel output.
+
+    Each emotion's score is a float32 column (`<emotion>_score`) and its justification a string column
+    (`<emotion>_justification`), so readers can load only the scores without parsing any JSON. Rows are
+    written in completion order; the `Row` column holds each row's position in the input sheet, and
+    `Duplicate_Of` the NewID whose analysis a duplicate row received, and `Scoring_Tier` whether the row
+    was scored locally or by the model. With `sample_stats`, the variance and agreement of each
+    emotion's self-consistency samples are stored in `<emotion>_variance` and `<emotion>_agreement`.
+    Results are buffered and flushed as one row group every `row_group_size` rows. `metadata` (bytes
+    keys and values) is stored in the file's schema, e.g. the fingerprints of an incremental run.
+
+    Requires pyarrow.
+    """
+    def __init__(self, path, emotions, row_group_size=10_000, sample_stats=False, metadata=None):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self.path = path
+        self.emotions = list(emotions)
+        self.row_group_size = row_group_size
+        self.schema = pa.schema(
+            [("Row", pa.int64()), ("ResponseID", pa.string()), ("NewID", pa.string()), ("Text", pa.string()),
+             ("Duplicate_Of", pa.string()), ("Scoring_Tier", pa.string())]
+            + [(score_column(e), pa.float32()) for e in self.emotions]
+            + [(justification_column(e), pa.string()) for e in self.emotions]
+            + ([(variance_column(e), pa.float32()) for e in self.emotions]
+               + [(agreement_column(e), pa.float32()) for e in self.emotions] if sample_stats else []),
+            metadata=metadata,
+        )
+        self.sample_stats = sample_stats
+        self._writer = pq.ParquetWriter(path, self.schema)
+        self._buffer = {name: [] for name in self.schema.names}
+        self.rows_written = 0
+
+    def write(self, row, response_id, new_id, text, analysis, duplicate_of=None, scoring_tier=None):
+        """
+        Adds one row. `analysis` is the model's analysis dictionary, or None if the row has no result,
+        `duplicate_of` the NewID the analysis was copied from, if any, and `scoring_tier` the tier that
+        scored it ("local" or "gemini").
+        """
+        buffer = self._buffer
+        buffer["Row"].append(row)
+        buffer["ResponseID"].append(_as_text(response_id))
+        buffer["NewID"].append(_as_text(new_id))
+        buffer["Text"].append(_as_text(text))
+        buffer["Duplicate_Of"].append(_as_text(duplicate_of))
+        buffer["Scoring_Tier"].append(_as_text(scoring_tier) if analysis else None)
+        for emotion in self.emotions:
+            entry = analysis.get(emotion) if isinstance(analysis, dict) else None
+            entry = entry if isinstance(entry, dict) else {}
+            score = entry.get("score")
+            buffer[score_column(emotion)].append(_as_float(score))
+            buffer[justification_column(emotion)].append(entry.get("justification"))
+            if self.sample_stats:
+                buffer[variance_column(emotion)].append(_as_float(entry.get("variance")))
+                buffer[agreement_column(emotion)].append(_as_float(entry.get("agreement")))
+        if len(buffer["Row"]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer["Row"]:
+            return
+        table = self._pa.Table.from_pydict(self._buffer, schema=self.schema)
+        self._writer.write_table(table)
+        self.rows_written += table.num_rows
+        self._buffer = {name: [] for name in self.schema.names}
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+
+def _as_float(value):
+    return float(value) if isinstance(value, (int, float)) else None
+
+
+def _as_text(value):
+    if value is None or value != value:  # None or NaN
+        return None
+    return str(value)
+
+
+def read_parquet_results(path, columns=None):
+    """Reads a raw Parquet output back into a DataFrame in input row order."""
+    import pandas as pd
+
+    df = pd.read_parquet(path, columns=columns if columns is None or "Row" in columns else ["Row"] + list(columns))
+    return df.sort_values("Row", kind="stable").reset_index(drop=True)
+
+
+def analysis_from_row(row, emotions):
+    """Rebuilds the Model_Response JSON of one Parquet row, or None if the row has no scores."""
+    analysis = {}
+    for emotion in emotions:
+        score = row.get(score_column(emotion))
+        if score is None or score != score:
+            continue
+        entry = {"score": round(float(score), 6)}
+        justification = row.get(justification_column(emotion))
+        if justification is not None:
+            entry["justification"] = justification
+        for field, column in (("variance", variance_column(emotion)), ("agreement", agreement_column(emotion))):
+            value = row.get(column)
+            if value is not None and value == value:
+                entry[field] = round(float(value), 6)
+        analysis[emotion] = entry
+    return json.dumps(analysis) if analysis else None
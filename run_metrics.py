@@ -0,0 +1,186 @@
+# run_metrics.py
+
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# The metrics record of the batch being processed on the current thread, if any.
+_current = threading.local()
+# Helper threads of a batch (see `use_metrics`) may add to the same record at the same time.
+_update_lock = threading.Lock()
+
+
+def add_metrics(**values):
+    """Adds numeric values to the current batch's metrics record. Does nothing outside `RunMetrics.batch`."""
+    record = getattr(_current, "record", None)
+    if record is None:
+        return
+    with _update_lock:
+        for name, value in values.items():
+            record[name] = record.get(name, 0) + value
+
+
+def set_metrics(**values):
+    """Sets values in the current batch's metrics record. Does nothing outside `RunMetrics.batch`."""
+    record = getattr(_current, "record", None)
+    if record is not None:
+        record.update(values)
+
+
+def current_metrics():
+    """The metrics record open on the current thread, or None; hand it to helper threads with `use_metrics`."""
+    return getattr(_current, "record", None)
+
+
+@contextmanager
+def use_metrics(record):
+    """Makes `record` (from `current_metrics`) the current thread's metrics record for the duration of the block."""
+    previous = getattr(_current, "record", None)
+    _current.record = record
+    try:
+        yield
+    finally:
+        _current.record = previous
+
+
+def percentile(values, q):
+    """The q-th percentile (0-100) of `values` with linear interpolation, or None if there are no values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class RunMetrics:
+    """
+    Collects one metrics record per batch and writes each as a line of JSON as soon as the batch ends.
+
+    A record is opened with `batch()` around the work for one batch. While it is open, the client and
+    scheduler running on the same thread add their measurements to it with `add_metrics` and
+    `set_metrics`: API calls and retries, rate-limit waits, time to first chunk, latency, token usage
+    from the response's usage metadata, parse time, and rows recovered by retries.
+    """
+    def __init__(self, path=None, clock=time.perf_counter, max_records=None):
+        """
+        Args:
+            path (str): The JSONL file to append records to, or None to keep them in memory only.
+            max_records (int): Keep only this many of the latest records in memory (None keeps all), so a
+                               long-running service summarizes its recent batches without growing.
+        """
+        self.path = path
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8') if path else None
+        self.records = deque(maxlen=max_records) if max_records else []
+
+    @contextmanager
+    def batch(self, **fields):
+        """Opens the metrics record for one batch on the current thread and emits it when the block ends."""
+        record = {"event": "batch", **fields}
+        previous = getattr(_current, "record", None)
+        _current.record = record
+        started = self._clock()
+        try:
+            yield record
+        except BaseException as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            record["total_s"] = self._clock() - started
+            for name, value in record.items():
+                if isinstance(value, float):
+                    record[name] = round(value, 4)
+            _current.record = previous
+            self.emit(record)
+
+    def emit(self, record):
+        with self._lock:
+            self.records.append(record)
+            if self._file is not None:
+                self._file.write(json.dumps(record, default=str) + "\n")
+                self._file.flush()
+
+    def summary(self, job=None, rows=None, elapsed=None):
+        """
+        Summarizes the batch records (of one job, if given).
+
+        Args:
+            job (str): Only include the batches of this job.
+            rows (int): Rows processed, for the rows/sec rate (default: the rows sent to the API).
+            elapsed (float): Wall-clock seconds of the run, for the rows/sec rate.
+
+        Returns:
+            dict: Batch count, latency and queue-wait percentiles, retries, token totals and rates.
+        """
+        with self._lock:
+            batches = [r for r in self.records if r.get("event") == "batch" and (job is None or r.get("job") == job)]
+
+        def total(name):
+            return sum(r.get(name, 0) for r in batches)
+
+        # Records of whole phases (a batch prediction job, the dead-letter retry) are left out of the latencies.
+        latencies = [r["total_s"] for r in batches if "phase" not in r]
+        first_chunk = [r["time_to_first_chunk_s"] for r in batches if "time_to_first_chunk_s" in r]
+        queue_waits = [r["queue_wait_s"] for r in batches if "queue_wait_s" in r]
+        rows_sent = total("excerpts")
+        rows = rows_sent if rows is None else rows
+        tokens = total("prompt_tokens") + total("output_tokens")
+        summary = {
+            "event": "summary",
+            "job": job,
+            "batches": len(latencies),
+            "rows_sent": rows_sent,
+            "api_calls": total("api_calls"),
+            "retries": total("retries"),
+            "rows_recovered": total("rows_recovered"),
+            "failed_batches": sum(1 for r in batches if "error" in r),
+            "latency_p50_s": percentile(latencies, 50),
+            "latency_p95_s": percentile(latencies, 95),
+            "latency_p99_s": percentile(latencies, 99),
+            "first_chunk_p50_s": percentile(first_chunk, 50),
+            "first_chunk_p95_s": percentile(first_chunk, 95),
+            "queue_wait_p50_s": percentile(queue_waits, 50),
+            "queue_wait_p95_s": percentile(queue_waits, 95),
+            "rate_limit_wait_s": round(total("rate_limit_wait_s"), 4),
+            "parse_s": round(total("parse_s"), 4),
+            "prompt_tokens": total("prompt_tokens"),
+            "output_tokens": total("output_tokens"),
+            "cached_tokens": total("cached_tokens"),
+            "tokens_per_row": tokens / rows_sent if rows_sent else None,
+            "rows": rows,
+            "elapsed_s": round(elapsed, 3) if elapsed is not None else None,
+            "rows_per_s": rows / elapsed if rows is not None and elapsed else None,
+        }
+        return summary
+
+    def report(self, job=None, rows=None, elapsed=None):
+        """Prints the summary of the run (or of one job) and appends it to the metrics file."""
+        summary = self.summary(job=job, rows=rows, elapsed=elapsed)
+        self.emit(summary)
+
+        def fmt(value, spec=".2f", unit="s"):
+            return "n/a" if value is None else format(value, spec) + unit
+
+        prefix = f"[{job}] " if job else ""
+        print(f"\n📊 {prefix}Run metrics: {summary['batches']} batches, {summary['api_calls']} API calls, "
+              f"{summary['retries']} retries, {summary['rows_recovered']} rows recovered by retries.")
+        print(f"   Batch latency p50/p95/p99: {fmt(summary['latency_p50_s'])} / {fmt(summary['latency_p95_s'])} / "
+              f"{fmt(summary['latency_p99_s'])}; time to first chunk p50: {fmt(summary['first_chunk_p50_s'])}; "
+              f"queue wait p95: {fmt(summary['queue_wait_p95_s'])}.")
+        print(f"   {fmt(summary['rows_per_s'], '.1f', ' rows/sec')}, {fmt(summary['tokens_per_row'], '.0f', ' tokens/row')} "
+              f"({summary['prompt_tokens']} input, {summary['output_tokens']} output, "
+              f"{summary['cached_tokens']} cached); {fmt(summary['rate_limit_wait_s'])} waiting on rate limits, "
+              f"{fmt(summary['parse_s'])} parsing.")
+        if self.path:
+            print(f"   Per-batch metrics: {self.path}")
+        return summary
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
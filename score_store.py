@@ -0,0 +1,210 @@
+# score_store.py
+
+import json
+from collections.abc import Mapping
+
+import numpy as np
+
+# Optional fields of an analysis entry besides the score, in the order they are written back.
+_STAT_FIELDS = ("variance", "agreement", "samples")
+_NO_STATS = (None,) * len(_STAT_FIELDS)
+
+
+class ScoreStore(Mapping):
+    """
+    The analyses of a run, keyed by NewID, held as arrays instead of one JSON string per row.
+
+    Scores (and self-consistency statistics, once an analysis carries them) are float32 matrices
+    with one row per excerpt and one column per codebook emotion, NaN where an emotion is missing.
+    Justifications are interned: each distinct text is stored once in a side table and the matrix
+    holds its ID (-1 for none). Duplicates, locally scored rows and near-duplicate copies share
+    their justifications instead of repeating them.
+
+    Reading an item returns the analysis as a JSON string, so the store can stand in for the
+    NewID -> JSON dictionary that it replaces. Like the Parquet output, scores are read back
+    rounded to 6 decimals. An analysis the arrays cannot hold exactly (an unknown emotion, entries
+    out of codebook order, extra fields, or a score that does not survive float32) is kept as its
+    JSON string instead.
+    """
+    def __init__(self, emotions, capacity=1024):
+        """
+        Args:
+            emotions (list): The codebook emotions, in column order.
+            capacity (int): Rows allocated up front; the arrays double in size when full.
+        """
+        self.emotions = list(emotions)
+        self._column = {emotion: column for column, emotion in enumerate(self.emotions)}
+        capacity = max(1, capacity)
+        self._scores = np.full((capacity, len(self.emotions)), np.nan, dtype=np.float32)
+        self._justification_ids = np.full((capacity, len(self.emotions)), -1, dtype=np.int32)
+        self._stats = None
+        self._row_of = {}
+        self._free_rows = []
+        self._rows_used = 0
+        self.justifications = []
+        self._justification_id = {}
+        self._overflow = {}
+
+    def __len__(self):
+        return len(self._row_of) + len(self._overflow)
+
+    def __iter__(self):
+        yield from self._row_of
+        yield from self._overflow
+
+    def __contains__(self, new_id):
+        return new_id in self._row_of or new_id in self._overflow
+
+    def __getitem__(self, new_id):
+        if new_id in self._overflow:
+            return self._overflow[new_id]
+        return json.dumps(self._analysis_at(self._row_of[new_id]))
+
+    def analysis(self, new_id):
+        """The analysis of `new_id` as a dictionary, or None if the store has none."""
+        if new_id in self._overflow:
+            return json.loads(self._overflow[new_id])
+        row = self._row_of.get(new_id)
+        return self._analysis_at(row) if row is not None else None
+
+    def add(self, new_id, analysis):
+        """Stores the analysis dictionary of `new_id`, replacing any earlier one."""
+        packed = self._pack(analysis)
+        if packed is None:
+            self._release(new_id)
+            self._overflow[new_id] = json.dumps(analysis)
+            return
+        self._overflow.pop(new_id, None)
+        row = self._row_of.get(new_id)
+        if row is None:
+            row = self._new_row()
+            self._row_of[new_id] = row
+        columns, scores, justifications, stats = packed
+        self._scores[row] = np.nan
+        self._scores[row, columns] = scores
+        self._justification_ids[row] = -1
+        self._justification_ids[row, columns] = [self._intern(text) for text in justifications]
+        if stats is not None or self._stats is not None:
+            self._ensure_stats()[row] = np.nan
+            if stats is not None:
+                self._stats[row, columns] = stats
+
+    def nbytes(self):
+        """Approximate bytes held by the arrays and the distinct justification texts."""
+        arrays = self._scores.nbytes + self._justification_ids.nbytes
+        if self._stats is not None:
+            arrays += self._stats.nbytes
+        return (arrays + sum(len(text) for text in self.justifications)
+                + sum(len(text) for text in self._overflow.values()))
+
+    def _pack(self, analysis):
+        """The columns, scores, justifications and statistics of an analysis, or None if it does not fit."""
+        if not isinstance(analysis, dict):
+            return None
+        columns, scores, justifications, stats = [], [], [], []
+        has_stats = False
+        previous_column = -1
+        for emotion, entry in analysis.items():
+            column = self._column.get(emotion)
+            if column is None or column <= previous_column or not isinstance(entry, dict):
+                return None
+            previous_column = column
+            score = entry.get("score")
+            if type(score) not in (int, float):
+                return None
+            justification = entry.get("justification")
+            if justification is not None and type(justification) is not str:
+                return None
+            extra_fields = len(entry) - 1 - (justification is not None)
+            entry_stats = _NO_STATS
+            if extra_fields:
+                entry_stats = [entry.get(field) for field in _STAT_FIELDS]
+                if extra_fields != sum(value is not None for value in entry_stats):
+                    return None
+                if any(value is not None and type(value) not in (int, float) for value in entry_stats):
+                    return None
+                has_stats = True
+            columns.append(column)
+            scores.append(score)
+            justifications.append(justification)
+            stats.append(entry_stats)
+
+        packed_scores = np.array(scores, dtype=np.float32)
+        if not _survives_float32(scores, packed_scores):
+            return None
+        packed_stats = None
+        if has_stats:
+            originals = [value for entry_stats in stats for value in entry_stats]
+            packed_stats = np.array([np.nan if value is None else value for value in originals], dtype=np.float32)
+            if not _survives_float32(originals, packed_stats):
+                return None
+            packed_stats = packed_stats.reshape(len(columns), len(_STAT_FIELDS))
+        return columns, packed_scores, justifications, packed_stats
+
+    def _analysis_at(self, row):
+        analysis = {}
+        scores = self._scores[row].tolist()
+        justification_ids = self._justification_ids[row].tolist()
+        stats = self._stats[row].tolist() if self._stats is not None else None
+        for column, score in enumerate(scores):
+            if score != score:  # NaN: the emotion is missing
+                continue
+            entry = {"score": round(score, 6)}
+            if justification_ids[column] >= 0:
+                entry["justification"] = self.justifications[justification_ids[column]]
+            if stats is not None:
+                for field, value in zip(_STAT_FIELDS, stats[column]):
+                    if value == value:
+                        entry[field] = int(value) if field == "samples" else round(value, 6)
+            analysis[self.emotions[column]] = entry
+        return analysis
+
+    def _intern(self, text):
+        if text is None:
+            return -1
+        text_id = self._justification_id.get(text)
+        if text_id is None:
+            text_id = self._justification_id[text] = len(self.justifications)
+            self.justifications.append(text)
+        return text_id
+
+    def _new_row(self):
+        if self._free_rows:
+            return self._free_rows.pop()
+        if self._rows_used == len(self._scores):
+            self._grow()
+        self._rows_used += 1
+        return self._rows_used - 1
+
+    def _release(self, new_id):
+        row = self._row_of.pop(new_id, None)
+        if row is not None:
+            self._free_rows.append(row)
+
+    def _grow(self):
+        capacity = 2 * len(self._scores)
+        self._scores = _resized(self._scores, capacity, np.nan)
+        self._justification_ids = _resized(self._justification_ids, capacity, -1)
+        if self._stats is not None:
+            self._stats = _resized(self._stats, capacity, np.nan)
+
+    def _ensure_stats(self):
+        if self._stats is None:
+            self._stats = np.full(self._scores.shape + (len(_STAT_FIELDS),), np.nan, dtype=np.float32)
+        return self._stats
+
+
+def _resized(array, capacity, fill):
+    resized = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+    resized[:len(array)] = array
+    return resized
+
+
+def _survives_float32(values, packed):
+    """True if every value other than None reads back unchanged from float32 at 6 decimals."""
+    for value, stored in zip(values, packed.tolist()):
+        if value is None:
+            continue
+        if value != value or round(stored, 6) != value:
+            return False
+    return True
@@ -0,0 +1,63 @@
+# self_consistency.py
+
+
+def aggregate_samples(samples, threshold=0.5):
+    """
+    Combines several samples of the validated results of one batch into one result per excerpt.
+
+    Each emotion's entry holds the mean `score` of the samples, the `justification` of the sample whose
+    score is closest to the mean (if the samples have justifications), the population `variance` of the
+    scores, the `agreement` rate (the share of samples on the majority side of `threshold`) and the
+    number of `samples` that answered.
+
+    Args:
+        samples (list): One list of results ({"NewID": ..., "analysis": ...}) per sample.
+        threshold (float): The score the agreement rate is measured against.
+
+    Returns:
+        list: One result per excerpt answered by at least one sample, in order of first appearance.
+    """
+    analyses_by_id = {}
+    for results in samples:
+        for result in results:
+            new_id, analyses = analyses_by_id.setdefault(str(result["NewID"]), (result["NewID"], []))
+            analyses.append(result["analysis"])
+
+    aggregated = []
+    for new_id, analyses in analyses_by_id.values():
+        analysis = {}
+        for emotion in analyses[0]:
+            entries = [sample[emotion] for sample in analyses if emotion in sample]
+            scores = [entry["score"] for entry in entries]
+            mean = sum(scores) / len(scores)
+            present = sum(score >= threshold for score in scores)
+            closest = min(entries, key=lambda entry: abs(entry["score"] - mean))
+            entry = {"score": round(mean, 4)}
+            if "justification" in closest:
+                entry["justification"] = closest["justification"]
+            entry["variance"] = round(sum((score - mean) ** 2 for score in scores) / len(scores), 4)
+            entry["agreement"] = round(max(present, len(scores) - present) / len(scores), 4)
+            entry["samples"] = len(scores)
+            analysis[emotion] = entry
+        aggregated.append({"NewID": new_id, "analysis": analysis})
+    return aggregated
+
+
+def samples_agree(samples, excerpts_batch, max_spread):
+    """
+    True if every sample answered every excerpt of the batch and, for each excerpt and emotion, the
+    scores of the samples lie within `max_spread` of each other, so further samples are unlikely to
+    change the result.
+    """
+    if len(samples) < 2:
+        return False
+    expected = {str(excerpt["NewID"]) for excerpt in excerpts_batch}
+    by_sample = [{str(result["NewID"]): result["analysis"] for result in results} for results in samples]
+    if any(set(analyses) != expected for analyses in by_sample):
+        return False
+    for new_id in expected:
+        for emotion, entry in by_sample[0][new_id].items():
+            scores = [analyses[new_id][emotion]["score"] for analyses in by_sample if emotion in analyses[new_id]]
+            if len(scores) < len(samples) or max(scores) - min(scores) > max_spread:
+                return False
+    return True
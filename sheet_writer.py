@@ -0,0 +1,68 @@
+# sheet_writer.py
+
+import os
+
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+
+
+def write_sheets(output_path, sheets):
+    """
+    Writes DataFrames as sheets of `output_path` using openpyxl's write-only mode, which streams rows
+    to disk instead of building the whole workbook in memory.
+
+    If the workbook already exists, its other sheets are streamed across unchanged and sheets with the
+    same name as a new one are replaced in place. The workbook is written to a temporary file first
+    and then moved over the old one, so an interrupted write never leaves a corrupt file behind.
+
+    Args:
+        output_path (str): The .xlsx file to write.
+        sheets (dict): Sheet name -> DataFrame, written without the index.
+    """
+    temp_path = f"{output_path}.tmp"
+    workbook = openpyxl.Workbook(write_only=True)
+    existing = openpyxl.load_workbook(output_path, read_only=True) if os.path.exists(output_path) else None
+    try:
+        pending = dict(sheets)
+        if existing is not None:
+            for name in existing.sheetnames:
+                if name in pending:
+                    _write_frame(workbook.create_sheet(name), pending.pop(name))
+                else:
+                    _copy_sheet(workbook.create_sheet(name), existing[name])
+        for name, df in pending.items():
+            _write_frame(workbook.create_sheet(name), df)
+        workbook.save(temp_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finally:
+        if existing is not None:
+            existing.close()
+    os.replace(temp_path, output_path)
+
+
+def _write_frame(worksheet, df):
+    header_font = Font(bold=True)
+    header = []
+    for name in df.columns:
+        cell = WriteOnlyCell(worksheet, value=str(name))
+        cell.font = header_font
+        header.append(cell)
+    worksheet.append(header)
+    columns = [_cell_values(df.iloc[:, i]) for i in range(df.shape[1])]
+    for row in zip(*columns):
+        worksheet.append(row)
+
+
+def _cell_values(series):
+    """A column's values as plain Python objects, with missing values as empty cells."""
+    values = series.astype(object)
+    return values.where(series.notna(), None).tolist()
+
+
+def _copy_sheet(worksheet, source):
+    for row in source.iter_rows(values_only=True):
+        worksheet.append(row)
@@ -0,0 +1,129 @@
+# stream_parser.py
+
+import json
+import re
+
+# Characters that change the parser's state outside and inside JSON strings.
+_STRUCTURAL = re.compile(r'[{}\[\]",]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+_ELEMENT_START = re.compile(r'[^\s,]')
+
+
+class StreamingJSONArrayParser:
+    """
+    Incrementally extracts the elements of a top-level JSON array from streamed text.
+
+    Text is fed chunk by chunk as it arrives; `feed` returns every element completed by that chunk,
+    already decoded. Anything before the opening '[' (such as a ```json fence) is skipped. An element
+    that fails to decode is counted in `errors` and skipped without affecting its neighbours, and an
+    element cut off by a truncated stream is simply never returned.
+    """
+    def __init__(self):
+        self.started = False     # The opening '[' has been seen.
+        self.finished = False    # The closing ']' has been seen.
+        self.errors = 0          # Elements that were complete but not valid JSON.
+        self._in_element = False
+        self._in_string = False
+        self._skip_escaped = False
+        self._depth = 0
+        self._pieces = []
+        self._element_start = 0
+
+    @property
+    def has_partial_element(self):
+        """True if an element was started but the stream ended before it was complete."""
+        return self._in_element
+
+    def feed(self, text):
+        """
+        Consumes the next chunk of streamed text.
+
+        Returns:
+            list: The array elements completed within this chunk, decoded from JSON.
+        """
+        completed = []
+        pos = 0
+        n = len(text)
+        if self._skip_escaped and n:
+            # The previous chunk ended on a backslash inside a string; skip the escaped character.
+            self._skip_escaped = False
+            pos = 1
+
+        while pos < n and not self.finished:
+            if not self.started:
+                idx = text.find('[', pos)
+                if idx < 0:
+                    return completed
+                self.started = True
+                pos = idx + 1
+                continue
+
+            if not self._in_element:
+                match = _ELEMENT_START.search(text, pos)
+                if match is None:
+                    break
+                if text[match.start()] == ']':
+                    self.finished = True
+                    break
+                self._in_element = True
+                self._element_start = match.start()
+                self._pieces = []
+                self._depth = 0
+                pos = match.start()
+
+            if self._in_string:
+                match = _STRING_SPECIAL.search(text, pos)
+                if match is None:
+                    pos = n
+                    break
+                i = match.start()
+                if text[i] == '\\':
+                    if i + 1 >= n:
+                        self._skip_escaped = True
+                        pos = n
+                        break
+                    pos = i + 2
+                    continue
+                self._in_string = False
+                pos = i + 1
+                if self._depth == 0:
+                    self._end_element(text, pos, completed)
+                continue
+
+            match = _STRUCTURAL.search(text, pos)
+            if match is None:
+                pos = n
+                break
+            i = match.start()
+            char = text[i]
+            pos = i + 1
+            if char == '"':
+                self._in_string = True
+            elif char in '{[':
+                self._depth += 1
+            elif char in '}]':
+                if self._depth == 0:
+                    # The array's closing bracket right after a scalar element.
+                    self._end_element(text, i, completed)
+                    self.finished = True
+                    break
+                self._depth -= 1
+                if self._depth == 0:
+                    self._end_element(text, pos, completed)
+            elif self._depth == 0:
+                # A comma ending a scalar element.
+                self._end_element(text, i, completed)
+
+        if self._in_element:
+            self._pieces.append(text[self._element_start:])
+            self._element_start = 0
+        return completed
+
+    def _end_element(self, text, end, completed):
+        element_text = "".join(self._pieces) + text[self._element_start:end]
+        self._in_element = False
+        self._pieces = []
+        try:
+            completed.append(json.loads(element_text))
+        except json.JSONDecodeError:
+            self.errors += 1
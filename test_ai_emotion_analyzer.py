@@ -1,16 +1,43 @@
 import unittest
 import os
+import shutil
+import numpy as np
 import pandas as pd
 import json
+import gzip
+import re
+import importlib.util
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
 from unittest.mock import patch, MagicMock
 
 # Import the functions to be tested
 # Note: To make these imports work, ensure your config.py and other scripts are in the same directory
 # or accessible via your PYTHONPATH.
-from ai_emotion_analyzer import process_spreadsheet
-from results_processor import process_results
+from ai_emotion_analyzer import (process_spreadsheet, excerpt_cache_key, plan_batches, EmotionClassifierClient,
+                                 load_manifest, run_manifest, plan_spreadsheet, prompt_fingerprint, main as analyzer_main)
+from batch_scheduler import BatchScheduler
+from checkpoint_journal import CheckpointJournal
+from response_cache import ResponseCache
+from input_reader import ExcerptReader
+from batch_prediction import BatchPredictionJob, LocalBatchRunner
+from run_metrics import RunMetrics, percentile
+from fake_genai import FakeGenAIClient
+from benchmark_analyzer import make_input_sheet
+from prompt_logger import read_log_entries, read_static_record
+from local_scorer import LexiconScorer, LinearScorer
+from score_store import ScoreStore
+from emotion_service import MicroBatcher, create_server
+from result_processor import (process_results, build_analysis_frames, build_analysis_frames_rowwise, parse_model_responses,
+                               parse_threshold_range, process_threshold_sweep, analysis_output_path)
 import config
 
+HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
 class TestEmotionAnalysisWorkflow(unittest.TestCase):
 
     def setUp(self):
@@ -81,7 +108,8 @@ class TestEmotionAnalysisWorkflow(unittest.TestCase):
 
         # --- Execution ---
         # Run the spreadsheet processing function
-        process_spreadsheet(self.test_spreadsheet_path, mock_instance)
+        with patch('ai_emotion_analyzer.OUTPUT_DIR', self.output_dir):
+            process_spreadsheet(self.test_spreadsheet_path, mock_instance)
 
         # --- Assertions ---
         # Check that the output directory contains exactly one file
@@ -103,7 +131,7 @@ class TestEmotionAnalysisWorkflow(unittest.TestCase):
 
     def test_02_results_processing(self):
         """
-        Test the second script (results_processor.py).
+        Test the second script (result_processor.py).
         It should read a raw output file and generate summary sheets.
         """
         # --- Test Setup ---
@@ -130,7 +158,8 @@ class TestEmotionAnalysisWorkflow(unittest.TestCase):
 
         # --- Assertions ---
         # Load the processed file and check the new sheets
-        xls = pd.ExcelFile(raw_output_path)
+        analysis_path = os.path.join(self.output_dir, "test_raw_output_analysis.xlsx")
+        xls = pd.ExcelFile(analysis_path)
         self.assertIn(f'Detailed_Analysis_T05', xls.sheet_names)
         self.assertIn('Top_Emotion_Summary', xls.sheet_names)
 
@@ -145,6 +174,1165 @@ class TestEmotionAnalysisWorkflow(unittest.TestCase):
         self.assertEqual(df_summary.iloc[0]['Top_Emotion'], 'enjoyment')
         self.assertEqual(df_summary.iloc[0]['Top_Score'], 0.9)
 
+        # The raw workbook is left untouched, and a second threshold adds its sheet next to the first.
+        process_results(raw_output_path, 0.95)
+        self.assertEqual(pd.ExcelFile(raw_output_path).sheet_names, ['LLM_Raw_Output'])
+        self.assertEqual(pd.ExcelFile(analysis_path).sheet_names,
+                         ['Detailed_Analysis_T05', 'Top_Emotion_Summary', 'Detailed_Analysis_T095'])
+        df_detailed = pd.read_excel(analysis_path, sheet_name='Detailed_Analysis_T095')
+        self.assertEqual(df_detailed.iloc[0]['Final_Classification'], 'neutral')
+
+        # With in_place, the sheets are added to the raw workbook as before.
+        process_results(raw_output_path, test_threshold, in_place=True)
+        self.assertIn('Detailed_Analysis_T05', pd.ExcelFile(raw_output_path).sheet_names)
+
+    def test_03_concurrent_batch_dispatch(self):
+        """
+        Batches should run concurrently up to the configured limit while the output keeps the input row order.
+        """
+        ids = [f"test_id_{i:02d}" for i in range(12)]
+        pd.DataFrame({
+            "ResponseID": list(range(12)),
+            "NewID": ids,
+            "Text": [f"Excerpt number {i}" for i in range(12)]
+        }).to_excel(self.test_spreadsheet_path, sheet_name=config.SHEET_NAME, index=False)
+
+        state = {"in_flight": 0, "peak": 0}
+        lock = threading.Lock()
+
+        class SlowClient:
+            def classify_batch(self, excerpts_batch, batch_num, total_batches):
+                with lock:
+                    state["in_flight"] += 1
+                    state["peak"] = max(state["peak"], state["in_flight"])
+                # Later batches finish first so results arrive out of order.
+                time.sleep(0.02 * (7 - batch_num))
+                with lock:
+                    state["in_flight"] -= 1
+                return [{"NewID": e["NewID"], "analysis": {"anger": {"score": 0.1, "justification": e["NewID"]}}}
+                        for e in excerpts_batch]
+
+        with patch('ai_emotion_analyzer.BATCH_SIZE', 2), patch('ai_emotion_analyzer.OUTPUT_DIR', self.output_dir):
+            process_spreadsheet(self.test_spreadsheet_path, SlowClient(), max_concurrent_batches=3)
+
+        self.assertGreater(state["peak"], 1)
+        self.assertLessEqual(state["peak"], 3)
+
+        output_file_path = os.path.join(self.output_dir, os.listdir(self.output_dir)[0])
+        df_out = pd.read_excel(output_file_path, sheet_name='LLM_Raw_Output')
+        self.assertEqual(list(df_out['NewID']), ids)
+        justifications = [json.loads(r)['anger']['justification'] for r in df_out['Model_Response']]
+        self.assertEqual(justifications, ids)
+
+    def test_04_retry_scheduler_recovers_failed_batches(self):
+        """
+        Retryable errors should be retried with backoff, and batches that fail every attempt should be
+        retried from the dead-letter queue at the end of the run.
+        """
+        ids = [f"test_id_{i:02d}" for i in range(6)]
+        pd.DataFrame({
+            "ResponseID": list(range(6)),
+            "NewID": ids,
+            "Text": [f"Excerpt number {i}" for i in range(6)]
+        }).to_excel(self.test_spreadsheet_path, sheet_name=config.SHEET_NAME, index=False)
+
+        class QuotaError(Exception):
+            code = 429
+
+        class FlakyClient:
+            """Fails batch 1 twice with a quota error and batch 2 with a timeout on every call until the final retry."""
+            def __init__(self):
+                self.calls = {}
+
+            def classify_batch(self, excerpts_batch, batch_num, total_batches):
+                self.calls[batch_num] = self.calls.get(batch_num, 0) + 1
+                if batch_num == 1 and self.calls[batch_num] <= 2:
+                    raise QuotaError("429 RESOURCE_EXHAUSTED")
+                if batch_num == 2 and self.calls[batch_num] <= 3:
+                    raise TimeoutError("stream dropped")
+                return [{"NewID": e["NewID"], "analysis": {"fear": {"score": 0.5, "justification": "ok"}}}
+                        for e in excerpts_batch]
+
+        delays = []
+        client = FlakyClient()
+        scheduler = BatchScheduler(client, requests_per_minute=1000, max_retries=2,
+                                   base_delay=1.0, max_delay=4.0, sleep=delays.append)
+
+        with patch('ai_emotion_analyzer.BATCH_SIZE', 2), patch('ai_emotion_analyzer.OUTPUT_DIR', self.output_dir):
+            process_spreadsheet(self.test_spreadsheet_path, client, max_concurrent_batches=1, scheduler=scheduler)
+
+        self.assertEqual(client.calls, {1: 3, 2: 4, 3: 1})
+        self.assertEqual(scheduler.dead_letters, [])
+        # Backoff delays double from the base delay, with jitter of up to half the delay.
+        self.assertTrue(all(0.5 <= d <= 4.0 for d in delays))
+
+        output_file_path = os.path.join(self.output_dir, os.listdir(self.output_dir)[0])
+        df_out = pd.read_excel(output_file_path, sheet_name='LLM_Raw_Output')
+        self.assertTrue(df_out['Model_Response'].notna().all())
+
+    def test_05_resume_from_checkpoint_journal(self):
+        """
+        A resumed run should skip journaled excerpts, journal the new ones and still write every row.
+        """
+        ids = [f"test_id_{i:02d}" for i in range(4)]
+        pd.DataFrame({
+            "ResponseID": list(range(4)),
+            "NewID": ids,
+            "Text": [f"Excerpt number {i}" for i in range(4)]
+        }).to_excel(self.test_spreadsheet_path, sheet_name=config.SHEET_NAME, index=False)
+
+        journal_path = os.path.join(self.input_dir, "checkpoint.jsonl")
+        with open(journal_path, 'w', encoding='utf-8') as f:
+            for new_id in ids[:2]:
+                f.write(json.dumps({"NewID": new_id, "analysis": {"sadness": {"score": 0.7, "justification": "journaled"}}}) + '\n')
+            f.write('{"NewID": "test_id_02", "anal')  # torn write from a crash
+
+        mock_client = MagicMock()
+        mock_client.classify_batch.side_effect = lambda batch, batch_num, total: [
+            {"NewID": e["NewID"], "analysis": {"sadness": {"score": 0.1, "justification": "fresh"}}} for e in batch
+        ]
+
+        journal = CheckpointJournal(journal_path, resume=True)
+        with patch('ai_emotion_analyzer.OUTPUT_DIR', self.output_dir):
+            process_spreadsheet(self.test_spreadsheet_path, mock_client, journal=journal)
+        journal.close()
+
+        sent_ids = [e["NewID"] for call in mock_client.classify_batch.call_args_list for e in call.args[0]]
+        self.assertEqual(sent_ids, ids[2:])
+
+        output_file_path = os.path.join(self.output_dir, os.listdir(self.output_dir)[0])
+        df_out = pd.read_excel(output_file_path, sheet_name='LLM_Raw_Output')
+        justifications = [json.loads(r)['sadness']['justification'] for r in df_out['Model_Response']]
+        self.assertEqual(justifications, ["journaled", "journaled", "fresh", "fresh"])
+
+        self.assertEqual(set(CheckpointJournal(journal_path, resume=True).completed), set(ids))
+
+    def test_06_response_cache_and_duplicates(self):
+        """
+        Cached excerpts should not be sent, identical excerpts should be sent once, and a rerun should
+        be answered entirely from the cache.
+        """
+        texts = ["3 year wait list", "Cached answer", "3 year wait list", "A new answer"]
+        ids = [f"test_id_{i:02d}" for i in range(4)]
+        pd.DataFrame({"ResponseID": list(range(4)), "NewID": ids, "Text": texts}).to_excel(
+            self.test_spreadsheet_path, sheet_name=config.SHEET_NAME, index=False)
+
+        cache = ResponseCache(os.path.join(self.input_dir, "cache.sqlite"), max_entries=10)
+        cache.put_many({excerpt_cache_key("Cached answer"): json.dumps({"fear": {"score": 0.8, "justification": "cached"}})})
+
+        mock_client = MagicMock()
+        mock_client.classify_batch.side_effect = lambda batch, batch_num, total: [
+            {"NewID": e["NewID"], "analysis": {"fear": {"score": 0.2, "justification": e["Text"]}}} for e in batch
+        ]
+
+        with patch('ai_emotion_analyzer.OUTPUT_DIR', self.output_dir):
+            process_spreadsheet(self.test_spreadsheet_path, mock_client, cache=cache)
+
+        sent_texts = sorted(e["Text"] for call in mock_client.classify_batch.call_args_list for e in call.args[0])
+        self.assertEqual(sent_texts, ["3 year wait list", "A new answer"])
+
+        output_file_path = os.path.join(self.output_dir, os.listdir(self.output_dir)[0])
+        df_out = pd.read_excel(output_file_path, sheet_name='LLM_Raw_Output')
+        justifications = [json.loads(r)['fear']['justification'] for r in df_out['Model_Response']]
+        self.assertEqual(justifications, ["3 year wait list", "cached", "3 year wait list", "A new answer"])
+        self.assertEqual(len(cache), 3)
+
+        mock_client.classify_batch.reset_mock()
+        with patch('ai_emotion_analyzer.OUTPUT_DIR', self.output_dir):
+            process_spreadsheet(self.test_spreadsheet_path, mock_client, cache=cache)
+        mock_client.classify_batch.assert_not_called()
+        cache.close()
+
+    def test_06b_cache_keys_follow_the_client_settings(self):
+        """
+        Clients built with different output or sampling settings should not share cache entries: a
+        scores-only client's answers must not be served to a client that asks for justifications.
+        """
+        pd.DataFrame({"ResponseID": [1, 2], "NewID": ["a", "b"], "Text": ["Happy", "Sad"]}).to_excel(
+            self.test_spreadsheet_path, sheet_name=config.SHEET_NAME, index=False)
+
+        def client(**settings):
+            return EmotionClassifierClient(os.path.join(self.output_dir, 'prompt_log.txt'), log_verbosity="off",
+                                           genai_client=FakeGenAIClient(latency=0), **settings)
+
+        full, lean, sampled = client(scores_only=False), client(scores_only=True), client(samples=3)
+        fingerprints = {c.prompt_fingerprint for c in (full, lean, sampled, full.for_question("Another question?"))}
+        self.assertEqual(len(fingerprints), 4)
+        sampled.close()
+        # A client with the config.py settings matches the default fingerprint.
+        self.assertEqual(full.prompt_fingerprint, prompt_fingerprint())
+
+        cache = ResponseCache(os.path.join(self.input_dir, "cache.sqlite"), max_entries=10)
+        for name, classifier_client in (("lean", lean), ("full", full)):
+            raw_output = process_spreadsheet(self.test_spreadsheet_path, classifier_client, cache=cache,
+                                             output_dir=self.output_dir, output_name=name)
+            classifier_client.close()
+        cache.close()
+        self.assertEqual(lean.client.excerpts, 2)
+        self.assertEqual(full.client.excerpts, 2)
+        analyses = [json.loads(r) for r in pd.read_excel(raw_output)["Model_Response"]]
+        self.assertTrue(all("justification" in entry for analysis in analyses for entry in analysis.values()))
+
+    def test_07_streaming_input_reader(self):
+        """
+        The reader should stream only the required columns in chunks, from Excel and CSV alike.
+        """
+        frame = pd.DataFrame({
+            "ResponseID": [1, 2, 3, 4, 5],
+            "NewID": ["a", "b", "c", "d", "e"],
+            "Text": ["One", None, "Three", "Four", "Five"],
+            "Unused": ["x"] * 5
+        })
+        frame.to_excel(self.test_spreadsheet_path, sheet_name=config.SHEET_NAME, index=False)
+        csv_path = os.path.join(self.input_dir, "input.csv")
+        frame.to_csv(csv_path, index=False)
+
+        columns = ["ResponseID", "NewID", "Text"]
+        for path in (self.test_spreadsheet_path, csv_path):
+            reader = ExcerptReader(path, sheet_name=config.SHEET_NAME)
+            chunks = list(reader.iter_chunks(columns, chunk_size=2))
+            reader.close()
+            self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+            self.assertEqual(list(chunks[0][0]), columns)
+            self.assertEqual([r["ResponseID"] for chunk in chunks for r in chunk], [1, 2, 3, 4, 5])
+
+        with self.assertRaises(ValueError):
+            ExcerptReader(self.test_spreadsheet_path, sheet_name="No Such Sheet")
+
+        mock_client = MagicMock()
+        mock_client.classify_batch.side_effect = lambda batch, batch_num, total: [
+            {"NewID": e["NewID"], "analysis": {"anger": {"score": 0.1, "justification": "..."}}} for e in batch
+        ]
+        with patch('ai_emotion_analyzer.INPUT_CHUNK_SIZE', 2), patch('ai_emotion_analyzer.OUTPUT_DIR', self.output_dir):
+            process_spreadsheet(csv_path, mock_client)
+
+        output_file_path = os.path.join(self.output_dir, os.listdir(self.output_dir)[0])
+        df_out = pd.read_excel(output_file_path, sheet_name='LLM_Raw_Output')
+        self.assertEqual(list(df_out['NewID']), ["a", "b", "c", "d", "e"])
+        self.assertEqual(list(df_out['Model_Response'].isna()), [False, True, False, False, False])
+
+    @unittest.skipUnless(HAS_PYARROW, "pyarrow is required for Parquet output")
+    def test_08_parquet_raw_output(self):
+        """
+        The Parquet backend should store typed score columns for every row and feed result_processor.
+        """
+        pd.DataFrame({
+            "ResponseID": [1, 2, 3],
+            "NewID": ["a", "b", "c"],
+            "Text": ["Happy", None, "Sad"]
+        }).to_excel(self.test_spreadsheet_path, sheet_name=config.SHEET_NAME, index=False)
+
+        mock_client = MagicMock()
+        mock_client.classify_batch.side_effect = lambda batch, batch_num, total: [
+            {"NewID": e["NewID"], "analysis": {
+                "enjoyment": {"score": 0.9 if e["Text"] == "Happy" else 0.1, "justification": e["Text"]},
+                "sadness": {"score": 0.8 if e["Text"] == "Sad" else 0.0, "justification": e["Text"]},
+            }} for e in batch
+        ]
+        with patch('ai_emotion_analyzer.RAW_OUTPUT_FORMAT', 'parquet'), \
+             patch('ai_emotion_analyzer.EXPORT_EXCEL', False), \
+             patch('ai_emotion_analyzer.OUTPUT_DIR', self.output_dir):
+            process_spreadsheet(self.test_spreadsheet_path, mock_client)
+
+        output_files = os.listdir(self.output_dir)
+        self.assertEqual(len(output_files), 1)
+        parquet_path = os.path.join(self.output_dir, output_files[0])
+        self.assertTrue(parquet_path.endswith('.parquet'))
+
+        df_out = pd.read_parquet(parquet_path).sort_values("Row")
+        self.assertEqual(list(df_out["NewID"]), ["a", "b", "c"])
+        self.assertEqual(str(df_out["enjoyment_score"].dtype), "float32")
+        self.assertTrue(pd.isna(df_out.iloc[1]["enjoyment_score"]))
+        self.assertEqual(df_out.iloc[2]["sadness_justification"], "Sad")
+
+        process_results(parquet_path, 0.5)
+        analysis_path = parquet_path.replace('.parquet', '_analysis.xlsx')
+        df_summary = pd.read_excel(analysis_path, sheet_name='Top_Emotion_Summary')
+        self.assertEqual(list(df_summary['Top_Emotion']), ['enjoyment', 'sadness'])
+
+        # Without justifications, the same classifications are written from the score columns alone.
+        process_results(parquet_path, 0.5, scores_only=True)
+        df_summary = pd.read_excel(analysis_path, sheet_name='Top_Emotion_Summary')
+        self.assertEqual(list(df_summary['Top_Emotion']), ['enjoyment', 'sadness'])
+        self.assertNotIn('Top_Justification', df_summary.columns)
+        df_detailed = pd.read_excel(analysis_path, sheet_name='Detailed_Analysis_T05')
+        self.assertFalse(any(col.endswith('_justification') for col in df_detailed.columns))
+
+
+    @patch('google.genai.Client')
+    def test_09_batch_prediction_backend(self, MockGenAIClient):
+        """
+        With a batch prediction job, every batch should go into one request file, the output file should be
+        parsed like an online response, and excerpts missing from it should be sent online.
+        """
+        pd.DataFrame({
+            "ResponseID": [1, 2, 3],
+            "NewID": ["a", "b", "c"],
+            "Text": ["Happy", "Sad", "Angry"]
+        }).to_excel(self.test_spreadsheet_path, sheet_name=config.SHEET_NAME, index=False)
+
+        def item(new_id):
+            return {"NewID": new_id, "analysis": {
+                emotion: {"score": 0.7, "justification": "..."} for emotion in config.EMOTION_CODEBOOK
+            }}
+
+        def respond(request):
+            prompt = request["contents"][0]["parts"][0]["text"]
+            # The fake job leaves out excerpt "c".
+            return json.dumps([item(new_id) for new_id in ("a", "b") if f'"NewID": "{new_id}"' in prompt])
+
+        genai_client = MockGenAIClient.return_value
+        genai_client.models.generate_content_stream.return_value = iter([MagicMock(text=json.dumps([item("c")]))])
+        client = EmotionClassifierClient(os.path.join(self.output_dir, 'prompt_log.txt'), use_response_schema=True)
+        job = BatchPredictionJob(client, LocalBatchRunner(respond), self.output_dir, name="job")
+
+        with patch('ai_emotion_analyzer.OUTPUT_DIR', self.output_dir), patch('ai_emotion_analyzer.BATCH_SIZE', 2):
+            process_spreadsheet(self.test_spreadsheet_path, client, scheduler=BatchScheduler(client), batch_job=job)
+
+        with open(job.request_path) as f:
+            requests = [json.loads(line) for line in f]
+        self.assertEqual(len(requests), 2)
+        self.assertIn("responseSchema", requests[0]["request"]["generationConfig"])
+        self.assertIn("systemInstruction", requests[0]["request"])
+        # Only the excerpt missing from the job's output was sent online.
+        online_prompt = genai_client.models.generate_content_stream.call_args.kwargs["contents"][0]
+        self.assertIn('"NewID": "c"', online_prompt)
+        self.assertNotIn('"NewID": "a"', online_prompt)
+
+        output_file = [f for f in os.listdir(self.output_dir) if f.startswith('llm_raw_output_')][0]
+        df_out = pd.read_excel(os.path.join(self.output_dir, output_file))
+        self.assertEqual(df_out['Model_Response'].notna().sum(), 3)
+
+    def test_10_manifest_runs_jobs_with_shared_client(self):
+        """
+        Manifest jobs should share one client, scheduler and cache while each uses its own question and
+        writes its own output and journal.
+        """
+        with pd.ExcelWriter(self.test_spreadsheet_path) as writer:
+            pd.DataFrame({"ResponseID": [1, 2], "NewID": ["c1", "c2"], "Text": ["Too few staff", "Same text"]}) \
+                .to_excel(writer, sheet_name="Concerns", index=False)
+            pd.DataFrame({"ResponseID": [3], "NewID": ["h1"], "Text": ["Long waits"]}) \
+                .to_excel(writer, sheet_name="Challenges", index=False)
+        pd.DataFrame({"ResponseID": [4], "NewID": ["s1"], "Text": ["Same text"]}) \
+            .to_csv(os.path.join(self.input_dir, "survey.csv"), index=False)
+        manifest_path = os.path.join(self.input_dir, "jobs.json")
+        with open(manifest_path, "w") as f:
+            json.dump([
+                {"file": config.SPREADSHEET_FILENAME, "sheet": "Concerns", "question": "What concerns you?"},
+                {"file": config.SPREADSHEET_FILENAME, "sheet": "Challenges", "question": "What is hard?"},
+                {"file": "survey.csv", "question": "Anything else?", "name": "survey"},
+            ], f)
+
+        calls = []
+
+        class FakeClient:
+            def __init__(self, question=None):
+                self.question = question
+
+            def for_question(self, question):
+                return FakeClient(question)
+
+            def classify_batch(self, excerpts_batch, batch_num, total_batches):
+                calls.append((self.question, [e["NewID"] for e in excerpts_batch]))
+                return [{"NewID": e["NewID"], "analysis": {"enjoyment": {"score": 0.5, "justification": self.question}}}
+                        for e in excerpts_batch]
+
+        cache = ResponseCache(os.path.join(self.output_dir, "cache.sqlite"), max_entries=100)
+        self.addCleanup(cache.close)
+        with patch('ai_emotion_analyzer.INPUT_DIR', self.input_dir), \
+             patch('ai_emotion_analyzer.OUTPUT_DIR', self.output_dir):
+            jobs = load_manifest(manifest_path)
+            client = FakeClient()
+            outputs = run_manifest(jobs, client, scheduler=BatchScheduler(client), cache=cache)
+
+        self.assertEqual([job["name"] for job in jobs], ["Full_Data_Uncoded_Concerns", "Full_Data_Uncoded_Challenges", "survey"])
+        self.assertEqual(sorted(question for question, _ in calls), ["Anything else?", "What concerns you?", "What is hard?"])
+        # The same text under another question is not answered from the cache.
+        self.assertIn(("Anything else?", ["s1"]), calls)
+        for job in jobs:
+            self.assertTrue(os.path.exists(os.path.join(self.output_dir, f"checkpoint_{job['name']}.jsonl")))
+            df_out = pd.read_excel(outputs[job["name"]])
+            justifications = {json.loads(r)["enjoyment"]["justification"] for r in df_out["Model_Response"]}
+            self.assertEqual(justifications, {job["question"]})
+
+    def test_11_end_to_end_with_simulated_backend(self):
+        """
+        Against the simulated backend's errors and truncated streams, every excerpt should still end up
+        with a complete analysis, both in the raw output and in the processed sheets.
+        """
+        make_input_sheet(self.test_spreadsheet_path, 200)
+        fake = FakeGenAIClient(latency=0, error_rate=0.2, truncation_rate=0.3, seed=1)
+        client = EmotionClassifierClient(os.path.join(self.output_dir, 'prompt_log.txt'), log_verbosity="off",
+                                         genai_client=fake)
+        scheduler = BatchScheduler(client, max_retries=10, sleep=lambda delay: None)
+        raw_output = process_spreadsheet(self.test_spreadsheet_path, client, scheduler=scheduler,
+                                         output_dir=self.output_dir)
+        client.close()
+
+        self.assertGreater(fake.errors, 0)
+        self.assertGreater(fake.truncations, 0)
+        df_out = pd.read_excel(raw_output)
+        self.assertEqual(len(df_out), 200)
+        for response in df_out["Model_Response"]:
+            self.assertEqual(sorted(json.loads(response)), sorted(config.EMOTION_CODEBOOK))
+        process_results(raw_output, 0.6)
+        detailed = pd.read_excel(analysis_output_path(raw_output), sheet_name='Detailed_Analysis_T06')
+        self.assertEqual(len(detailed), 200)
+
+    def test_12_near_duplicates_are_classified_once(self):
+        """
+        Near-identical excerpts, even in different input chunks, should be sent once and share the
+        representative's analysis, while excerpts that differ in a number or in substance are sent separately.
+        """
+        texts = ["3 year wait list", "No", "3-Year wait list!", "2 year wait list", "no.",
+                 "I am happy with the care arrangements now", "Im happy with the care arrangements now",
+                 "I am not happy with the care arrangements"]
+        ids = [f"n{i}" for i in range(len(texts))]
+        pd.DataFrame({"ResponseID": range(len(texts)), "NewID": ids, "Text": texts}).to_excel(
+            self.test_spreadsheet_path, sheet_name=config.SHEET_NAME, index=False)
+        sent = []
+
+        class RecordingClient:
+            def classify_batch(self, excerpts_batch, batch_num, total_batches):
+                sent.extend(e["NewID"] for e in excerpts_batch)
+                return [{"NewID": e["NewID"], "analysis": {"anger": {"score": 0.1, "justification": e["NewID"]}}}
+                        for e in excerpts_batch]
+
+        with patch('ai_emotion_analyzer.INPUT_CHUNK_SIZE', 3), patch('ai_emotion_analyzer.NEAR_DUPLICATE_THRESHOLD', 0.9):
+            raw_output = process_spreadsheet(self.test_spreadsheet_path, RecordingClient(), output_dir=self.output_dir)
+
+        self.assertEqual(sorted(sent), ["n0", "n1", "n3", "n5", "n7"])
+        df_out = pd.read_excel(raw_output)
+        duplicate_of = dict(zip(df_out["NewID"], df_out["Duplicate_Of"].fillna("")))
+        self.assertEqual(duplicate_of, {"n0": "", "n1": "", "n2": "n0", "n3": "", "n4": "n1",
+                                        "n5": "", "n6": "n5", "n7": ""})
+        source = [json.loads(r)["anger"]["justification"] for r in df_out["Model_Response"]]
+        self.assertEqual(source, ["n0", "n1", "n0", "n3", "n1", "n5", "n5", "n7"])
+
+    def test_13_local_scorer_handles_confident_excerpts(self):
+        """
+        Excerpts the local scorer is confident about should be scored without an API call, every row
+        should record its scoring tier, and the tier should survive a resumed run.
+        """
+        texts = ["Yes", "I am so worried about the wait list", "N/A", "3 year wait list", "yes"]
+        ids = [f"l{i}" for i in range(len(texts))]
+        pd.DataFrame({"ResponseID": range(len(texts)), "NewID": ids, "Text": texts}).to_excel(
+            self.test_spreadsheet_path, sheet_name=config.SHEET_NAME, index=False)
+        sent = []
+
+        class RecordingClient:
+            def classify_batch(self, excerpts_batch, batch_num, total_batches):
+                sent.extend(e["NewID"] for e in excerpts_batch)
+                return [{"NewID": e["NewID"], "analysis": {"fear": {"score": 0.8, "justification": "Worried."}}}
+                        for e in excerpts_batch]
+
+        journal_path = os.path.join(self.output_dir, "checkpoint.jsonl")
+        journal = CheckpointJournal(journal_path)
+        raw_output = process_spreadsheet(self.test_spreadsheet_path, RecordingClient(), journal=journal,
+                                         output_dir=self.output_dir, local_scorer=LexiconScorer.from_codebook())
+        journal.close()
+
+        self.assertEqual(sent, ["l1"])
+        df_out = pd.read_excel(raw_output)
+        self.assertEqual(df_out["Scoring_Tier"].tolist(), ["local", "gemini", "local", "local", "local"])
+        local_yes = json.loads(df_out["Model_Response"][0])
+        self.assertEqual(local_yes["neutral"]["score"], 0.9)
+        self.assertEqual(local_yes["anger"]["score"], 0.0)
+        self.assertIn("Scored locally", local_yes["neutral"]["justification"])
+        self.assertEqual(json.loads(df_out["Model_Response"][3])["anger"]["score"], 0.9)
+
+        # A resumed run keeps each row's tier without scoring or sending anything again.
+        journal = CheckpointJournal(journal_path, resume=True)
+        self.addCleanup(journal.close)
+        resumed = process_spreadsheet(self.test_spreadsheet_path, RecordingClient(), journal=journal,
+                                      output_dir=self.output_dir)
+        self.assertEqual(sent, ["l1"])
+        self.assertEqual(pd.read_excel(resumed)["Scoring_Tier"].tolist(), df_out["Scoring_Tier"].tolist())
+
+    def test_14_incremental_run_rescores_only_what_changed(self):
+        """
+        Against a previous output, only new and edited rows should be classified in full, and an edited
+        codebook entry should be re-scored on its own with a reduced prompt and merged into the old analyses.
+        """
+        texts = ["The wait list is long", "We feel supported", "Nothing to add", "Therapy helps a lot",
+                 "I worry about school", "The staff are kind", "The wait list is long"]
+        ids = [f"r{i}" for i in range(len(texts))]
+
+        def write_input(texts, ids):
+            pd.DataFrame({"ResponseID": range(len(texts)), "NewID": ids, "Text": texts}).to_excel(
+                self.test_spreadsheet_path, sheet_name=config.SHEET_NAME, index=False)
+
+        def run(name, previous=None):
+            fake = FakeGenAIClient(latency=0, seed=len(name))
+            prompts = []
+            stream = fake.models.generate_content_stream
+
+            def recording_stream(model, contents, config=None):
+                prompts.append(contents[0])
+                return stream(model, contents, config)
+
+            fake.models.generate_content_stream = recording_stream
+            client = EmotionClassifierClient(os.path.join(self.output_dir, f'prompt_log_{name}.txt'),
+                                             log_verbosity="batches", genai_client=fake)
+            raw_output = process_spreadsheet(self.test_spreadsheet_path, client, output_dir=self.output_dir,
+                                             output_name=name, previous_output=previous)
+            client.close()
+            df_out = pd.read_excel(raw_output)
+            return raw_output, {new_id: json.loads(r) for new_id, r in zip(df_out["NewID"], df_out["Model_Response"])}, prompts
+
+        write_input(texts, ids)
+        first_output, first, _ = run("first")
+        self.assertIn("Run_Fingerprints", pd.ExcelFile(first_output).sheet_names)
+
+        # Edit one row, append another and change the definition of one emotion.
+        write_input(texts[:2] + ["Nothing more to add"] + texts[3:] + ["A new answer"], ids + ["r7"])
+        fear = {**config.EMOTION_CODEBOOK["fear"], "description": "An edited definition of fear."}
+        with patch.dict(config.EMOTION_CODEBOOK, {"fear": fear}):
+            second_output, second, prompts = run("second", previous=first_output)
+            third_output, third, third_prompts = run("third", previous=second_output)
+
+        full_prompts = [p for p in prompts if '"anger"' in p]
+        rescore_prompts = [p for p in prompts if '"anger"' not in p]
+        sent_in_full = sorted(new_id for p in full_prompts for new_id in re.findall(r'"NewID": "(r\d+)"', p))
+        rescored = sorted(new_id for p in rescore_prompts for new_id in re.findall(r'"NewID": "(r\d+)"', p))
+        self.assertEqual(sent_in_full, ["r2", "r7"])
+        # The duplicate r6 shares r0's re-scoring.
+        self.assertEqual(rescored, ["r0", "r1", "r3", "r4", "r5"])
+        self.assertTrue(all("An edited definition of fear." in p and '"sadness"' not in p for p in rescore_prompts))
+
+        for new_id in ["r0", "r1", "r3", "r4", "r5", "r6"]:
+            self.assertEqual(list(second[new_id]), list(config.EMOTION_CODEBOOK))
+            for emotion in config.EMOTION_CODEBOOK:
+                if emotion != "fear":
+                    self.assertEqual(second[new_id][emotion], first[new_id][emotion])
+        self.assertEqual(second["r6"]["fear"], second["r0"]["fear"])
+        self.assertEqual(sorted(second["r7"]), sorted(config.EMOTION_CODEBOOK))
+
+        # The prompt log shows the reduced prompt the re-scored rows were sent with.
+        index_path = os.path.join(self.output_dir, "prompt_log_second.index.jsonl")
+        rescore_entry, = read_log_entries(index_path, "r0")
+        self.assertEqual(rescore_entry["prompt_id"], "emotions:fear")
+        static = read_static_record(index_path, rescore_entry["prompt_id"])
+        self.assertIn("An edited definition of fear.", static["prompt_suffix"])
+        self.assertNotIn('"anger"', static["prompt_suffix"])
+        self.assertNotIn("prompt_id", read_log_entries(index_path, "r7")[0])
+
+        # Nothing changed since the second run, so the third sends nothing.
+        self.assertEqual(third_prompts, [])
+        self.assertEqual(third, second)
+
+        # Reused rows keep the provenance columns a full run writes.
+        for output in (first_output, second_output, third_output):
+            duplicate_of = pd.read_excel(output).set_index("NewID")["Duplicate_Of"]
+            self.assertEqual(duplicate_of["r6"], "r0")
+            self.assertTrue(duplicate_of.drop("r6").isna().all())
+
+    def test_15_repeated_items_in_a_response_are_dropped(self):
+        """
+        A response that repeats an excerpt's item should keep only its first answer, so an incremental run
+        that merges re-scored emotions into the previous analyses still completes.
+        """
+        pd.DataFrame({"ResponseID": [1, 2, 3], "NewID": ["r0", "r1", "r2"],
+                      "Text": ["The wait list is long", "We feel supported", "Therapy helps a lot"]}).to_excel(
+            self.test_spreadsheet_path, sheet_name=config.SHEET_NAME, index=False)
+
+        def run(name, previous=None):
+            fake = FakeGenAIClient(latency=0)
+            stream = fake.models.generate_content_stream
+
+            def repeating_stream(model, contents, config=None):
+                items = json.loads("".join(chunk.text for chunk in stream(model, contents, config)))
+                return iter([MagicMock(text=json.dumps(items + items[:1]), usage_metadata=None)])
+
+            fake.models.generate_content_stream = repeating_stream
+            client = EmotionClassifierClient(os.path.join(self.output_dir, 'prompt_log.txt'), log_verbosity="off",
+                                             genai_client=fake)
+            raw_output = process_spreadsheet(self.test_spreadsheet_path, client, output_dir=self.output_dir,
+                                             output_name=name, previous_output=previous)
+            client.close()
+            df_out = pd.read_excel(raw_output)
+            return raw_output, {new_id: json.loads(r) for new_id, r in zip(df_out["NewID"], df_out["Model_Response"])}
+
+        first_output, first = run("first")
+        fear = {**config.EMOTION_CODEBOOK["fear"], "description": "An edited definition of fear."}
+        with patch.dict(config.EMOTION_CODEBOOK, {"fear": fear}):
+            _, second = run("second", previous=first_output)
+
+        self.assertEqual(sorted(second), ["r0", "r1", "r2"])
+        for new_id, analysis in second.items():
+            self.assertEqual(list(analysis), list(config.EMOTION_CODEBOOK))
+            self.assertEqual(analysis["anger"], first[new_id]["anger"])
+
+class TestBatchPlanner(unittest.TestCase):
+
+    def test_batches_fill_token_budget(self):
+        """
+        Short excerpts should share a batch, long ones should be split off, and no batch should exceed its budgets.
+        """
+        excerpts = [{"NewID": f"short_{i}", "Text": "Yes"} for i in range(30)]
+        excerpts += [{"NewID": f"long_{i}", "Text": "word " * 800} for i in range(3)]
+        excerpts.append({"NewID": "huge", "Text": "word " * 5000})
+
+        batches = plan_batches(excerpts, token_budget=2000, max_batch_size=25, max_output_tokens=8192)
+
+        planned_ids = [e["NewID"] for batch in batches for e in batch]
+        self.assertEqual(sorted(planned_ids), sorted(e["NewID"] for e in excerpts))
+        self.assertTrue(all(len(batch) <= 25 for batch in batches))
+        # The 30 one-word answers need only two calls instead of six at five per batch; the first is
+        # capped by the expected response size rather than the input budget.
+        short_batches = [b for b in batches if any(e["NewID"].startswith("short") for e in b)]
+        self.assertEqual(len(short_batches), 2)
+        self.assertEqual(len(short_batches[0]), 18)
+        # A single excerpt over the budget is sent on its own rather than dropped.
+        self.assertIn([excerpts[-1]], batches)
+
+        long_first = [excerpts[30]] + excerpts[:30]
+        by_length = plan_batches(long_first, token_budget=2000, max_batch_size=25, sort_by_length=True)
+        in_order = plan_batches(long_first, token_budget=2000, max_batch_size=25, sort_by_length=False)
+        self.assertEqual(by_length[0][0]["NewID"], "short_0")
+        self.assertEqual(in_order[0][0]["NewID"], "long_0")
+
+
+class TestEmotionClassifierClient(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = 'test_logs'
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.log_file_path = os.path.join(self.log_dir, 'prompt_log.txt')
+
+    def tearDown(self):
+        for name in os.listdir(self.log_dir):
+            os.remove(os.path.join(self.log_dir, name))
+        os.rmdir(self.log_dir)
+
+    @staticmethod
+    def _stream(text):
+        return iter([MagicMock(text=text)])
+
+    @staticmethod
+    def _item(new_id, score=0.4):
+        """A well-formed response item covering every emotion in the codebook."""
+        return json.dumps({"NewID": new_id, "analysis": {
+            emotion: {"score": score, "justification": "..."} for emotion in config.EMOTION_CODEBOOK
+        }})
+
+    @patch('google.genai.Client')
+    def test_context_cache_replaces_inline_codebook(self, MockGenAIClient):
+        """
+        With context caching, requests should reference the cached codebook instead of repeating it.
+        """
+        genai_client = MockGenAIClient.return_value
+        genai_client.caches.create.return_value = MagicMock()
+        genai_client.caches.create.return_value.name = "cachedContents/123"
+        genai_client.models.generate_content_stream.return_value = self._stream(f"[{self._item('a')}]")
+
+        client = EmotionClassifierClient(self.log_file_path, use_context_cache=True)
+        results = client.classify_batch([{"NewID": "a", "Text": "That so scary"}], 1, 1)
+
+        self.assertEqual(results[0]["NewID"], "a")
+        call = genai_client.models.generate_content_stream.call_args
+        self.assertNotIn("CODEBOOK:", call.kwargs["contents"][0])
+        self.assertEqual(call.kwargs["config"].cached_content, "cachedContents/123")
+        self.assertIsNone(call.kwargs["config"].system_instruction)
+
+        client.close()
+        genai_client.caches.delete.assert_called_once_with(name="cachedContents/123")
+
+    @patch('google.genai.Client')
+    def test_context_cache_falls_back_to_inline_prompt(self, MockGenAIClient):
+        """
+        If the cached context cannot be created, the codebook should be sent inline as before.
+        """
+        genai_client = MockGenAIClient.return_value
+        genai_client.caches.create.side_effect = RuntimeError("model does not support caching")
+        genai_client.models.generate_content_stream.return_value = self._stream("[]")
+
+        client = EmotionClassifierClient(self.log_file_path, use_context_cache=True)
+        client.classify_batch([{"NewID": "a", "Text": "Yes"}], 1, 1)
+
+        call = genai_client.models.generate_content_stream.call_args
+        self.assertIn("CODEBOOK:", call.kwargs["contents"][0])
+        self.assertIsNone(call.kwargs["config"].cached_content)
+        self.assertIsNotNone(call.kwargs["config"].system_instruction)
+
+    @patch('google.genai.Client')
+    def test_scores_only_schema_rejects_malformed_items(self, MockGenAIClient):
+        """
+        In scores-only structured mode the request should carry a schema built from the codebook, and each
+        response item should be validated on its own.
+        """
+        emotions = list(config.EMOTION_CODEBOOK)
+        good = {"NewID": "101", "analysis": {e: {"score": 1.2 if e == "fear" else 0.1} for e in emotions}}
+        missing_emotion = {"NewID": "102", "analysis": {e: {"score": 0.1} for e in emotions[1:]}}
+        bad_score = {"NewID": "103", "analysis": {e: {"score": "high"} for e in emotions}}
+        genai_client = MockGenAIClient.return_value
+        genai_client.models.generate_content_stream.return_value = self._stream(
+            json.dumps([good, missing_emotion, bad_score]))
+
+        client = EmotionClassifierClient(self.log_file_path, scores_only=True, use_response_schema=True)
+        results = client.classify_batch([{"NewID": i, "Text": "..."} for i in (101, 102, 103)], 1, 1)
+
+        call = genai_client.models.generate_content_stream.call_args
+        schema = call.kwargs["config"].response_schema
+        self.assertEqual(call.kwargs["config"].response_mime_type, "application/json")
+        self.assertEqual(sorted(schema["items"]["properties"]["analysis"]["properties"]), sorted(emotions))
+        self.assertNotIn("justification", call.kwargs["contents"][0])
+
+        # Only the valid item survives; its NewID is restored to the input's type and scores are clamped.
+        self.assertEqual([r["NewID"] for r in results], [101])
+        self.assertEqual(results[0]["analysis"]["fear"], {"score": 1.0})
+
+    @patch('google.genai.Client')
+    def test_truncated_stream_keeps_complete_excerpts(self, MockGenAIClient):
+        """
+        Excerpts that decoded before a truncation or a malformed element should be kept, and only the
+        missing NewIDs should be sent again.
+        """
+        item = self._item
+        first_response = ["```json\n[", item("a") + ",", '{"NewID": "b", "analysis": {"anger": {"score": 0.xx}}},',
+                          item("c") + ',\n{"NewID": "d", "analysis": {"ang']
+        genai_client = MockGenAIClient.return_value
+        genai_client.models.generate_content_stream.side_effect = [
+            iter([MagicMock(text=t) for t in first_response]),
+            self._stream(f"[{item('b')}, {item('d')}]"),
+        ]
+
+        client = EmotionClassifierClient(self.log_file_path)
+        scheduler = BatchScheduler(client, sleep=lambda delay: None)
+        batch = [{"NewID": new_id, "Text": "..."} for new_id in "abcd"]
+        results = scheduler.classify_batch(batch, 1, 1)
+
+        self.assertEqual(sorted(r["NewID"] for r in results), ["a", "b", "c", "d"])
+        second_prompt = genai_client.models.generate_content_stream.call_args_list[1].kwargs["contents"][0]
+        self.assertIn('"NewID": "b"', second_prompt)
+        self.assertIn('"NewID": "d"', second_prompt)
+        self.assertNotIn('"NewID": "a"', second_prompt)
+
+    @patch('google.genai.Client')
+    def test_run_metrics_record_calls_retries_and_tokens(self, MockGenAIClient):
+        """
+        A batch's metrics record should collect every API call, retry, token count and recovered row,
+        and the summary should be written after the batch records.
+        """
+        def chunk(text, prompt_tokens, output_tokens):
+            usage = MagicMock(prompt_token_count=prompt_tokens, candidates_token_count=output_tokens,
+                              cached_content_token_count=None)
+            return MagicMock(text=text, usage_metadata=usage)
+
+        genai_client = MockGenAIClient.return_value
+        genai_client.models.generate_content_stream.side_effect = [
+            iter([chunk(f"[{self._item('a')}", 900, 0), chunk("]", 900, 300)]),
+            iter([chunk(f"[{self._item('b')}]", 500, 150)]),
+        ]
+        client = EmotionClassifierClient(self.log_file_path)
+        scheduler = BatchScheduler(client, sleep=lambda delay: None)
+        metrics_path = os.path.join(self.log_dir, 'metrics.jsonl')
+        metrics = RunMetrics(metrics_path)
+
+        with metrics.batch(job="test", batch_num=1, excerpts=2):
+            scheduler.classify_batch([{"NewID": "a", "Text": "..."}, {"NewID": "b", "Text": "..."}], 1, 1)
+        summary = metrics.report(job="test", rows=2, elapsed=0.5)
+        metrics.close()
+
+        record = metrics.records[0]
+        self.assertEqual(record["api_calls"], 2)
+        self.assertEqual(record["retries"], 1)
+        self.assertEqual(record["rows_recovered"], 1)
+        self.assertEqual((record["prompt_tokens"], record["output_tokens"]), (1400, 450))
+        self.assertNotIn("cached_tokens", record)
+        self.assertIn("time_to_first_chunk_s", record)
+        self.assertIn("parse_s", record)
+        self.assertEqual(summary["tokens_per_row"], 925)
+        self.assertEqual(summary["rows_per_s"], 4)
+        with open(metrics_path) as f:
+            events = [json.loads(line)["event"] for line in f]
+        self.assertEqual(events, ["batch", "summary"])
+        self.assertEqual(percentile([4, 1, 3, 2], 50), 2.5)
+
+    @patch('google.genai.Client')
+    def test_prompt_log_is_compact_indexed_and_rotated(self, MockGenAIClient):
+        """
+        The codebook should be logged once per log file, each batch should log only its excerpts and
+        response, and the index should lead straight to every batch an excerpt was sent in.
+        """
+        genai_client = MockGenAIClient.return_value
+        genai_client.models.generate_content_stream.side_effect = [
+            self._stream(f"[{self._item('a')}, {self._item('b')}]"),
+            RuntimeError("quota exceeded"),
+            self._stream(f"[{self._item('c')}]"),
+        ]
+        client = EmotionClassifierClient(self.log_file_path, log_verbosity="batches")
+        client.logger.max_bytes = 1  # Every batch starts a new file.
+        client.classify_batch([{"NewID": "a", "Text": "..."}, {"NewID": "b", "Text": "..."}], 1, 2)
+        with self.assertRaises(RuntimeError):
+            client.classify_batch([{"NewID": "c", "Text": "..."}], 2, 2)
+        client.classify_batch([{"NewID": "c", "Text": "..."}], 2, 2)
+        client.close()
+
+        log_files = sorted(name for name in os.listdir(self.log_dir) if name.endswith(".jsonl.gz"))
+        self.assertEqual(log_files, ["prompt_log.1.jsonl.gz", "prompt_log.2.jsonl.gz", "prompt_log.3.jsonl.gz",
+                                     "prompt_log.jsonl.gz"])
+        with gzip.open(os.path.join(self.log_dir, "prompt_log.2.jsonl.gz"), 'rt', encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([r["type"] for r in records], ["static", "error"])
+        self.assertIn("CODEBOOK:", records[0]["prompt_suffix"])
+        self.assertNotIn("CODEBOOK:", json.dumps(records[1]))
+        self.assertEqual(records[1]["error"], "RuntimeError: quota exceeded")
+
+        index_path = os.path.join(self.log_dir, "prompt_log.index.jsonl")
+        self.assertEqual([r["type"] for r in read_log_entries(index_path, "c")], ["error", "batch"])
+        entry, = read_log_entries(index_path, "b")
+        self.assertEqual([e["NewID"] for e in entry["payload"]["excerpts_to_classify"]], ["a", "b"])
+        self.assertIn('"NewID": "b"', entry["response"])
+
+        # At "errors" verbosity only the failed call is logged.
+        genai_client.models.generate_content_stream.side_effect = [
+            self._stream(f"[{self._item('d')}]"), RuntimeError("timeout")]
+        client = EmotionClassifierClient(os.path.join(self.log_dir, 'errors.txt'), log_verbosity="errors")
+        client.classify_batch([{"NewID": "d", "Text": "..."}], 1, 2)
+        with self.assertRaises(RuntimeError):
+            client.classify_batch([{"NewID": "e", "Text": "..."}], 2, 2)
+        client.close()
+        index_path = os.path.join(self.log_dir, "errors.index.jsonl")
+        self.assertEqual(read_log_entries(index_path, "d"), [])
+        self.assertEqual(read_log_entries(index_path, "e")[0]["error"], "RuntimeError: timeout")
+
+    def test_self_consistency_aggregates_samples(self):
+        """
+        Several samples of a batch should be aggregated into mean scores with their variance and agreement,
+        taking only the first samples when they agree, and a single request in candidates mode.
+        """
+        batch = [{"NewID": str(i), "Text": f"Excerpt number {i}"} for i in range(4)]
+
+        noisy = FakeGenAIClient(latency=0, score_noise=0.2, seed=3)
+        client = EmotionClassifierClient(self.log_file_path, log_verbosity="off", genai_client=noisy, samples=3)
+        results = client.classify_batch(batch, 1, 1)
+        self.assertEqual(noisy.calls, 3)
+        self.assertEqual([r["NewID"] for r in results], ["0", "1", "2", "3"])
+        for result in results:
+            for entry in result["analysis"].values():
+                self.assertEqual(entry["samples"], 3)
+                self.assertGreaterEqual(entry["variance"], 0.0)
+                self.assertTrue(2 / 3 - 1e-4 <= entry["agreement"] <= 1.0)
+        self.assertTrue(any(entry["variance"] > 0 for r in results for entry in r["analysis"].values()))
+
+        # Identical samples stop after SELF_CONSISTENCY_MIN_SAMPLES calls.
+        steady = FakeGenAIClient(latency=0, score_noise=0, seed=3)
+        client = EmotionClassifierClient(self.log_file_path, log_verbosity="off", genai_client=steady, samples=3)
+        results = client.classify_batch(batch, 1, 1)
+        self.assertEqual(steady.calls, config.SELF_CONSISTENCY_MIN_SAMPLES)
+        entry = results[0]["analysis"]["fear"]
+        self.assertEqual((entry["variance"], entry["agreement"]), (0.0, 1.0))
+
+        candidates = FakeGenAIClient(latency=0, score_noise=0.2, seed=3)
+        client = EmotionClassifierClient(self.log_file_path, log_verbosity="off", genai_client=candidates,
+                                         samples=3, sample_mode="candidates")
+        results = client.classify_batch(batch, 1, 1)
+        self.assertEqual(candidates.calls, 1)
+        self.assertEqual(results[0]["analysis"]["fear"]["samples"], 3)
+        self.assertEqual(client.requests_per_batch, 1)
+
+
+class TestLocalScorer(unittest.TestCase):
+
+    def test_linear_scorer_is_only_confident_on_familiar_text(self):
+        """
+        A linear scorer trained on previous scores should reproduce them for familiar text and report low
+        confidence for text made of words it has not seen.
+        """
+        emotions = ["fear", "neutral"]
+        texts = [f"I am worried about care {i}" for i in range(40)] + [f"My mum takes care {i}" for i in range(40)]
+        scores = np.array([[0.9, 0.0]] * 40 + [[0.0, 0.9]] * 40)
+        scorer = LinearScorer.train(texts, scores, emotions, dim=256, alpha=0.1)
+
+        predicted, confidence = scorer.score(["I am worried about care", "My mum takes care", "Zebras juggle oranges"])
+        self.assertGreater(predicted[0, 0], 0.7)
+        self.assertGreater(predicted[1, 1], 0.7)
+        self.assertGreater(confidence[0], 0.9)
+        self.assertEqual(confidence[2], 0.0)
+
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_local_scorer.npz")
+        self.addCleanup(os.remove, path)
+        scorer.save(path)
+        np.testing.assert_allclose(LinearScorer.load(path).score(["My mum takes care"])[0], predicted[1:2])
+
+class TestEmotionService(unittest.TestCase):
+
+    def setUp(self):
+        self.service_dir = 'test_service'
+        os.makedirs(self.service_dir, exist_ok=True)
+        self.fake = FakeGenAIClient(latency=0.1, latency_sigma=0, seed=2)
+        self.client = EmotionClassifierClient(os.path.join(self.service_dir, 'prompt_log.jsonl.gz'),
+                                              log_verbosity="off", genai_client=self.fake)
+        self.cache = ResponseCache(os.path.join(self.service_dir, 'cache.sqlite'))
+        self.batcher = MicroBatcher(BatchScheduler(self.client, max_retries=2, sleep=lambda delay: None),
+                                    cache=self.cache, window=0.3)
+        self.server = create_server(self.batcher, "127.0.0.1", 0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.batcher.close()
+        self.cache.close()
+        self.client.close()
+        shutil.rmtree(self.service_dir)
+
+    def _post(self, body):
+        request = urllib.request.Request(f"{self.url}/classify", data=json.dumps(body).encode('utf-8'),
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return json.loads(response.read())
+
+    def test_concurrent_requests_share_one_call_and_the_cache(self):
+        """
+        Single-excerpt requests arriving together should be answered by one API call, a repeated excerpt
+        should come from the shared cache, and /health should count both.
+        """
+        texts = [f"Answer {i}: the school changes every term" for i in range(6)]
+        responses = [None] * len(texts)
+
+        def post(i):
+            responses[i] = self._post({"text": texts[i]})
+
+        threads = [threading.Thread(target=post, args=(i,)) for i in range(len(texts))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.fake.calls, 1)
+        for text, response in zip(texts, responses):
+            result, = response["results"]
+            self.assertEqual(result["text"], text)
+            self.assertEqual(result["source"], "gemini")
+            self.assertEqual(sorted(result["analysis"]), sorted(config.EMOTION_CODEBOOK))
+
+        again = self._post({"texts": [texts[0], ""]})["results"]
+        self.assertEqual(again[0]["source"], "cache")
+        self.assertEqual(again[0]["analysis"], responses[0]["results"][0]["analysis"])
+        self.assertIn("error", again[1])
+        self.assertEqual(self.fake.calls, 1)
+
+        with urllib.request.urlopen(f"{self.url}/health", timeout=10) as response:
+            health = json.loads(response.read())
+        self.assertEqual(health["status"], "ok")
+        self.assertEqual((health["requests"], health["excerpts"], health["cached"], health["sent"]), (7, 8, 1, 6))
+        self.assertEqual(health["batches"]["api_calls"], 1)
+
+    def test_reports_excerpts_the_model_did_not_answer_in_time(self):
+        """An excerpt still waiting for the model when the request times out should get the timeout message."""
+        result, = self.batcher.classify(["The school changes every term"], timeout=0.01)
+        self.assertEqual(result, {"error": "No answer from the model within 0.01s."})
+
+    def test_rejects_malformed_requests(self):
+        with self.assertRaises(urllib.error.HTTPError) as caught:
+            self._post({"texts": "not a list"})
+        self.assertEqual(caught.exception.code, 400)
+
+class TestStartup(unittest.TestCase):
+
+    HEAVY_MODULES = ("google.genai", "pandas", "openpyxl", "dotenv")
+
+    def _import_in_fresh_interpreter(self, module):
+        """Imports a module in a new interpreter; returns the heavy modules it loaded."""
+        code = (f"import json, sys; import {module}; "
+                f"print(json.dumps([m for m in {self.HEAVY_MODULES!r} if m in sys.modules]))")
+        completed = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+
+    def test_entry_points_import_without_heavy_dependencies(self):
+        """
+        The entry points should leave google.genai, openpyxl and the .env file to the code paths that use
+        them.
+        """
+        analyzer_modules = self._import_in_fresh_interpreter("ai_emotion_analyzer")
+        self.assertNotIn("google.genai", analyzer_modules)
+        self.assertNotIn("pandas", analyzer_modules)
+        self.assertNotIn("openpyxl", analyzer_modules)
+
+        processor_modules = self._import_in_fresh_interpreter("result_processor")
+        self.assertEqual(processor_modules, ["pandas"])
+        config_modules = self._import_in_fresh_interpreter("config")
+        self.assertEqual(config_modules, [])
+
+    def test_dry_run_plans_without_a_client(self):
+        """A dry run should report the planned batches without creating a client or writing any output."""
+        work_dir = 'test_dry_run'
+        os.makedirs(work_dir, exist_ok=True)
+        self.addCleanup(shutil.rmtree, work_dir)
+        make_input_sheet(os.path.join(work_dir, 'input.csv'), 50)
+        client_class = MagicMock(side_effect=AssertionError("the dry run created a client"))
+        with patch('ai_emotion_analyzer.INPUT_DIR', work_dir), patch('ai_emotion_analyzer.OUTPUT_DIR', work_dir), \
+                patch('ai_emotion_analyzer.SPREADSHEET_FILENAME', 'input.csv'), \
+                patch('ai_emotion_analyzer.EmotionClassifierClient', client_class):
+            analyzer_main(["--dry-run", "--no-cache"])
+        client_class.assert_not_called()
+        self.assertEqual(os.listdir(work_dir), ['input.csv'])
+
+        plan = plan_spreadsheet(os.path.join(work_dir, 'input.csv'))
+        self.assertEqual((plan["excerpts"], plan["sent"]), (50, 50))
+        self.assertEqual(plan["batches"], len(plan_batches(
+            [{"NewID": f"{i}_1", "Text": text} for i, text in enumerate(pd.read_csv(os.path.join(work_dir, 'input.csv'))["Text"])])))
+        self.assertGreater(plan["input_tokens"], 0)
+
+class TestScoreStore(unittest.TestCase):
+
+    def test_round_trips_analyses_and_shares_justifications(self):
+        """
+        Analyses should read back as the JSON that was stored, with repeated justifications kept once, and
+        analyses the arrays cannot hold exactly should be kept as they are.
+        """
+        emotions = list(config.EMOTION_CODEBOOK)
+        store = ScoreStore(emotions, capacity=2)
+        full = {e: {"score": 0.7, "justification": "Same text."} for e in emotions}
+        partial = {emotions[1]: {"score": 0.25}, emotions[3]: {"score": 1, "justification": "Other text."}}
+        sampled = {e: {"score": 0.33, "justification": "Sampled.", "variance": 0.0123, "agreement": 0.6667,
+                       "samples": 3} for e in emotions}
+        for i in range(5):
+            store.add(f"f{i}", full)
+        store.add("p", partial)
+        store.add("s", sampled)
+
+        self.assertEqual(len(store), 7)
+        for new_id, analysis in [("f4", full), ("p", partial), ("s", sampled)]:
+            self.assertEqual(json.loads(store[new_id]), analysis)
+            self.assertEqual(store.analysis(new_id), analysis)
+        self.assertEqual(store.justifications, ["Same text.", "Other text.", "Sampled."])
+        self.assertIsNone(store.analysis("missing"))
+
+        # Unknown emotions, extra fields and scores float32 cannot hold are stored as JSON.
+        odd = [{"other": {"score": 0.5}}, {emotions[0]: {"score": 0.5, "note": "x"}},
+               {emotions[0]: {"score": 0.123456789}}, {emotions[2]: {"score": 0.1}, emotions[0]: {"score": 0.2}}]
+        for i, analysis in enumerate(odd):
+            store.add(f"f{i}", analysis)
+            self.assertEqual(store[f"f{i}"], json.dumps(analysis))
+        store.add("f0", full)
+        self.assertEqual(json.loads(store["f0"]), full)
+        self.assertEqual(sorted(store), ["f0", "f1", "f2", "f3", "f4", "p", "s"])
+
+
+class TestResultProcessor(unittest.TestCase):
+
+    def test_vectorized_frames_match_rowwise(self):
+        """
+        The vectorized engine should produce exactly the sheets of the row-by-row implementation,
+        including ties, integer scores, missing emotions, extra keys and unparseable responses.
+        """
+        emotions = list(config.EMOTION_CODEBOOK)
+        full = {e: {"score": 0.2, "justification": f"{e} note"} for e in emotions}
+        responses = [
+            json.dumps(full),
+            json.dumps({**full, emotions[1]: {"score": 0.8, "justification": "high"}}),
+            # A tie whose key order differs from the codebook order: the row's own first maximum wins.
+            json.dumps({emotions[2]: {"score": 0.7}, emotions[0]: {"score": 0.7, "justification": "tie"}}),
+            json.dumps({emotions[0]: {"score": 1}, "other": {"score": 0.9, "justification": "extra"}}),
+            json.dumps({emotions[3]: {"justification": "no score"}}),
+            json.dumps({}),
+            "not json",
+            None,
+        ]
+        df = pd.DataFrame({
+            "ResponseID": range(len(responses)),
+            "NewID": [f"id_{i}" for i in range(len(responses))],
+            "Text": ["..."] * len(responses),
+            "Model_Response": responses,
+        })
+
+        parsed = parse_model_responses(df)
+        self.assertEqual(len(parsed), 6)
+        for threshold in (0.0, 0.5, 0.7, 1.0):
+            expected_detailed, expected_summary = build_analysis_frames_rowwise(df, threshold)
+            detailed, summary = build_analysis_frames(parsed, threshold)
+            pd.testing.assert_frame_equal(detailed, expected_detailed)
+            pd.testing.assert_frame_equal(summary, expected_summary)
+
+        # Without justifications both engines still agree, and neither sheet has justification columns.
+        parsed = parse_model_responses(df, scores_only=True)
+        expected_detailed, expected_summary = build_analysis_frames_rowwise(df, 0.5, scores_only=True)
+        detailed, summary = build_analysis_frames(parsed, 0.5)
+        pd.testing.assert_frame_equal(detailed, expected_detailed)
+        pd.testing.assert_frame_equal(summary, expected_summary)
+        self.assertFalse([col for col in detailed.columns if col.endswith("_justification")])
+        self.assertNotIn("Top_Justification", summary.columns)
+
+        # Scores given as strings are left to the row-by-row implementation.
+        df.loc[0, "Model_Response"] = json.dumps({emotions[0]: {"score": "0.9"}})
+        self.assertIsNone(parse_model_responses(df))
+
+    def test_low_confidence_flags_follow_sample_variance(self):
+        """
+        With self-consistency statistics, rows whose largest variance exceeds --max-variance should be flagged,
+        identically in both engines; without statistics no columns are added.
+        """
+        emotions = list(config.EMOTION_CODEBOOK)
+
+        def response(variance):
+            return json.dumps({e: {"score": 0.5, "justification": "...", "variance": variance if e == emotions[0] else 0.0,
+                                   "agreement": 1.0, "samples": 3} for e in emotions})
+
+        df = pd.DataFrame({
+            "ResponseID": range(3),
+            "NewID": ["a", "b", "c"],
+            "Text": ["..."] * 3,
+            "Model_Response": [response(0.001), response(0.05), json.dumps({emotions[0]: {"score": 0.9}})],
+        })
+        parsed = parse_model_responses(df)
+        detailed, _ = build_analysis_frames(parsed, 0.5, max_variance=0.02)
+        self.assertEqual(detailed["Low_Confidence"].tolist(), [0, 1, 0])
+        self.assertEqual(detailed["Max_Variance"].tolist()[:2], [0.001, 0.05])
+        self.assertTrue(np.isnan(detailed["Max_Variance"].iloc[2]))
+        expected, _ = build_analysis_frames_rowwise(df, 0.5, max_variance=0.02)
+        pd.testing.assert_frame_equal(detailed, expected)
+
+        # Without --max-variance, or without statistics, the sheet is unchanged.
+        self.assertNotIn("Low_Confidence", build_analysis_frames(parsed, 0.5)[0])
+        plain = df.assign(Model_Response=[json.dumps({emotions[0]: {"score": 0.9}})] * 3)
+        self.assertNotIn("Low_Confidence", build_analysis_frames(parse_model_responses(plain), 0.5, 0.02)[0])
+
+    def test_threshold_sweep_scores_against_labels(self):
+        """
+        A sweep should report prevalence, neutral rate and per-emotion precision/recall/F1 for every threshold.
+        """
+        test_dir = 'test_sweep'
+        os.makedirs(test_dir, exist_ok=True)
+        self.addCleanup(shutil.rmtree, test_dir)
+
+        def response(**scores):
+            return json.dumps({e: {"score": scores.get(e, 0.1), "justification": "..."} for e in config.EMOTION_CODEBOOK})
+
+        raw_output_path = os.path.join(test_dir, "raw.xlsx")
+        pd.DataFrame({
+            "ResponseID": [1, 2, 3],
+            "NewID": ["a", "b", "c"],
+            "Text": ["...", "...", "..."],
+            "Model_Response": [response(anger=0.9), response(anger=0.5, sadness=0.7), response()],
+        }).to_excel(raw_output_path, sheet_name='LLM_Raw_Output', index=False)
+        labels_path = os.path.join(test_dir, "labels.xlsx")
+        pd.DataFrame({"NewID": ["a", "b", "c"], "Human_Label": ["anger", "Sadness", "neutral"]}) \
+            .to_excel(labels_path, sheet_name='Coded', index=False)
+
+        thresholds = parse_threshold_range("0.4:0.8:0.2")
+        self.assertEqual(thresholds, [0.4, 0.6, 0.8])
+        process_threshold_sweep(raw_output_path, thresholds, labels_file=labels_path, labels_sheet='Coded')
+
+        analysis_path = os.path.join(test_dir, "raw_analysis.xlsx")
+        neutral = pd.read_excel(analysis_path, sheet_name='Threshold_Neutral_Rate')
+        self.assertEqual(neutral['Neutral_Count'].tolist(), [1, 1, 2])
+        prevalence = pd.read_excel(analysis_path, sheet_name='Threshold_Prevalence').set_index('Threshold')
+        self.assertAlmostEqual(prevalence.loc[0.4, 'anger'], 2 / 3)
+        self.assertAlmostEqual(prevalence.loc[0.8, 'sadness'], 0.0)
+
+        metrics = pd.read_excel(analysis_path, sheet_name='Threshold_Metrics').set_index(['Threshold', 'Emotion'])
+        self.assertAlmostEqual(metrics.loc[(0.4, 'anger'), 'Precision'], 0.5)
+        self.assertAlmostEqual(metrics.loc[(0.4, 'anger'), 'Recall'], 1.0)
+        self.assertAlmostEqual(metrics.loc[(0.8, 'anger'), 'F1'], 1.0)
+        self.assertAlmostEqual(metrics.loc[(0.8, 'sadness'), 'Recall'], 0.0)
+        self.assertEqual(metrics.loc[(0.4, 'neutral'), 'Support'], 1)
+        self.assertIn((0.6, 'macro_avg'), metrics.index)
+
 
 if __name__ == '__main__':
     unittest.main()